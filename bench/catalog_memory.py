@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""catalog_memory.py
+Compares the resident size of the product details for a synthetic catalog
+when kept as the raw catalog plus an info dict per installer, and when kept
+as InstallerProduct records once the catalog is released.
+
+    python bench/catalog_memory.py [PRODUCT_COUNT ...]
+"""
+
+import datetime
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import installinstallmacos_gui as iim  # noqa: E402
+
+
+def resident_size():
+    """Returns the current resident set size of this process in bytes."""
+    output = subprocess.check_output(["ps", "-o", "rss=", "-p",
+                                      str(os.getpid())])
+    return int(output.strip()) * 1024
+
+
+def resident_growth(before, *held):
+    """Returns how much the resident size grew since before. The measured
+    objects are passed as held, which keeps them alive until then."""
+    iim.release_free_memory()
+    return resident_size() - before
+
+
+def measure_resident_size(function):
+    """Calls function in a forked child and returns how much the child's
+    resident size grew while it holds the result, in bytes. Forking keeps
+    memory freed by one measurement from being reused by the next."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        # The child must never return into the caller's code.
+        status = 1
+        try:
+            os.close(read_fd)
+            iim.release_free_memory()
+            before = resident_size()
+            os.write(write_fd, str(resident_growth(before, function())))
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as the_pipe:
+        output = the_pipe.read()
+    _, status = os.waitpid(pid, 0)
+    if status:
+        raise RuntimeError("Measurement failed with status %d." % status)
+    return int(output)
+
+
+def synthetic_catalog(product_count, installer_count=50, package_count=12,
+                      model_count=120):
+    """Returns a catalog of product_count products, installer_count of them
+    macOS installers, and the info dicts parsing the installers' metadata
+    and distribution files would give."""
+    products = {}
+    infos = {}
+    installer_every = max(product_count // max(installer_count, 1), 1)
+    for index in range(product_count):
+        product_key = "061-%05d" % index
+        base = ("https://swcdn.apple.com/content/downloads/%02d/%02d/%s/" %
+                (index % 100, index % 37, product_key))
+        packages = [{
+            "URL": base + "Package%d.pkg" % number,
+            "MetadataURL": base + "Package%d.pkm" % number,
+            "Size": 1000000 * (number + 1),
+            "Digest": "%040x" % (index * package_count + number),
+            "IntegrityDataURL": base + "Package%d.integrityDataV1" % number,
+            "IntegrityDataSize": 4096,
+        } for number in range(package_count)]
+        products[product_key] = {
+            "ServerMetadataURL": base + product_key + ".smd",
+            "PostDate": datetime.datetime(2019, 1, 1) +
+            datetime.timedelta(hours=index),
+            "Distributions": {"English": base + product_key +
+                              ".English.dist"},
+            "Packages": packages,
+        }
+        if index % installer_every or len(infos) >= installer_count:
+            continue
+        products[product_key]["ExtendedMetaInfo"] = {
+            "InstallAssistantPackageIdentifiers": {
+                "OSInstall": "com.apple.mpkg.OSInstall"}}
+        # minidom hands back a new unicode object for every string.
+        infos[product_key] = {
+            "title": u"macOS Catalina",
+            "version": u"10.15.%d" % (index % 8),
+            "BUILD": u"19H%d" % index,
+            "VERSION": u"10.15.%d" % (index % 8),
+            "DistributionPath": "/private/tmp" + base[7:] + product_key +
+            ".English.dist",
+            "nonSupportedModels": [u"MacBookPro%d,%d" % divmod(model, 4)
+                                   for model in range(model_count)],
+            "PackageOrder": [u"Package%d.pkg" % number
+                             for number in range(package_count)],
+        }
+    return {"Products": products}, infos
+
+
+def benchmark_catalog_memory(product_count=5000):
+    """Returns the resident size, in bytes, of the product details for a
+    synthetic catalog of product_count products, kept both ways."""
+    def as_dicts():
+        catalog, infos = synthetic_catalog(product_count)
+        for product_key, info in infos.items():
+            info["PostDate"] = catalog["Products"][product_key]["PostDate"]
+        return catalog, infos
+
+    def as_records():
+        catalog, infos = synthetic_catalog(product_count)
+        records = {}
+        for product_key, info in infos.items():
+            product = catalog["Products"][product_key]
+            records[product_key] = iim.InstallerProduct.from_info(
+                info, post_date=product["PostDate"],
+                packages=[iim.slim_package(package)
+                          for package in product["Packages"]])
+        return records
+
+    return {"dicts": measure_resident_size(as_dicts),
+            "records": measure_resident_size(as_records)}
+
+
+def main():
+    for product_count in [int(arg) for arg in sys.argv[1:]] or [5000]:
+        result = benchmark_catalog_memory(product_count)
+        print("%d products: dicts %s records %s" % (
+            product_count, iim.convert_size(result["dicts"]),
+            iim.convert_size(result["records"])))
+
+
+if __name__ == "__main__":
+    main()
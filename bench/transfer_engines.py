@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""transfer_engines.py
+Compares how long the serial and the pool TransferEngine take to replicate
+a batch of small files, like the metadata and distribution files of a
+catalog, from a local server that adds a fixed latency to every request.
+
+    python bench/transfer_engines.py [FILE_COUNT [LATENCY_MS [FILE_SIZE]]]
+"""
+
+import os
+import shutil
+import SimpleHTTPServer
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import installinstallmacos_gui as iim  # noqa: E402
+
+
+class LatencyServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Object that serves the files under root over loopback, waiting
+    latency seconds before answering each request."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, root, latency):
+        server = self
+
+        class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def translate_path(self, path):
+                return server.root + path.split("?")[0]
+
+            def do_GET(self):
+                time.sleep(server.latency)
+                return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+        SocketServer.TCPServer.__init__(self, ("127.0.0.1", 0), Handler)
+        self.root = root
+        self.latency = latency
+        self.base_url = "http://127.0.0.1:%d" % self.server_address[1]
+
+
+def write_files(root, file_count, file_size):
+    """Writes file_count files of file_size random bytes under root and
+    returns their paths relative to it."""
+    paths = []
+    for index in range(file_count):
+        path = "/p/%05d/English.dist" % index
+        os.makedirs(os.path.dirname(root + path))
+        with open(root + path, "wb") as the_file:
+            the_file.write(os.urandom(file_size))
+        paths.append(path)
+    return paths
+
+
+def time_engine(engine, urls, workdir):
+    """Returns the seconds engine takes to replicate urls into workdir."""
+    started = time.time()
+    engine.map(lambda url: iim.replicate_url(
+        None, url, None, root_dir=workdir, **engine.options()), urls)
+    return time.time() - started
+
+
+def benchmark_transfer_engines(file_count=50, latency=0.05, file_size=20000):
+    """Returns the seconds the serial and the pool engine take to replicate
+    file_count files of file_size bytes, each answered after latency
+    seconds."""
+    scratch = tempfile.mkdtemp()
+    server = LatencyServer(os.path.join(scratch, "origin"), latency)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        urls = [server.base_url + path
+                for path in write_files(server.root, file_count, file_size)]
+        return {
+            "serial": time_engine(iim.TransferEngine(), urls,
+                                  os.path.join(scratch, "serial")),
+            "pool": time_engine(
+                iim.TransferEngine(workers=iim.TRANSFER_WORKERS,
+                                   timeout=iim.TRANSFER_TIMEOUT),
+                urls, os.path.join(scratch, "pool")),
+        }
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(scratch)
+
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:4]]
+    file_count, latency_ms, file_size = args + [50, 50, 20000][len(args):]
+    # The run's log output would swamp the results.
+    iim.log_stderr.level = 100
+    result = benchmark_transfer_engines(file_count, latency_ms / 1000.0,
+                                        file_size)
+    print("%d files of %s, %d ms latency: serial %.2fs pool %.2fs "
+          "(%.1fx)" % (file_count, iim.convert_size(file_size), latency_ms,
+                       result["serial"], result["pool"],
+                       result["serial"] / result["pool"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -51,62 +51,56 @@ for path in PYTHON_FRAMEWORK_PATHS:
         sys.path.append(path)
 
 import argparse
+import atexit
+import base64
+import BaseHTTPServer
+import bisect
+import contextlib
+import copy
+import cProfile
+import calendar
+import ctypes
 import json
 import logging
 import logging.handlers
+import datetime
+import errno
+import fcntl
+import gc
 import glob
 import gzip
+import hashlib
+import httplib
 import math
-import objc
+import mmap
 import os
 import plistlib
 import Queue
+import random
+import re
+import resource
+import select
+import shutil
 import signal
+import socket
+import SocketServer
+import stat
+import struct
 import subprocess
+import tempfile
 import threading
 import time
 import urlparse
 import urllib2
+import zlib
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
 from xml.dom import minidom
 from xml.parsers.expat import ExpatError
-from SystemConfiguration import SCDynamicStoreCopyLocalHostName
 
 
-from Foundation import (
-    NSObject,
-    NSString,
-    NSTimer,
-)
-
-# put all AppKit imports used by the project here
-from AppKit import (
-    NSAlert,
-    NSApp,
-    NSApplication,
-    NSAutoreleasePool,
-    NSBundle,
-    NSClosableWindowMask,
-    NSCriticalAlertStyle,
-    NSFont,
-    NSImage,
-    NSImageView,
-    NSInformationalAlertStyle,
-    NSMiniaturizableWindowMask,
-    NSProgressIndicator,
-    NSProgressIndicatorSpinningStyle,
-    NSResizableWindowMask,
-    NSScreenSaverWindowLevel,
-    NSTextField,
-    NSTitledWindowMask,
-    NSWindow,
-    NSWindowController
-)
-
-from PyObjCTools import AppHelper
-
-
-DEFAULT_PROGRESS_STRING = NSString.stringWithString_(u"Beginning Process...")
-
 DEFAULT_SUCATALOGS = {
     "17": "https://swscan.apple.com/content/catalogs/others/"
           "index-10.13-10.12-10.11-10.10-10.9"
@@ -130,6 +124,25 @@ USER_AGENT = (
     "MacAppStore/3.0 (Macintosh; OS X 10.14.3; 18D109) AppleWebKit/14606.4.5")
 
 CACHE_LOCATOR = ("/usr/bin/AssetCacheLocatorUtil")
+INSTALLER_CMD = ("/usr/sbin/installer")
+
+# Limits for the pooled transfer engine. The timeout is in seconds and applies
+# to connecting and to each read.
+TRANSFER_WORKERS = 8
+TRANSFER_PER_HOST = 4
+TRANSFER_TIMEOUT = 60
+# Ring of reusable buffers between the network reader and the disk writer for
+# large downloads. Files smaller than the threshold are written directly.
+TRANSFER_BUFFERS = 8
+TRANSFER_BUFFER_SIZE = 1048576
+PIPELINE_THRESHOLD = 5000000
+# Files that are fetched compressed when the server offers it. Packages and
+# disk images are compressed already, and are fetched as is so a partial
+# copy can be resumed. Files are stored decompressed, but anything that
+# starts with GZIP_MAGIC is read as gzip whatever its name.
+COMPRESSIBLE_EXTENSIONS = (".sucatalog", ".smd", ".dist", ".plist", ".xml")
+GZIP_MAGIC = "\x1f\x8b"
+PKGUTIL_CMD = ("/usr/sbin/pkgutil")
 
 CUSTOM_ICNS = ("None")
 SU_ICNS = ("/System/Library/CoreServices/Software Update.app/Contents/" +
@@ -138,11 +151,90 @@ APP_ICNS = ("/Applications/App Store.app/Contents/Resources/AppIcon.icns")
 
 # Set progress bars to max out at 100, which allows for more granularity.
 PROGRESS_BAR_MAX_VALUE = 100.0
-# Weight of different stages of the process.
-METADATA_WEIGHT = (1.0 / 100.0)
-CATALOG_WEIGHT = (2.0 / 100.0)
-PRODUCT_INFO_WEIGHT = (2.0 / 100.0)
-PRODUCT_WEIGHT = (74.0 / 100.0)
+# Share of the overall progress bar for each phase of the process. Within
+# a phase, progress is the bytes moved against the bytes expected.
+PROGRESS_PHASES = (("catalog", 5.0), ("downloads", 80.0), ("install", 15.0))
+# Seconds between progress updates sent to the GUI, bytes a transfer buffers
+# before reporting them, and the smoothing factor for the throughput.
+PROGRESS_PUBLISH_INTERVAL = 0.1
+PROGRESS_FLUSH_BYTES = 65536
+PROGRESS_SAMPLE_INTERVAL = 0.5
+PROGRESS_SMOOTHING = 0.3
+
+# How many times a failed installer run is retried after re-fetching the
+# damaged files, and the initial delay in seconds. The delay doubles.
+RECOVERY_ATTEMPTS = 2
+RECOVERY_BACKOFF = 5
+
+# Package fields kept in an InstallerProduct once the catalog is released.
+PACKAGE_KEYS = ("URL", "MetadataURL", "Size", "Digest")
+
+# Downloads are written to the file name plus PART_SUFFIX and renamed when
+# complete. A process downloading a file holds an flock on the file name
+# plus LOCK_SUFFIX; others wait, checking every LOCK_POLL_INTERVAL seconds.
+PART_SUFFIX = ".part"
+LOCK_SUFFIX = ".lock"
+LOCK_POLL_INTERVAL = 0.5
+
+# --metrics-file is rewritten this often, in seconds, with metric names
+# starting with METRICS_PREFIX.
+METRICS_INTERVAL = 5
+METRICS_PREFIX = "installinstallmacos_"
+
+# Bytes sent per write by the mirror server.
+MIRROR_CHUNK_SIZE = 1048576
+
+# Fleet simulation: the packages of the stand-in installer, the bytes
+# metered per throttle call, and the listen backlog of the stand-in servers.
+SIMULATION_PACKAGES = 4
+SIMULATION_PACKAGE_SIZE = 2 * 1048576
+SIMULATION_CHUNK_SIZE = 65536
+SIMULATION_BACKLOG = 1024
+
+# Cassettes: bodies of other files larger than CASSETTE_BODY_LIMIT bytes are
+# not kept and are replayed as filler of the same size. The timing profile
+# of each response is sampled every CASSETTE_SAMPLE_INTERVAL seconds, and
+# replays are paced in CASSETTE_CHUNK_SIZE writes.
+CASSETTE_FILE = "cassette.json"
+CASSETTE_BODY_LIMIT = 1048576
+CASSETTE_SAMPLE_INTERVAL = 0.25
+CASSETTE_CHUNK_SIZE = 65536
+
+# Control socket of --daemon, the commands it accepts, and the shortest
+# time in seconds between background catalog refreshes.
+DAEMON_SOCKET = "/var/run/installinstallmacos_gui.sock"
+DAEMON_COMMANDS = ("list", "prefetch", "stage", "install")
+DAEMON_MIN_REFRESH = 60
+
+# Background prefetch: niceness, seconds between checks for an open window,
+# and the setiopolicy_np constants from <sys/resource.h>.
+PREFETCH_NICENESS = 10
+PREFETCH_WINDOW_CHECK = 60
+IOPOL_TYPE_DISK = 0
+IOPOL_SCOPE_PROCESS = 0
+IOPOL_THROTTLE = 3
+
+# Seconds between estimated finish time updates while downloading.
+PROGRESS_REPORT_INTERVAL = 5
+
+# Least seconds between progress events on --progress-stream. Phase changes
+# and finished phases are always sent.
+PROGRESS_STREAM_INTERVAL = 0.5
+# Events waiting for a slow --progress-stream reader before new ones are
+# dropped, and the seconds a socket may take no data before the stream ends.
+PROGRESS_STREAM_QUEUE_SIZE = 1000
+PROGRESS_STREAM_TIMEOUT = 10
+
+# Retry policy for replicate_url. Delays are in seconds.
+RETRY_ATTEMPTS = 4
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+# A host is skipped after this many failures in a row, for this many seconds.
+CIRCUIT_FAILURE_LIMIT = 5
+CIRCUIT_RESET_AFTER = 60
+
+# Number of entries in each --profile allocation report.
+PROFILE_TOP_N = 25
 
 # Custom Log Levels.
 ## These are set between logging.INFO (20) and logging.WARN (30) purposefully.
@@ -171,6 +263,112 @@ if not os.path.exists(SCRIPT_CACHE):
     os.makedirs(SCRIPT_CACHE)
 ### Create the name of the log file for the logger.
 LOG_FILE = os.path.join(LOG_PARENT_DIR, LONG_R_DOMAIN + ".log")
+### Record of the installer products processed on previous runs.
+SNAPSHOT_FILE = os.path.join(SCRIPT_CACHE, LONG_R_DOMAIN + ".snapshot.json")
+SNAPSHOT_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+### Indexed copies of parsed catalogs, one per set of catalog URLs.
+CATALOG_INDEX_DIR = os.path.join(SCRIPT_CACHE, "catalogs")
+CATALOG_INDEX_MAGIC = "IIMCIDX1"
+### Cached system_profiler hardware report.
+HARDWARE_CACHE = os.path.join(SCRIPT_CACHE, "SPHardwareDataType.plist")
+HARDWARE_CACHE_MAX_AGE = 24 * 60 * 60
+### Reuse a downloaded catalog for this many seconds by default.
+CATALOG_MAX_AGE = 15 * 60
+
+# The log file is written by a background thread fed through a bounded queue,
+# flushed once per batch. When the queue is full, DEBUG records and the SLVL
+# download progress lines are dropped rather than blocking the thread that
+# logged them.
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 256
+
+
+class AsyncLogHandler(logging.Handler):
+    """Handler that hands records to a writer thread, which writes them with
+    the target file handler and flushes once per batch.
+    """
+    def __init__(self, target, queue_size=LOG_QUEUE_SIZE,
+                 batch_size=LOG_BATCH_SIZE):
+        logging.Handler.__init__(self, target.level)
+        self.target = target
+        self.batch_size = batch_size
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        # Render the message now, while its arguments are still current. The
+        # record is shared with the other handlers, so a copy is changed.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            if record.levelno <= SLVL:
+                self.dropped += 1
+            else:
+                self.queue.put(record)
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.target.close()
+        logging.Handler.close(self)
+
+    def _writer(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            done = None in batch
+            records = [record for record in batch if record is not None]
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                records.append(logging.makeLogRecord({
+                    "name": SCRIPT_NAME, "levelno": logging.WARNING,
+                    "levelname": "WARNING", "funcName": "_writer",
+                    "msg": "Dropped %d DEBUG and progress records." %
+                           dropped}))
+            for record in records:
+                self._write(record)
+            try:
+                self.target.flush()
+            except (OSError, IOError):
+                pass
+            for _ in batch:
+                self.queue.task_done()
+            if done:
+                break
+
+    def _write(self, record):
+        # Same as StreamHandler.emit without the flush after every record.
+        target = self.target
+        try:
+            if target.shouldRollover(record):
+                target.doRollover()
+            if target.stream is None:
+                target.stream = target._open()
+            message = target.format(record)
+            if isinstance(message, unicode):
+                message = message.encode("utf-8")
+            target.stream.write(message + "\n")
+        except Exception:
+            target.handleError(record)
+
 
 ## Configure the logger object.
 ### Custom Log Levels:
@@ -198,7 +396,7 @@ log_stderr.setFormatter(easy_formatter)
 log_logfile.setFormatter(file_formatter)
 ### Add all of the handlers to this logging instance:
 logger.addHandler(log_stderr)
-logger.addHandler(log_logfile)
+logger.addHandler(AsyncLogHandler(log_logfile))
 
 
 class ReplicationError(Exception):
@@ -206,239 +404,548 @@ class ReplicationError(Exception):
     pass
 
 
-class ErrorSheet(NSAlert):
-    sheet_parent = None
-
-    def init(self, *args, **kwargs):
-        # Call the super class (ErrorSheet)
-        self = objc.super(ErrorSheet, self).init(*args, **kwargs)
-        return self
-
-    def setParent(self, window):
-        self.sheet_parent = window
-
-    def displayMessage(self, title, message, type=NSInformationalAlertStyle):
-        def errorClose(returncode):
-            self.sheet_parent.close()
-
-        self.setMessageText_(title)
-        self.setInformativeText_(message)
-        self.setAlertStyle_(type)
-        self.addButtonWithTitle_(NSString.stringWithString_("Exit"))
-        self.beginSheetModalForWindow_completionHandler_(
-            self.sheet_parent, errorClose)
-
-    def destroy(self):
-        self = None
-
-
-# This metadata is missing from PyObjC, so it has to be created here.
-objc.registerMetaDataForSelector(
-    b"NSAlert", b"beginSheetModalForWindow:completionHandler:",
-    dict(arguments={3: {"callable": {"retval":
-                                     {"type": b"v"},
-                                     "arguments":
-                                     {0: {"type": b"^v"},
-                                      1: {"type": b"q"}}}}}))
-
-
-class StatusText(NSTextField):
-    def initWithFrame_(self, *args, **kwargs):
-        # Call the super class (NSTextField)
-        self = objc.super(StatusText, self).initWithFrame_(*args, **kwargs)
-        self.setStringValue_(
-            NSString.stringWithString_(u"Progress Bar"))
-        self.setBezeled_(False)
-        self.setDrawsBackground_(False)
-        self.setSelectable_(False)
-        self.setFont_(NSFont.systemFontOfSize_(14))
-        return self
-
-
-class ProgressSpinner(NSProgressIndicator):
-    def initWithFrame_(self, *args, **kwargs):
-        # Call the super class (NSProgressIndicator)
-        self = objc.super(ProgressSpinner,
-                          self).initWithFrame_(*args, **kwargs)
-        self.setStyle_(NSProgressIndicatorSpinningStyle)
-        self.setIndeterminate_(True)
-
-
-class ProgressBar(NSProgressIndicator):
-    def initWithFrame_(self, *args, **kwargs):
-        # Call the super class (NSProgressIndicator)
-        self = objc.super(ProgressBar, self).initWithFrame_(*args, **kwargs)
-        self.setIndeterminate_(False)
-        self.setMinValue_(0.0)
-        self.setMaxValue_(PROGRESS_BAR_MAX_VALUE)
-        return self
-
-
-class ProgressWindow(NSWindowController):
-    # Class Attributes
-    window = NSWindow.alloc()
-    window_icon = NSImageView.alloc()
-    window_icon_file = NSImage.alloc()
-    updateTimer = None
-    overall_pbar = ProgressBar.alloc()
-    stage_pbar = ProgressBar.alloc()
-    spinner = ProgressSpinner.alloc()
-    errorSheet = ErrorSheet.alloc()
-    overall_text = StatusText.alloc()
-    stage_text = StatusText.alloc()
-    version_text = StatusText.alloc()
-    versionText = NSString.stringWithString_(u"Progress Window")
-    # This style mask prevents the window from being resized or minimized.
-    style_mask = (
-        NSTitledWindowMask | NSClosableWindowMask &
-        ~NSResizableWindowMask & ~NSMiniaturizableWindowMask)
-
-    def init(self, *args, **kwargs):
-        self = objc.super(ProgressWindow, self).init(*args, **kwargs)
-        self.queue = Queue.Queue()
-        return self
-
-    def showProgressWindow(self):
-        logger.debug("Configuring main window.")
-        frame = ((0.0, 0.0), (480.0, 240.0))
-        self.window.initWithContentRect_styleMask_backing_defer_(
-            frame, ProgressWindow.style_mask, 2, 0)
-        self.window.setCanBecomeVisibleWithoutLogin_(True)
-        self.window.setLevel_(NSScreenSaverWindowLevel - 1)
-        self.window.center()
-        self.window.setTitle_("Downloading macOS")
-
-        # Use a pretty icon to make the window look more composed.
-        self.window_icon_file.initByReferencingFile_(self._findIcon())
-
-        logger.debug("Finished setting up main window. Defining subelements.")
-        # Layout. Each frame element is a rectangle defined as:
-        # ((x offset from origin, y offset from origin), (width, height))
-        # where origin is the top left corner of the window.
-        self.window_icon.initWithFrame_(((10.0, 165.0), (60.0, 60.0)))
-        self.overall_pbar.initWithFrame_(((10.0, 95.0), (460.0, 20.0)))
-        self.overall_text.initWithFrame_(((10.0, 115.0), (460.0, 40.0)))
-        self.stage_pbar.initWithFrame_(((10.0, 15.0), (460.0, 20.0)))
-        self.stage_text.initWithFrame_(((10.0, 35.0), (460.0, 40.0)))
-
-        logger.debug("Adding subelements to main window.")
-        self.window_icon.setImage_(self.window_icon_file)
-        self.window.contentView().addSubview_(self.window_icon)
-        self.window.contentView().addSubview_(self.overall_pbar)
-        self.window.contentView().addSubview_(self.overall_text)
-        self.window.contentView().addSubview_(self.stage_pbar)
-        self.window.contentView().addSubview_(self.stage_text)
-
-        logger.debug("Done setting up window. Now displaying.")
-        self.window.display()
-        self.window.orderFrontRegardless()
-
-    def showVersionInfo(self, text):
-        self.version_text.initWithFrame_(((80.0, 165.0), (460.0, 40.0)))
-        self.version_text.setFont_(NSFont.systemFontOfSize_(18))
-        self.window.contentView().addSubview_(self.version_text)
-        self.version_text.setStringValue_(
-            NSString.stringWithString_(text))
-        self.version_text.displayIfNeeded()
-
-    def startQueueLoop(self):
-        # Display and continuously update elements of the main window.
-        self.stopQueueLoop()
-        # Run the incoming items once.
-        self.runAnyIncomingItems()
-        # Kick off a timer that checks the queue periodically.
-        self.updateTimer = NSTimer.scheduledTimerWithTimeInterval_target_selector_userInfo_repeats_(
-            0.1,
-            self,
-            u"runAnyIncomingItems",
-            None,
-            True
-        )
+class ShortReadError(ReplicationError):
+    """The connection closed before the whole file arrived"""
+    pass
+
+
+class CircuitOpenError(ReplicationError):
+    """A host has failed too often and is not being contacted"""
+    pass
+
+
+class RetryPolicy(object):
+    """Object that decides which replication errors are worth retrying and
+    how long to wait before each retry: exponential backoff with full
+    jitter, capped at max_delay.
+    """
+    # HTTP status codes that indicate a transient server problem.
+    retryable_statuses = (408, 429, 500, 502, 503, 504)
+
+    def __init__(self, attempts=RETRY_ATTEMPTS, base_delay=RETRY_BASE_DELAY,
+                 max_delay=RETRY_MAX_DELAY):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_retryable(self, err):
+        if isinstance(err, urllib2.HTTPError):
+            return err.code in self.retryable_statuses
+        if isinstance(err, (ShortReadError, CircuitOpenError)):
+            return True
+        if isinstance(err, ReplicationError):
+            return False
+        # socket.error is a subclass of IOError, so check it before the
+        # local disk errors below.
+        if isinstance(err, (socket.error, urllib2.URLError,
+                            httplib.HTTPException)):
+            return True
+        return False
+
+    def should_retry(self, err, attempt):
+        return attempt < self.attempts and self.is_retryable(err)
+
+    def delay(self, attempt):
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker(object):
+    """Object that stops requests to a host after failure_limit failures in
+    a row, until reset_after seconds have passed. Then one request is let
+    through to test the host again.
+    """
+    def __init__(self, host, failure_limit=CIRCUIT_FAILURE_LIMIT,
+                 reset_after=CIRCUIT_RESET_AFTER):
+        self.host = host
+        self.failure_limit = failure_limit
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if time.time() - self.opened >= self.reset_after:
+                # Half open: the next result decides.
+                self.opened = None
+                self.failures = self.failure_limit - 1
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_limit and self.opened is None:
+                self.opened = time.time()
+                TRANSFER_STATS.count("circuits_opened")
+                logger.debug("Circuit opened for %s" % self.host)
+
+
+class CircuitBreakers(object):
+    """Object that holds one CircuitBreaker per host.
+    """
+    def __init__(self):
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get(self, host):
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(host)
+            return self.breakers[host]
+
+
+class TransferStats(object):
+    """Object that counts transfer events for the run report.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
 
-    def stopQueueLoop(self):
-        # Stop the update timer.
-        if self.updateTimer is not None:
-            self.updateTimer.invalidate()
-            self.updateTimer = None
+    def report(self):
+        with self.lock:
+            return ", ".join(["%s: %d" % item
+                              for item in sorted(self.counters.items())])
 
-    def runAnyIncomingItems(self):
-        """Handle all the callables currently in the queue (if any)."""
-        while self.queue.qsize():
-            pool = NSAutoreleasePool.alloc().init()
+
+class RunMetrics(object):
+    """Object that keeps the per-file byte counts and stage durations of the
+    run for MetricsExporter. Adding to it is a dict update under a lock, so
+    the transfer loop can call it for every batch of bytes.
+    """
+    def __init__(self):
+        self.file_bytes = {}
+        self.stages = {}
+        self.last_bytes = None
+        self.lock = threading.Lock()
+
+    def add_bytes(self, path, count):
+        if count <= 0:
+            return
+        with self.lock:
+            self.file_bytes[path] = self.file_bytes.get(path, 0) + count
+            self.last_bytes = time.time()
+
+    def add_stage(self, name, seconds):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.file_bytes), dict(self.stages), self.last_bytes
+
+
+class MetricsExporter(object):
+    """Object that rewrites a Prometheus text format file with the state of
+    a run every METRICS_INTERVAL seconds, for the node_exporter textfile
+    collector or anything else that reads it. Each write goes to a temporary
+    file that is renamed over path, so readers never see half a file.
+    """
+    def __init__(self, path, script_thread, interval=METRICS_INTERVAL):
+        self.path = path
+        self.script_thread = script_thread
+        self.interval = interval
+        self.started = time.time()
+        self.stopped = threading.Event()
+        # The writer thread and stop share the temporary file.
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._writer)
+        self.thread.daemon = True
+
+    def start(self):
+        self.write()
+        self.thread.start()
+
+    def stop(self):
+        """Stops the updates and writes the final state of the run."""
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.write(finished=True)
+
+    def _writer(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def render(self, finished=False):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP %s%s %s" % (METRICS_PREFIX, name, help_text))
+            lines.append("# TYPE %s%s %s" % (METRICS_PREFIX, name, kind))
+            for labels, value in samples:
+                label_text = ",".join(['%s="%s"' % (
+                    key, label.replace("\\", "\\\\").replace('"', '\\"'))
+                    for key, label in labels])
+                lines.append("%s%s%s %r" % (
+                    METRICS_PREFIX, name,
+                    "{%s}" % label_text if label_text else "", float(value)))
+
+        file_bytes, stages, last_bytes = RUN_METRICS.snapshot()
+        snapshot = self.script_thread.progress.snapshot()
+        queue = self.script_thread.queue
+        with TRANSFER_STATS.lock:
+            counters = dict(TRANSFER_STATS.counters)
+        hits = counters.get("cache_hits", 0)
+        misses = counters.get("fallbacks", 0)
+        metric("run_started_timestamp_seconds", "gauge",
+               "When the run started.", [((), self.started)])
+        metric("run_finished", "gauge", "1 once the run has ended.",
+               [((), 1 if finished else 0)])
+        metric("progress_ratio", "gauge",
+               "Overall progress of the run from 0 to 1.",
+               [((("phase", snapshot["phase"] or "none"),),
+                 snapshot["overall"] / PROGRESS_BAR_MAX_VALUE)])
+        metric("throughput_bytes_per_second", "gauge",
+               "Smoothed download rate.", [((), float(snapshot["rate"]))])
+        metric("eta_seconds", "gauge",
+               "Estimated time left in the current phase, -1 if unknown.",
+               [((), float(-1 if snapshot["eta"] is None
+                           else snapshot["eta"]))])
+        metric("last_download_timestamp_seconds", "gauge",
+               "When bytes were last received, 0 if never.",
+               [((), last_bytes or 0.0)])
+        metric("downloaded_bytes_total", "counter",
+               "Bytes received this run per file.",
+               [((("path", path),), count)
+                for path, count in sorted(file_bytes.items())])
+        metric("gui_queue_depth", "gauge",
+               "Calls waiting for the progress window.",
+               [((), queue.qsize() if queue is not None else 0)])
+        metric("transfer_events_total", "counter",
+               "Transfer events such as retries, fallbacks and reuses.",
+               [((("event", name),), count)
+                for name, count in sorted(counters.items())])
+        # No sample until the caching server has been asked for something.
+        metric("caching_server_hit_ratio", "gauge",
+               "Share of caching server requests it served.",
+               [((), hits / float(hits + misses))] if hits + misses else [])
+        metric("stage_seconds", "gauge", "Time spent in each finished stage.",
+               [((("stage", name),), seconds)
+                for name, seconds in sorted(stages.items())])
+        return "\n".join(lines) + "\n"
+
+    def write(self, finished=False):
+        temp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        with self.lock:
             try:
-                new_method, new_args, new_kwargs = self.queue.get(0)
-                logger.debug(
-                    "Method: %s Args: %s Kwargs: %s" %
-                    (str(new_method), str(new_args), str(new_kwargs)))
-                new_method(*new_args, **new_kwargs)
-                self.queue.task_done()
-            except Queue.Empty:
-                pass
-            del pool
-
-    def haltOnError(self, message):
-        self.errorSheet.init()
-        self.errorSheet.setParent(self.window)
-        title = "macOS Install"
-        alert_type = NSCriticalAlertStyle
-        self.errorSheet.displayMessage(title, message, alert_type)
-        self.stopQueueLoop()
-
-    def _findIcon(self):
-        for icon in [CUSTOM_ICNS, SU_ICNS, APP_ICNS]:
-            if os.path.exists(icon):
-                logger.debug("Using Icon: " + icon)
-                return icon
-
-    def changeOverallText(self, text):
-        self.overall_text.setStringValue_(
-            NSString.stringWithString_(text))
-        self.overall_text.displayIfNeeded()
-
-    def changeStageText(self, text):
-        self.stage_text.setStringValue_(
-            NSString.stringWithString_(text))
-        self.stage_text.displayIfNeeded()
-
-    def changeOverallProgress(self, progress):
-        logger.debug(
-            "GUI Current Progress Overall: %f Incrementing by: %f" %
-            (self.overall_pbar.doubleValue(), progress))
-        self.overall_pbar.incrementBy_(progress)
-
-    def changeStageProgress(self, progress):
-        logger.debug(
-            "GUI Current Progress Stage: %f Incrementing by: %f" %
-            (self.stage_pbar.doubleValue(), progress))
-        self.stage_pbar.incrementBy_(progress)
-
-    def resetStageProgress(self):
-        self.stage_pbar.setDoubleValue_(0.0)
-
-    def showSpinner(self):
-        # Remove Stage-related Objects:
-        main_subviews = [
-            self.stage_pbar, self.stage_text, self.overall_pbar]
-        for view in main_subviews:
-            view.removeFromSuperview()
-        self.spinner.initWithFrame_(((200.0, 30.0), (80.0, 80.0)))
-        self.window.contentView().addSubview_(self.spinner)
-        self.spinner.startAnimation_(True)
-        self.spinner.displayIfNeeded()
-
-
-class AppDelegate(NSObject):
-    def init(self, *args, **kwargs):
-        self = objc.super(AppDelegate, self).init(*args, **kwargs)
-        self.progress_window = ProgressWindow.alloc().init()
-        return self
-
-    def applicationDidFinishLaunching_(self, aNotification):
-        self.progress_window.showProgressWindow()
-        self.progress_window.startQueueLoop()
-
-    def applicationShouldTerminateAfterLastWindowClosed_(self, aNotification):
-        return True
+                with open(temp_path, "w") as the_file:
+                    the_file.write(self.render(finished))
+                os.rename(temp_path, self.path)
+            except (OSError, IOError) as err:
+                logger.debug("Could not write metrics to %s: %s" %
+                             (self.path, err))
+
+
+def start_metrics_exporter(arguments, script_thread):
+    """Starts a MetricsExporter for --metrics-file, if given, that writes
+    the final state when the process exits."""
+    if not arguments.metrics_file:
+        return None
+    exporter = MetricsExporter(arguments.metrics_file, script_thread)
+    exporter.start()
+    atexit.register(exporter.stop)
+    return exporter
+
+
+class StreamDecoder(object):
+    """Object that decodes a gzip or deflate response body a chunk at a time.
+    Deflate should be zlib wrapped, but some servers send it raw, so raw is
+    tried when the zlib header is missing.
+    """
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.decompressor = zlib.decompressobj()
+        self.started = False
+
+    def decompress(self, chunk):
+        if self.encoding == "deflate" and not self.started:
+            self.started = True
+            try:
+                return self.decompressor.decompress(chunk)
+            except zlib.error:
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.decompressor.decompress(chunk)
+
+    def flush(self):
+        return self.decompressor.flush()
+
+
+def load_gui():
+    """Imports PyObjC and defines the GUI classes. Only the GUI needs
+    them, so the listing and headless modes start without loading
+    AppKit."""
+    global AppDelegate, AppHelper, NSApp, NSApplication, NSBundle
+    import objc
+    from Foundation import (
+        NSObject,
+        NSString,
+        NSTimer,
+    )
+
+    # put all AppKit imports used by the project here
+    from AppKit import (
+        NSAlert,
+        NSApp,
+        NSApplication,
+        NSAutoreleasePool,
+        NSBundle,
+        NSClosableWindowMask,
+        NSCriticalAlertStyle,
+        NSFont,
+        NSImage,
+        NSImageView,
+        NSInformationalAlertStyle,
+        NSMiniaturizableWindowMask,
+        NSProgressIndicator,
+        NSProgressIndicatorSpinningStyle,
+        NSResizableWindowMask,
+        NSScreenSaverWindowLevel,
+        NSTextField,
+        NSTitledWindowMask,
+        NSWindow,
+        NSWindowController
+    )
+
+    from PyObjCTools import AppHelper
+
+    class ErrorSheet(NSAlert):
+        sheet_parent = None
+
+        def init(self, *args, **kwargs):
+            # Call the super class (ErrorSheet)
+            self = objc.super(ErrorSheet, self).init(*args, **kwargs)
+            return self
+
+        def setParent(self, window):
+            self.sheet_parent = window
+
+        def displayMessage(self, title, message,
+                           type=NSInformationalAlertStyle):
+            def errorClose(returncode):
+                self.sheet_parent.close()
+
+            self.setMessageText_(title)
+            self.setInformativeText_(message)
+            self.setAlertStyle_(type)
+            self.addButtonWithTitle_(NSString.stringWithString_("Exit"))
+            self.beginSheetModalForWindow_completionHandler_(
+                self.sheet_parent, errorClose)
+
+        def destroy(self):
+            self = None
+
+    # This metadata is missing from PyObjC, so it has to be created here.
+    objc.registerMetaDataForSelector(
+        b"NSAlert", b"beginSheetModalForWindow:completionHandler:",
+        dict(arguments={3: {"callable": {"retval":
+                                         {"type": b"v"},
+                                         "arguments":
+                                         {0: {"type": b"^v"},
+                                          1: {"type": b"q"}}}}}))
+
+    class StatusText(NSTextField):
+        def initWithFrame_(self, *args, **kwargs):
+            # Call the super class (NSTextField)
+            self = objc.super(StatusText, self).initWithFrame_(*args, **kwargs)
+            self.setStringValue_(
+                NSString.stringWithString_(u"Progress Bar"))
+            self.setBezeled_(False)
+            self.setDrawsBackground_(False)
+            self.setSelectable_(False)
+            self.setFont_(NSFont.systemFontOfSize_(14))
+            return self
+
+    class ProgressSpinner(NSProgressIndicator):
+        def initWithFrame_(self, *args, **kwargs):
+            # Call the super class (NSProgressIndicator)
+            self = objc.super(ProgressSpinner,
+                              self).initWithFrame_(*args, **kwargs)
+            self.setStyle_(NSProgressIndicatorSpinningStyle)
+            self.setIndeterminate_(True)
+
+    class ProgressBar(NSProgressIndicator):
+        def initWithFrame_(self, *args, **kwargs):
+            # Call the super class (NSProgressIndicator)
+            self = objc.super(ProgressBar,
+                              self).initWithFrame_(*args, **kwargs)
+            self.setIndeterminate_(False)
+            self.setMinValue_(0.0)
+            self.setMaxValue_(PROGRESS_BAR_MAX_VALUE)
+            return self
+
+    class ProgressWindow(NSWindowController):
+        # Class Attributes
+        window = NSWindow.alloc()
+        window_icon = NSImageView.alloc()
+        window_icon_file = NSImage.alloc()
+        updateTimer = None
+        overall_pbar = ProgressBar.alloc()
+        stage_pbar = ProgressBar.alloc()
+        spinner = ProgressSpinner.alloc()
+        errorSheet = ErrorSheet.alloc()
+        overall_text = StatusText.alloc()
+        stage_text = StatusText.alloc()
+        version_text = StatusText.alloc()
+        versionText = NSString.stringWithString_(u"Progress Window")
+        # This style mask prevents the window from being resized or minimized.
+        style_mask = (
+            NSTitledWindowMask | NSClosableWindowMask &
+            ~NSResizableWindowMask & ~NSMiniaturizableWindowMask)
+
+        def init(self, *args, **kwargs):
+            self = objc.super(ProgressWindow, self).init(*args, **kwargs)
+            self.queue = Queue.Queue()
+            return self
+
+        def showProgressWindow(self):
+            logger.debug("Configuring main window.")
+            frame = ((0.0, 0.0), (480.0, 240.0))
+            self.window.initWithContentRect_styleMask_backing_defer_(
+                frame, ProgressWindow.style_mask, 2, 0)
+            self.window.setCanBecomeVisibleWithoutLogin_(True)
+            self.window.setLevel_(NSScreenSaverWindowLevel - 1)
+            self.window.center()
+            self.window.setTitle_("Downloading macOS")
+
+            # Use a pretty icon to make the window look more composed.
+            self.window_icon_file.initByReferencingFile_(self._findIcon())
+
+            logger.debug(
+                "Finished setting up main window. Defining subelements.")
+            # Layout. Each frame element is a rectangle defined as:
+            # ((x offset from origin, y offset from origin), (width, height))
+            # where origin is the top left corner of the window.
+            self.window_icon.initWithFrame_(((10.0, 165.0), (60.0, 60.0)))
+            self.overall_pbar.initWithFrame_(((10.0, 95.0), (460.0, 20.0)))
+            self.overall_text.initWithFrame_(((10.0, 115.0), (460.0, 40.0)))
+            self.stage_pbar.initWithFrame_(((10.0, 15.0), (460.0, 20.0)))
+            self.stage_text.initWithFrame_(((10.0, 35.0), (460.0, 40.0)))
+
+            logger.debug("Adding subelements to main window.")
+            self.window_icon.setImage_(self.window_icon_file)
+            self.window.contentView().addSubview_(self.window_icon)
+            self.window.contentView().addSubview_(self.overall_pbar)
+            self.window.contentView().addSubview_(self.overall_text)
+            self.window.contentView().addSubview_(self.stage_pbar)
+            self.window.contentView().addSubview_(self.stage_text)
+
+            logger.debug("Done setting up window. Now displaying.")
+            self.window.display()
+            self.window.orderFrontRegardless()
+
+        def showVersionInfo(self, text):
+            self.version_text.initWithFrame_(((80.0, 165.0), (460.0, 40.0)))
+            self.version_text.setFont_(NSFont.systemFontOfSize_(18))
+            self.window.contentView().addSubview_(self.version_text)
+            self.version_text.setStringValue_(
+                NSString.stringWithString_(text))
+            self.version_text.displayIfNeeded()
+
+        def startQueueLoop(self):
+            # Display and continuously update elements of the main window.
+            self.stopQueueLoop()
+            # Run the incoming items once.
+            self.runAnyIncomingItems()
+            # Kick off a timer that checks the queue periodically.
+            self.updateTimer = NSTimer.scheduledTimerWithTimeInterval_target_selector_userInfo_repeats_(
+                0.1,
+                self,
+                u"runAnyIncomingItems",
+                None,
+                True
+            )
+
+        def stopQueueLoop(self):
+            # Stop the update timer.
+            if self.updateTimer is not None:
+                self.updateTimer.invalidate()
+                self.updateTimer = None
+
+        def runAnyIncomingItems(self):
+            """Handle all the callables currently in the queue (if any)."""
+            while self.queue.qsize():
+                pool = NSAutoreleasePool.alloc().init()
+                try:
+                    new_method, new_args, new_kwargs = self.queue.get(0)
+                    logger.debug(
+                        "Method: %s Args: %s Kwargs: %s" %
+                        (str(new_method), str(new_args), str(new_kwargs)))
+                    new_method(*new_args, **new_kwargs)
+                    self.queue.task_done()
+                except Queue.Empty:
+                    pass
+                del pool
+
+        def haltOnError(self, message):
+            self.errorSheet.init()
+            self.errorSheet.setParent(self.window)
+            title = "macOS Install"
+            alert_type = NSCriticalAlertStyle
+            self.errorSheet.displayMessage(title, message, alert_type)
+            self.stopQueueLoop()
+
+        def _findIcon(self):
+            for icon in [CUSTOM_ICNS, SU_ICNS, APP_ICNS]:
+                if os.path.exists(icon):
+                    logger.debug("Using Icon: " + icon)
+                    return icon
+
+        def changeOverallText(self, text):
+            self.overall_text.setStringValue_(
+                NSString.stringWithString_(text))
+            self.overall_text.displayIfNeeded()
+
+        def changeStageText(self, text):
+            self.stage_text.setStringValue_(
+                NSString.stringWithString_(text))
+            self.stage_text.displayIfNeeded()
+
+        def setOverallProgress(self, progress):
+            self.overall_pbar.setDoubleValue_(progress)
+
+        def setStageProgress(self, progress):
+            self.stage_pbar.setDoubleValue_(progress)
+
+        def showSpinner(self):
+            # Remove Stage-related Objects:
+            main_subviews = [
+                self.stage_pbar, self.stage_text, self.overall_pbar]
+            for view in main_subviews:
+                view.removeFromSuperview()
+            self.spinner.initWithFrame_(((200.0, 30.0), (80.0, 80.0)))
+            self.window.contentView().addSubview_(self.spinner)
+            self.spinner.startAnimation_(True)
+            self.spinner.displayIfNeeded()
+
+    class AppDelegate(NSObject):
+        def init(self, *args, **kwargs):
+            self = objc.super(AppDelegate, self).init(*args, **kwargs)
+            self.progress_window = ProgressWindow.alloc().init()
+            return self
+
+        def applicationDidFinishLaunching_(self, aNotification):
+            self.progress_window.showProgressWindow()
+            self.progress_window.startQueueLoop()
+
+        def applicationShouldTerminateAfterLastWindowClosed_(self,
+                                                             aNotification):
+            return True
 
 
 class ScriptThread(object):
@@ -452,6 +959,20 @@ class ScriptThread(object):
         self.arguments = arguments
         self.queue = None
         self.gui = gui
+        # Set when the script ends, so in-flight transfers stop.
+        self.cancel_event = threading.Event()
+        # Self-pipe written by the signal handler to wake wait_for_the_end.
+        # Writing to a pipe is safe inside a signal handler, unlike taking
+        # the lock behind a threading.Event.
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        # Every transfer reports its bytes here. Its snapshots drive both the
+        # progress bars and the estimated finish time in the log.
+        self.progress = ProgressModel(self.show_progress)
+        self.last_progress_report = time.time()
+        # Set by start_progress_stream to mirror the GUI calls as events.
+        self.progress_stream = None
+        self.last_streamed = 0.0
+        self.streamed_phase = None
 
         # Set up the GUI part if necessary.
         if gui:
@@ -472,9 +993,15 @@ class ScriptThread(object):
     def enqueue(self, method, *args, **kwargs):
         self.queue.put((method, args, kwargs))
 
+    def stream(self, event):
+        if self.progress_stream:
+            event["time"] = round(time.time(), 3)
+            self.progress_stream.send(event)
+
     def script_error(self, message):
         if self.gui:
             self.enqueue(self.gui.haltOnError, message)
+        self.stream({"event": "error", "message": message})
 
     def version_text(self, text):
         if self.gui:
@@ -483,23 +1010,35 @@ class ScriptThread(object):
     def overall_text(self, text):
         if self.gui:
             self.enqueue(self.gui.changeOverallText, text)
+        self.stream({"event": "status", "kind": "overall", "message": text})
 
     def stage_text(self, text):
         if self.gui:
             self.enqueue(self.gui.changeStageText, text)
+        self.stream({"event": "status", "kind": "stage", "message": text})
 
-    def overall_progress(self, progress):
+    def show_progress(self, snapshot):
+        """Sends a ProgressModel snapshot to the progress bars, and logs the
+        estimated finish time now and then while downloading."""
         if self.gui:
-            self.enqueue(self.gui.changeOverallProgress, progress)
-
-    def stage_progress(self, progress):
-        if self.gui:
-            self.enqueue(self.gui.changeStageProgress, progress)
-
-    def reset_stage_progress(self):
-        logger.debug("Resetting the Stage Progress Bar!")
-        if self.gui:
-            self.enqueue(self.gui.resetStageProgress)
+            self.enqueue(self.gui.setOverallProgress, snapshot["overall"])
+            self.enqueue(self.gui.setStageProgress, snapshot["stage"])
+        now = time.time()
+        if self.progress_stream and (
+                snapshot["phase"] != self.streamed_phase or
+                snapshot["stage"] >= PROGRESS_BAR_MAX_VALUE or
+                now - self.last_streamed >= PROGRESS_STREAM_INTERVAL):
+            self.last_streamed = now
+            self.streamed_phase = snapshot["phase"]
+            self.stream(progress_event(snapshot))
+        if (snapshot["phase"] != "downloads" or snapshot["eta"] is None or
+                now - self.last_progress_report < PROGRESS_REPORT_INTERVAL):
+            return
+        self.last_progress_report = now
+        logger.log(OLVL, "Downloaded %s of %s at %s/s, %s remaining." % (
+            convert_size(snapshot["done"]), convert_size(snapshot["expected"]),
+            convert_size(snapshot["rate"]),
+            convert_duration(snapshot["eta"])))
 
     def show_spinner(self):
         logger.debug("Switching to Indeterminate Progress Indicator.")
@@ -507,24 +1046,30 @@ class ScriptThread(object):
             self.enqueue(self.gui.showSpinner)
 
     def wait_for_the_end(self):
-        time_slept = 0
         logger.debug("Waiting for signal...")
         while self.running:
-            time.sleep(1)
-            logger.debug("Still waiting...")
-            time_slept += 1
+            try:
+                select.select([self.wakeup_read], [], [])
+            except select.error as err:
+                if err.args[0] != errno.EINTR:
+                    raise
+        # The handler cannot log, as that takes the logging locks, so the
+        # signals it wrote to the pipe are logged here.
+        if select.select([self.wakeup_read], [], [], 0)[0]:
+            for signal_number in bytearray(os.read(self.wakeup_read, 64)):
+                logger.debug("Got signal! %d" % signal_number)
         self.end_application()
 
     def receive_signal(self, signal_number, stack_frame):
-        logger.debug("Got signal! %s Frame: %s" %
-                     (str(signal_number), str(stack_frame)))
         self.running = False
+        os.write(self.wakeup_write, chr(signal_number))
 
     def end_application(self):
         logger.debug("Ending Application.")
         if self.gui:
             self.enqueue(self.gui.stopQueueLoop)
         self.running = False
+        self.cancel_event.set()
         if self.gui:
             self.gui.window.performClose_(True)
         sys.exit(0)
@@ -537,73 +1082,171 @@ class MakeInstaller(object):
     def __init__(self, arguments, script_thread=None):
         self.script_thread = script_thread
         self.arguments = arguments
+        self.transfer_engine = make_transfer_engine(arguments, script_thread)
         self.this_mac = MacInfo()
         self.software_catalog = SoftwareCatalog(self)
         self.target_version = None
+        self.timings = StageTimings(
+            profile_dir=LOG_PARENT_DIR if arguments.profile else None)
+        # (url, reason) for packages that failed verification while staging.
+        self.staging_failures = []
+
+    def select_product(self, product_key):
+        """Makes product_key the product that is installed and checked."""
+        self.target_version = product_key
+        self.product = self.software_catalog.product_info[product_key]
 
     def replicate_product(self):
-        """Downloads all the packages for a product"""
-        self.script_thread.reset_stage_progress()
-        self.product = (
-            self.software_catalog.catalog["Products"][self.target_version])
-        # We will need total_size to calculate our progress.
-        total_size = float(sum(
-            [size.get("Size", "0") for size in self.product.get("Packages")
-             if "URL" in size]))
-        for package in self.product.get("Packages", []):
-            self.script_thread.reset_stage_progress()
-            package_size = float(package.get("Size"))
-            relative_weight = ((package_size / total_size) * PRODUCT_WEIGHT)
-            logger.debug("Package Size: %f Total Size: %f Weight: %f" %
-                         (package_size, total_size, relative_weight))
-            if "URL" in package:
-                try:
-                    replicate_url(
-                        self.script_thread, package["URL"], relative_weight, 
-                        caching_server=self.arguments.caching_server,
-                        root_dir=self.arguments.workdir)
-                except ReplicationError as err:
-                    logger.log(FAIL, "Could not replicate %s: %s" %
-                               (package["URL"], err))
-            if "MetadataURL" in package:
+        """Downloads all the packages for the target product, in the order
+        the installer needs them, verifying each one as soon as it lands"""
+        self.select_product(self.target_version)
+        self.replicate_products([self.target_version])
+
+    def replicate_products(self, product_keys):
+        """Downloads the packages of several products through one scheduler.
+        A package shared by several products is downloaded once, and each
+        product is reported as soon as all of its packages are in."""
+        products = [self.software_catalog.product_info[product_key]
+                    for product_key in product_keys]
+        scheduler = DownloadScheduler(self.transfer_engine.workers)
+        packages = scheduler.order_products(products)
+        # The package sizes are known up front. The metadata files are not,
+        # and are added to the total as their downloads start.
+        self.script_thread.progress.expect("downloads", sum(
+            [package.get("Size", 0) for package in packages
+             if "URL" in package]))
+        completion = TargetCompletion(product_keys, products)
+        staging = StagingPipeline()
+        # (url, reason) for the files that could not be downloaded.
+        download_failures = []
+
+        def replicate_package(package):
+            failed = []
+            for key in ("URL", "MetadataURL"):
+                if key not in package:
+                    continue
                 try:
                     replicate_url(
-                        self.script_thread, package["MetadataURL"],
-                        relative_weight,
+                        self.script_thread, package[key], "downloads",
                         caching_server=self.arguments.caching_server,
-                        root_dir=self.arguments.workdir)
+                        root_dir=self.arguments.workdir,
+                        expected_size=(package.get("Size")
+                                       if key == "URL" else None),
+                        # A metadata file has no size in the catalog to
+                        # check a local copy against.
+                        max_age=(self.arguments.cache_max_age
+                                 if key == "MetadataURL" else None),
+                        **self.transfer_engine.options())
                 except ReplicationError as err:
                     logger.log(FAIL, "Could not replicate %s: %s" %
-                               (package["MetadataURL"], err))
+                               (package[key], err))
+                    download_failures.append((package[key], str(err)))
+                    failed.append(key)
+            if "URL" in package and "URL" not in failed:
+                staging.submit(package, local_path_for_url(
+                    package["URL"], self.arguments.workdir))
+            if not failed:
+                completion.package_done(package)
+
+        self.transfer_engine.map(
+            replicate_package, packages,
+            url_of=lambda package: package.get("URL", ""))
+        with self.timings.stage("staging wait"):
+            self.staging_failures = staging.finish() + download_failures
+        self.script_thread.progress.finish_phase("downloads")
 
     def install_product(self):
-        """Verify the installation of the product."""
-        if not self._install_product():
-            logger.log(OLVL, "Product installation failed. Redownloading.")
-            self.replicate_product()
-        if not self._install_product():
-            logger.log(FAIL, "Unable to create installer!")
+        """Verify the installation of the product. When the installer fails,
+        only the artifacts that look damaged are downloaded again."""
+        product_urls = set([package.get("URL")
+                            for package in self.product.packages])
+        failures = [failure for failure in self.staging_failures
+                    if failure[0] in product_urls]
+        if failures:
+            logger.log(OLVL, "Redownloading %d damaged files." %
+                       len(failures))
+            self.refetch_artifacts(failures)
+        delay = RECOVERY_BACKOFF
+        for attempt in range(RECOVERY_ATTEMPTS + 1):
+            success, output = self._install_product()
+            if success:
+                break
+            if attempt == RECOVERY_ATTEMPTS:
+                logger.log(FAIL, "Unable to create installer!")
+                break
+            suspects = self.find_suspect_artifacts(output)
+            if suspects:
+                logger.log(OLVL, "Product installation failed. "
+                           "Redownloading %d damaged files." % len(suspects))
+            else:
+                logger.log(OLVL, "Product installation failed. Redownloading.")
+            logger.debug("Retrying in %d seconds." % delay)
+            time.sleep(delay)
+            delay *= 2
+            if suspects:
+                self.refetch_artifacts(suspects)
+            else:
+                self.replicate_product()
         self.os_install = glob.glob("/Applications/Install macOS *.app" +
                                     "/Contents/Resources/startosinstall")[0]
 
     def _install_product(self):
-        """Install the product to the Applications folder."""
+        """Install the product to the Applications folder. Returns whether
+        the installer succeeded and its combined output."""
         dist_path = (self.software_catalog.product_info[
-                     self.target_version]["DistributionPath"])
-        cmd = ["/usr/sbin/installer", "-pkg", dist_path, "-target", "/"]
-        try:
-            subprocess.check_call(cmd)
-            return True
-        except subprocess.CalledProcessError as err:
-            logger.error(str(err))
-            return False
+                     self.target_version].distribution_path)
+        cmd = [INSTALLER_CMD, "-pkg", dist_path, "-target", "/"]
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        logger.debug("installer output: " + output)
+        if process.returncode:
+            logger.error("Command '%s' returned non-zero exit status %d" %
+                         (" ".join(cmd), process.returncode))
+            return False, output
+        return True, output
+
+    def find_suspect_artifacts(self, installer_output=""):
+        """Returns a list of (url, reason) for the product's files that are
+        missing, do not match the catalog, or are named by the installer."""
+        suspects = []
+        for package in self.product.packages:
+            for key in ("URL", "MetadataURL"):
+                if key not in package:
+                    continue
+                url = package[key]
+                local_path = local_path_for_url(url, self.arguments.workdir)
+                if key == "URL":
+                    reason = verify_package(package, local_path)
+                elif not os.path.exists(local_path):
+                    reason = "missing"
+                else:
+                    reason = None
+                if (not reason and installer_output and
+                        os.path.basename(local_path) in installer_output):
+                    reason = "named by installer"
+                if reason:
+                    logger.debug("Suspect artifact %s: %s" % (url, reason))
+                    suspects.append((url, reason))
+        return suspects
+
+    def refetch_artifacts(self, suspects):
+        """Downloads the given (url, reason) artifacts again."""
+        for url, _ in suspects:
+            try:
+                replicate_url(
+                    self.script_thread, url, None,
+                    caching_server=self.arguments.caching_server,
+                    root_dir=self.arguments.workdir,
+                    **self.transfer_engine.options())
+            except ReplicationError as err:
+                logger.log(FAIL, "Could not replicate %s: %s" % (url, err))
 
     def launch_osinstall(self):
         ## subprocess.Popen is used here without its .communicate() method.
         ## This is intentional. This immediately releases the file descriptor
         ## to the underlying process, allowing this script to exit before
         ## startosinstall is complete.
-        self.script_thread.overall_progress(PROGRESS_BAR_MAX_VALUE)
         this_pid = os.getpid()
         logger.debug("This PID: " + str(this_pid))
         # Request that startosinstall signals this script when it is complete.
@@ -616,7 +1259,8 @@ class MakeInstaller(object):
         else:
             logger.log(OLVL, "Starting In-Place Installation!")
 
-        time.sleep(15)
+        if self.arguments.launch_delay > 0:
+            time.sleep(self.arguments.launch_delay)
         logger.debug("startosinstall will run with the following options: %s" %
                      " ".join(os_install_cmd))
         # Start Popen without .communicate() so the fd is decoupled
@@ -624,6 +1268,487 @@ class MakeInstaller(object):
         subprocess.Popen(os_install_cmd)
 
 
+class StageTimings(object):
+    """Object that records how long each named stage of a run takes. With a
+    profile_dir, each outermost stage is also run under cProfile, and a
+    pstats file and a top allocations report are written there.
+
+    cProfile only sees the thread that runs the stage, so pooled transfers
+    show up as time spent waiting in TransferEngine.map.
+    """
+    def __init__(self, profile_dir=None):
+        self.stages = []
+        self.profile_dir = profile_dir
+        self.depth = 0
+        self.run_stamp = time.strftime("%Y%m%d-%H%M%S")
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        profiling = self.profile_dir and not self.depth
+        if profiling:
+            profile = StageProfile(name)
+        self.depth += 1
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.time() - started))
+            RUN_METRICS.add_stage(name, time.time() - started)
+            self.depth -= 1
+            if profiling:
+                profile.finish(os.path.join(
+                    self.profile_dir, "%s.%s.%s" % (
+                        LONG_R_DOMAIN, self.run_stamp,
+                        name.replace(" ", "_"))))
+
+    def report(self):
+        return ", ".join(["%s: %.2fs" % (name, seconds)
+                          for name, seconds in self.stages])
+
+
+class StageProfile(object):
+    """Object that profiles one stage with cProfile and takes memory
+    snapshots around it. tracemalloc is used where the interpreter has it;
+    otherwise the growth in live objects per type is reported.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.profile = cProfile.Profile()
+        if tracemalloc:
+            tracemalloc.start()
+            self.before = tracemalloc.take_snapshot()
+        else:
+            self.before = count_objects_by_type()
+        self.profile.enable()
+
+    def finish(self, path_prefix):
+        self.profile.disable()
+        self.profile.dump_stats(path_prefix + ".pstats")
+        lines = ["Stage: %s" % self.name,
+                 "Peak RSS: %s" % convert_size(peak_rss())]
+        if tracemalloc:
+            after = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            for stat in after.compare_to(self.before, "lineno")[
+                    :PROFILE_TOP_N]:
+                lines.append(str(stat))
+        else:
+            after = count_objects_by_type()
+            growth = sorted(
+                [(after[kind] - self.before.get(kind, 0), kind)
+                 for kind in after], reverse=True)[:PROFILE_TOP_N]
+            lines.extend(["%+d %s" % (count, kind)
+                          for count, kind in growth])
+        with open(path_prefix + ".allocations.txt", "w") as the_file:
+            the_file.write("\n".join(lines) + "\n")
+        logger.info("Profile for %s written to %s.pstats" %
+                    (self.name, path_prefix))
+
+
+class StagingPipeline(object):
+    """Object that verifies each package on a background thread as soon as
+    its download finishes, so verification overlaps the remaining downloads
+    instead of delaying the installer.
+    """
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.failures = []
+        self.verify_time = 0.0
+        self.thread = threading.Thread(target=self._worker,
+                                       name=worker_thread_name("staging"))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, package, local_path):
+        self.queue.put((package, local_path))
+
+    def finish(self):
+        """Waits for every submitted package to be verified. Returns a list
+        of (url, reason) for the ones that failed."""
+        self.queue.put(None)
+        self.thread.join()
+        logger.debug("Package verification took %.2fs" % self.verify_time)
+        return self.failures
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            package, local_path = item
+            started = time.time()
+            reason = verify_package(package, local_path)
+            if not reason:
+                reason = check_package_signature(local_path)
+            self.verify_time += time.time() - started
+            if reason:
+                logger.debug("Staged package %s failed: %s" %
+                             (local_path, reason))
+                self.failures.append((package["URL"], reason))
+
+
+class DownloadScheduler(object):
+    """Object that decides the order packages are downloaded in.
+
+    Packages are started in the order the installer needs them. With several
+    workers, packages the dist file ranks the same are started largest
+    first, so the big ones overlap each other and the small ones fill the
+    gaps at the end.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+
+    def order(self, packages, package_order):
+        return order_packages(packages, package_order,
+                              largest_first=self.workers > 1)
+
+    def order_products(self, products):
+        """Returns the packages of every product, each package once, with
+        the products taken in turn."""
+        packages = []
+        seen = set()
+        for product in products:
+            for package in self.order(list(product.packages),
+                                      product.package_order):
+                if package_id(package) in seen:
+                    continue
+                seen.add(package_id(package))
+                packages.append(package)
+        return packages
+
+
+class TargetCompletion(object):
+    """Object that logs each target product as soon as the last of its
+    packages is done, when several products are downloaded together.
+    """
+    def __init__(self, product_keys, products):
+        self.pending = dict([
+            (product_key, set([package_id(package)
+                               for package in product.packages]))
+            for product_key, product in zip(product_keys, products)])
+        self.names = dict([
+            (product_key, "%s %s" % (product.title, product.version))
+            for product_key, product in zip(product_keys, products)])
+        self.total = len(product_keys)
+        self.completed = []
+        self.lock = threading.Lock()
+
+    def package_done(self, package):
+        with self.lock:
+            for product_key, pending in self.pending.items():
+                if package_id(package) not in pending:
+                    continue
+                pending.discard(package_id(package))
+                if pending or self.total == 1:
+                    continue
+                self.completed.append(product_key)
+                logger.log(OLVL, "Downloads complete for %s (%d of %d)." % (
+                    self.names[product_key], len(self.completed),
+                    self.total))
+
+
+class ProgressModel(object):
+    """Object that tracks the progress of the whole run from the bytes each
+    phase in PROGRESS_PHASES is expected to move and has moved, with an
+    exponentially weighted throughput for the estimated time left. It calls
+    publish with a snapshot at most every PROGRESS_PUBLISH_INTERVAL seconds.
+    """
+    def __init__(self, publish=None):
+        self.publish = publish
+        self.lock = threading.Lock()
+        self.shares = dict(PROGRESS_PHASES)
+        self.expected = dict.fromkeys(self.shares, 0.0)
+        self.done = dict.fromkeys(self.shares, 0.0)
+        self.finished = set()
+        self.phase = None
+        self.rate = None
+        self.transferred = 0.0
+        self.sampled = 0.0
+        self.sample_time = time.time()
+        self.last_publish = 0.0
+        # The bars never move backwards, even when a new file adds to the
+        # bytes expected.
+        self.overall = 0.0
+        self.stage = 0.0
+
+    def expect(self, phase, count):
+        with self.lock:
+            self.expected[phase] += count
+
+    def add_bytes(self, phase, count):
+        with self.lock:
+            self.done[phase] += count
+            # Progress taken back after a failed attempt still moved bytes.
+            if count > 0:
+                self.transferred += count
+            now = time.time()
+            if now - self.last_publish < PROGRESS_PUBLISH_INTERVAL:
+                return
+            self.last_publish = now
+            self.sample(now)
+            snapshot = self.take_snapshot(phase)
+        if self.publish:
+            self.publish(snapshot)
+
+    def finish_phase(self, phase):
+        with self.lock:
+            self.finished.add(phase)
+            snapshot = self.take_snapshot(phase)
+        if self.publish:
+            self.publish(snapshot)
+
+    def sample(self, now):
+        """Folds the bytes since the last sample into the throughput."""
+        elapsed = now - self.sample_time
+        if elapsed < PROGRESS_SAMPLE_INTERVAL:
+            return
+        rate = (self.transferred - self.sampled) / elapsed
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate += PROGRESS_SMOOTHING * (rate - self.rate)
+        self.sampled = self.transferred
+        self.sample_time = now
+
+    def fraction(self, phase):
+        if phase in self.finished:
+            return 1.0
+        if self.expected[phase] <= 0:
+            return 0.0
+        return min(1.0, self.done[phase] / self.expected[phase])
+
+    def eta(self, phase):
+        if not self.rate or self.rate < 1:
+            return None
+        return max(0.0, self.expected[phase] - self.done[phase]) / self.rate
+
+    def take_snapshot(self, phase):
+        if phase != self.phase:
+            self.phase = phase
+            self.stage = 0.0
+        overall = sum([share * self.fraction(name)
+                       for name, share in self.shares.items()])
+        self.overall = max(self.overall, overall / 100.0 *
+                           PROGRESS_BAR_MAX_VALUE)
+        self.stage = max(self.stage, self.fraction(phase) *
+                         PROGRESS_BAR_MAX_VALUE)
+        return {"phase": phase, "overall": self.overall,
+                "stage": self.stage, "rate": self.rate or 0.0,
+                "eta": self.eta(phase), "done": self.done[phase],
+                "expected": self.expected[phase]}
+
+    def snapshot(self):
+        with self.lock:
+            # Before any bytes arrive, report the first phase.
+            return self.take_snapshot(self.phase or PROGRESS_PHASES[0][0])
+
+
+class TransferThrottle(object):
+    """Object that limits transfers to rate bytes per second with a token
+    bucket, shared by every transfer that uses it, and holds them while the
+    time of day is outside all of the given (start, end) windows.
+    """
+    def __init__(self, rate=0, windows=None, cancelled=None):
+        self.rate = float(rate)
+        # Allow one second of traffic as a burst.
+        self.capacity = self.rate
+        self.tokens = self.capacity
+        self.windows = windows or []
+        self.cancelled = cancelled or threading.Event()
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, count):
+        self.wait_for_window()
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= count
+            # Tokens go negative for a large chunk. The wait pays it back.
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            self.cancelled.wait(delay)
+
+    def in_window(self):
+        if not self.windows:
+            return True
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end in self.windows:
+            if start <= end and start <= minute < end:
+                return True
+            # The window crosses midnight.
+            if start > end and (minute >= start or minute < end):
+                return True
+        return False
+
+    def wait_for_window(self):
+        if self.in_window():
+            return
+        logger.log(OLVL, "Outside the prefetch window. Pausing downloads.")
+        while not self.in_window() and not self.cancelled.is_set():
+            self.cancelled.wait(PREFETCH_WINDOW_CHECK)
+        logger.log(OLVL, "Resuming downloads.")
+
+
+class TransferEngine(object):
+    """Object that runs transfers on a bounded pool of worker threads, with
+    no more than max_per_host transfers in flight to any one host. With no
+    workers, transfers run one at a time on the calling thread.
+    """
+    def __init__(self, workers=0, max_per_host=TRANSFER_PER_HOST,
+                 timeout=None, cancelled=None, throttle=None):
+        self.workers = workers
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.cancelled = cancelled or threading.Event()
+        self.throttle = throttle
+        self.host_semaphores = {}
+        self.lock = threading.Lock()
+
+    def options(self):
+        """Returns the keyword arguments replicate_url needs to honour this
+        engine's timeout, cancellation and throttle."""
+        return {"timeout": self.timeout, "cancel_event": self.cancelled,
+                "throttle": self.throttle}
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def map(self, function, items, url_of=str):
+        """Calls function on every item and returns the results in the
+        order of items. Items are started in order. url_of returns the URL
+        an item will fetch, which decides the host it counts against.
+
+        As on the calling thread, an exception from function is raised once
+        the workers have stopped, and no further items are started. Items
+        never started because of a cancel are left as None."""
+        if not self.workers:
+            return [function(item) for item in items]
+        results = [None] * len(items)
+        failures = []
+        pending = Queue.Queue()
+        for index, item in enumerate(items):
+            pending.put((index, item))
+
+        def worker():
+            while not self.cancelled.is_set() and not failures:
+                try:
+                    index, item = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                with self._host_semaphore(url_of(item)):
+                    try:
+                        results[index] = function(item)
+                    except Exception:
+                        logger.debug("Transfer of %s failed." % item)
+                        failures.append(sys.exc_info())
+
+        threads = [threading.Thread(target=worker,
+                                    name=worker_thread_name("transfer"))
+                   for _ in range(min(self.workers, len(items)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if failures:
+            raise failures[0][0], failures[0][1], failures[0][2]
+        return results
+
+    def _host_semaphore(self, url):
+        host = urlparse.urlsplit(url)[1]
+        with self.lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(
+                    self.max_per_host)
+            return self.host_semaphores[host]
+
+
+class TransferPipeline(object):
+    """Object that hands downloaded bytes to a disk writer thread through a
+    bounded ring of reusable buffers. The reader blocks when every buffer is
+    waiting to be written, which is the backpressure on the socket.
+
+    read_stall is the time the network side waited for a free buffer
+    (disk-bound) and write_stall the time the disk side waited for data
+    (network-bound).
+    """
+    def __init__(self, the_file, buffer_count=TRANSFER_BUFFERS,
+                 buffer_size=TRANSFER_BUFFER_SIZE):
+        self.the_file = the_file
+        self.free = Queue.Queue()
+        for _ in range(buffer_count):
+            self.free.put(bytearray(buffer_size))
+        self.full = Queue.Queue()
+        self.buffer = None
+        self.filled = 0
+        self.read_stall = 0.0
+        self.write_stall = 0.0
+        self.error = None
+        self.thread = threading.Thread(target=self._writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, data):
+        if self.error:
+            raise ReplicationError(self.error)
+        view = memoryview(data)
+        offset = 0
+        while offset < len(data):
+            if self.buffer is None:
+                started = time.time()
+                self.buffer = self.free.get()
+                self.read_stall += time.time() - started
+                self.filled = 0
+            count = min(len(self.buffer) - self.filled, len(data) - offset)
+            self.buffer[self.filled:self.filled + count] = (
+                view[offset:offset + count])
+            self.filled += count
+            offset += count
+            if self.filled == len(self.buffer):
+                self._hand_off()
+
+    def close(self):
+        """Writes out the remaining data and waits for the writer thread."""
+        self.abort()
+        if self.error:
+            raise ReplicationError(self.error)
+
+    def abort(self):
+        """Stops the writer thread without raising, for a download that
+        failed. The data read so far is still written, so the partial file
+        can be resumed."""
+        if self.buffer is not None and self.filled:
+            self._hand_off()
+        self.full.put(None)
+        self.thread.join()
+
+    def _hand_off(self):
+        self.full.put((self.buffer, self.filled))
+        self.buffer = None
+
+    def _writer(self):
+        while True:
+            started = time.time()
+            item = self.full.get()
+            self.write_stall += time.time() - started
+            if item is None:
+                break
+            buf, filled = item
+            # After an error keep draining, so the reader never blocks.
+            if not self.error:
+                try:
+                    self.the_file.write(memoryview(buf)[:filled])
+                except (OSError, IOError) as err:
+                    self.error = err
+            self.free.put(buf)
+
+
 class SoftwareCatalog(object):
     """Object that encapsulates the definition of the software catalog
     """
@@ -633,59 +1758,126 @@ class SoftwareCatalog(object):
         self.script_thread = self.parent.script_thread
         self.arguments = self.parent.arguments
         self.workdir = self.arguments.workdir
+        self.transfer_engine = self.parent.transfer_engine
         # Prepping instance variables.
         self.os_installers = []
+        # InstallerProduct records by product key.
         self.product_info = {}
+        # Installers this Mac cannot run, kept for listing.
+        self.incompatible_info = {}
+        # Only set when running incrementally against the last snapshot.
+        self.snapshot = None
 
     def start_parsing(self):
-        self.script_thread.reset_stage_progress()
+        with self.parent.timings.stage("catalog parse"):
+            if self.parse_catalogs():
+                return
+        with self.parent.timings.stage("product info"):
+            self.os_installer_product_info()
+        logger.debug("product_info: " + str(self.product_info))
+
+    def parse_catalogs(self):
+        """Downloads and parses the catalogs. Returns True if the product
+        info was restored from the snapshot instead."""
         self.get_catalog_url()
         logger.debug("su_catalog_url: " + self.su_catalog_url)
+        if (self.arguments.incremental or self.arguments.list_changes or
+                self.arguments.list_installers):
+            self.snapshot = InstallerSnapshot(self.su_catalog_url)
         self.download_sucatalog()
-        logger.debug("local_path: " + self.local_path)
-        self.parse_sucatalog()
-        logger.debug("catalog: " + str(self.catalog))
-        self.find_mac_os_installers()
+        logger.debug("local_paths: " + str(self.local_paths))
+        catalog_hash = ",".join(
+            [file_digest(path) for _, path in self.local_paths])
+        if self.snapshot:
+            if (self.arguments.list_installers and
+                    self.restore_snapshot(catalog_hash)):
+                logger.debug("Catalog unchanged. Using snapshot for listing.")
+                return True
+            self.snapshot.catalog_hash = catalog_hash
+        index_path = os.path.join(CATALOG_INDEX_DIR, hashlib.sha1(
+            self.su_catalog_url).hexdigest() + ".idx")
+        index = open_catalog_index(index_path, catalog_hash)
+        if index:
+            logger.debug("Using catalog index %s" % index_path)
+            self.catalog = {"Products": index}
+            self.os_installers = list(index.installers)
+            self.product_catalogs = index.catalogs
+        else:
+            self.parse_sucatalog()
+            self.find_mac_os_installers()
+            write_catalog_index(index_path, catalog_hash,
+                                self.catalog["Products"], self.os_installers,
+                                self.product_catalogs)
         logger.debug("os_installers: " + str(self.os_installers))
-        self.os_installer_product_info()
-        logger.debug("product_info: " + str(self.product_info))
+        return False
 
     def get_catalog_url(self):
-        if self.arguments.catalogurl:
-            self.su_catalog_url = self.arguments.catalogurl
-        else:
-            self.su_catalog_url = get_default_catalog()
-        if not self.su_catalog_url:
+        self.su_catalog_urls = get_catalog_urls(self.arguments)
+        if not self.su_catalog_urls:
             logger.log(FAIL, "Could not find a default catalog url " +
                        "for this OS version.")
             sys.exit(1)
+        # A space cannot appear in a URL, so this is a unique key for the
+        # set of catalogs.
+        self.su_catalog_url = " ".join(self.su_catalog_urls)
 
     def download_sucatalog(self):
-        """Downloads the softwareupdate catalog"""
-        try:
-            self.local_path = replicate_url(self.script_thread,
-                                            self.su_catalog_url,
-                                            CATALOG_WEIGHT,
-                                            root_dir=self.workdir)
-        except ReplicationError as err:
-            logger.error("Could not replicate %s: %s" %
-                         (self.su_catalog_url, err))
+        """Downloads all of the softwareupdate catalogs at the same time"""
+        def download(url):
+            try:
+                return replicate_url(
+                    self.script_thread, url, "catalog", root_dir=self.workdir,
+                    max_age=self.arguments.cache_max_age)
+            except ReplicationError as err:
+                logger.error("Could not replicate %s: %s" % (url, err))
+                return None
+
+        # Each path stays paired with its url, since a failed catalog is
+        # left out.
+        self.local_paths = [
+            (url, path) for url, path in zip(
+                self.su_catalog_urls,
+                run_in_threads(download, self.su_catalog_urls))
+            if path]
 
     def parse_sucatalog(self):
-        if os.path.splitext(self.local_path)[1] == ".gz":
-            with gzip.open(self.local_path) as the_file:
-                content = the_file.read()
-                try:
-                    self.catalog = plistlib.readPlistFromString(content)
-                except ExpatError as err:
-                    logger.log(FAIL, "Error reading %s: %s" %
-                               (self.local_path, err))
-        else:
-            try:
-                self.catalog = plistlib.readPlist(self.local_path)
-            except (OSError, IOError, ExpatError) as err:
-                logger.error("Error reading %s: %s" %
-                             (self.local_path, err))
+        """Merges the products of every downloaded catalog, keeping one copy
+        of each product ID and noting which catalogs offer it."""
+        self.catalog = {"Products": {}}
+        self.product_catalogs = {}
+        for url, local_path in self.local_paths:
+            catalog = read_sucatalog(local_path)
+            for product_key, product in catalog.get("Products", {}).items():
+                self.catalog["Products"].setdefault(product_key, product)
+                self.product_catalogs.setdefault(product_key, []).append(url)
+
+    def restore_snapshot(self, catalog_hash):
+        """Fills product_info from the snapshot when the catalog file is the
+        one the snapshot was built from. The raw catalog is not parsed, so
+        this is only suitable for listing."""
+        if (not self.snapshot.previous or
+                self.snapshot.catalog_hash != catalog_hash):
+            return False
+        for product_key, product in self.snapshot.restore().items():
+            self.sort_by_compatibility(product_key, product)
+        return True
+
+    def sort_by_compatibility(self, product_key, product):
+        """Files the InstallerProduct under product_info or
+        incompatible_info depending on this Mac's model."""
+        if product.non_supported_models:
+            # Remove any incompatible installer.
+            if (self.this_mac.machine_model in
+               product.non_supported_models):
+                logger.debug(
+                    "%s is not compatible with this installer." %
+                    self.this_mac.machine_model)
+                self.incompatible_info[product_key] = product
+                return
+            logger.debug(
+                "%s is not listed as incompatible with this installer." %
+                self.this_mac.machine_model)
+        self.product_info[product_key] = product
 
     def find_mac_os_installers(self):
         """Creates a list of product identifiers for what appear to be macOS
@@ -703,47 +1895,91 @@ class SoftwareCatalog(object):
                     continue
 
     def os_installer_product_info(self):
-        """Creates a dict of info about products that look like macOS
-        installers"""
+        """Creates an InstallerProduct for each product that looks like a
+        macOS installer, then releases the raw catalog."""
+        dist_urls = {}
+        infos = {}
         for product_key in self.os_installers:
-            self.product_info[product_key] = {}
-            filename = self.get_server_metadata(product_key)
-            self.product_info[product_key] = parse_server_metadata(filename)
             product = self.catalog["Products"][product_key]
-            self.product_info[product_key]["PostDate"] = product["PostDate"]
             distributions = product["Distributions"]
-            dist_url = distributions.get("English") or distributions.get("en")
-            try:
-                dist_path = replicate_url(self.script_thread, dist_url,
-                                          PRODUCT_INFO_WEIGHT,
-                                          root_dir=self.workdir)
-            except ReplicationError as err:
-                logger.log(FAIL, "Could not replicate %s: %s" %
-                           (dist_url, err))
-            dist_info = parse_dist(dist_path)
-            if dist_info.get("nonSupportedModels"):
-                # Remove any incompatible installer.
-                if (self.this_mac.machine_model in
-                   dist_info.get("nonSupportedModels")):
-                    logger.debug(
-                        "%s is not compatible with this installer." %
-                        self.this_mac.machine_model)
-                    del self.product_info[product_key]
-                    continue
-                logger.debug(
-                    "%s is not listed as incompatible with this installer." %
-                    self.this_mac.machine_model)
-
-            self.product_info[product_key]["DistributionPath"] = dist_path
-            self.product_info[product_key].update(dist_info)
+            dist_urls[product_key] = (
+                distributions.get("English") or distributions.get("en"))
+            if self.snapshot:
+                infos[product_key] = self.snapshot.reuse(
+                    product_key, product["PostDate"], dist_urls[product_key],
+                    self.workdir)
+        # Fetch everything the snapshot could not provide in one batch, so
+        # the transfer engine can run the small requests side by side.
+        to_fetch = [product_key for product_key in self.os_installers
+                    if infos.get(product_key) is None]
+        fetched = self.transfer_engine.map(
+            lambda product_key: self.fetch_product_info(
+                product_key, dist_urls[product_key]), to_fetch,
+            url_of=lambda product_key: dist_urls[product_key])
+        for product_key in self.os_installers:
+            product = self.catalog["Products"][product_key]
+            dist_url = dist_urls[product_key]
+            refreshed = product_key in to_fetch
+            if refreshed:
+                info = fetched[to_fetch.index(product_key)]
+            else:
+                info = infos[product_key]
+            if info is None:
+                logger.debug("No product info for %s." % product_key)
+                continue
+            packages = product.get("Packages", [])
+            installer_product = InstallerProduct.from_info(
+                info, post_date=product["PostDate"],
+                total_size=sum([package.get("Size", 0)
+                                for package in packages
+                                if "URL" in package]),
+                catalogs=self.product_catalogs[product_key],
+                packages=[slim_package(package) for package in packages])
+            if self.snapshot:
+                self.snapshot.record(product_key, installer_product, dist_url,
+                                     refreshed)
+            self.sort_by_compatibility(product_key, installer_product)
+        # Only the runs that compare against the snapshot move it forward,
+        # so --list and plain installs do not hide changes from them.
+        if self.snapshot and (self.arguments.incremental or
+                              self.arguments.list_changes):
+            self.snapshot.save()
+        # The records hold everything needed from here on, and the raw
+        # catalog is by far the largest object in the process.
+        self.catalog = None
+        self.product_catalogs = None
+        release_free_memory()
+
+    def fetch_product_info(self, product_key, dist_url):
+        """Downloads and parses the ServerMetadata and distribution file for
+        a single product."""
+        filename = self.get_server_metadata(product_key)
+        info = parse_server_metadata(filename)
+        dist_path = None
+        try:
+            dist_path = replicate_url(self.script_thread, dist_url,
+                                      "catalog",
+                                      root_dir=self.workdir,
+                                      max_age=self.metadata_max_age(
+                                          product_key),
+                                      **self.transfer_engine.options())
+        except ReplicationError as err:
+            logger.log(FAIL, "Could not replicate %s: %s" %
+                       (dist_url, err))
+        info["DistributionPath"] = dist_path
+        info.update(parse_dist(dist_path))
+        return info
 
     def get_server_metadata(self, product_key):
         """Replicate ServerMetaData"""
         try:
             url = self.catalog["Products"][product_key]["ServerMetadataURL"]
             try:
-                return replicate_url(self.script_thread, url, METADATA_WEIGHT,
-                                     root_dir=self.workdir)
+                return replicate_url(self.script_thread, url, "catalog",
+                                     root_dir=self.workdir,
+                                     max_age=self.metadata_max_age(
+                                         product_key),
+                                     **self.transfer_engine.options())
             except ReplicationError as err:
                 logger.error("Could not replicate %s: %s" % (url, err))
                 return None
@@ -751,13 +1987,312 @@ class SoftwareCatalog(object):
             logger.log(FAIL, "Malformed catalog.")
             return None
 
+    def metadata_max_age(self, product_key):
+        """Returns how many seconds a product's ServerMetadata and
+        distribution file are reused, so a repeated --list reads them from
+        the working directory. A copy downloaded before the product was last
+        posted is always replaced."""
+        post_date = self.catalog["Products"][product_key].get("PostDate")
+        if not isinstance(post_date, datetime.datetime):
+            return 0
+        posted_age = time.time() - calendar.timegm(post_date.utctimetuple())
+        return max(min(self.arguments.cache_max_age, posted_age), 0)
+
+
+class DownloadLock(object):
+    """Object that holds an flock on a file's lock file while this process
+    downloads it, so processes sharing a working directory download each
+    file once. The kernel drops an flock when its holder exits, so a crashed
+    download never leaves a stale lock behind.
+    """
+    def __init__(self, local_file_path):
+        self.local_file_path = local_file_path
+        self.path = local_file_path + LOCK_SUFFIX
+        self.lock_file = None
+        self.held = False
+
+    def acquire(self):
+        """Takes the lock without waiting. Returns whether it is held."""
+        if self.lock_file is None:
+            self.lock_file = open(self.path, "a+")
+        try:
+            fcntl.flock(self.lock_file.fileno(),
+                        fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as err:
+            if err.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        self.lock_file.seek(0)
+        self.lock_file.truncate()
+        self.lock_file.write(str(os.getpid()))
+        self.lock_file.flush()
+        self.held = True
+        return True
+
+    def owner(self):
+        """Returns the pid written by the holder, if any."""
+        try:
+            with open(self.path) as the_file:
+                return the_file.read().strip() or None
+        except IOError:
+            return None
+
+    def release(self):
+        if self.lock_file is None:
+            return
+        if self.held:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+            self.held = False
+        self.lock_file.close()
+        self.lock_file = None
+
+
+class CatalogIndex(object):
+    """Object that reads a merged catalog saved by write_catalog_index. The
+    file is memory-mapped and starts with an offset index of the products,
+    so a lookup only reads the pages of the product it needs, and processes
+    reading the same catalog share those pages through the page cache.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as the_file:
+            # The index lives under /private/tmp, where another user could
+            # leave one in its place.
+            if not (is_private(os.fstat(the_file.fileno())) and
+                    is_private(os.stat(os.path.dirname(path)))):
+                raise ValueError("Not private to this user")
+            self.map = mmap.mmap(the_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        magic_size = len(CATALOG_INDEX_MAGIC)
+        if self.map[:magic_size] != CATALOG_INDEX_MAGIC:
+            raise ValueError("Not a catalog index")
+        header_start = magic_size + 8
+        header_size = struct.unpack(
+            "!Q", self.map[magic_size:header_start])[0]
+        header = json.loads(self.map[header_start:header_start + header_size])
+        self.body = header_start + header_size
+        self.catalog_hash = header["CatalogHash"]
+        self.offsets = header["index"]
+        self.installers = header["installers"]
+        self.catalogs = header["catalogs"]
+
+    def __getitem__(self, product_key):
+        offset, size = self.offsets[product_key]
+        start = self.body + offset
+        return json.loads(self.map[start:start + size],
+                          object_hook=decode_catalog_value)
+
+    def __contains__(self, product_key):
+        return product_key in self.offsets
+
+    def keys(self):
+        return self.offsets.keys()
+
+    def get(self, product_key, default=None):
+        if product_key not in self.offsets:
+            return default
+        return self[product_key]
+
+    def close(self):
+        self.map.close()
+
+
+class InstallerProduct(object):
+    """Object that holds what the run needs to know about one macOS
+    installer product. One is kept per installer for the whole run, so it
+    has __slots__, interned strings and a frozenset of unsupported models.
+    """
+    __slots__ = ("title", "version", "build", "post_date",
+                 "distribution_path", "non_supported_models",
+                 "package_order", "total_size", "catalogs", "packages")
+
+    def __init__(self, title="", version="", build="", post_date=None,
+                 distribution_path=None, non_supported_models=(),
+                 package_order=(), total_size=0, catalogs=(), packages=()):
+        self.title = intern_string(title)
+        self.version = intern_string(version)
+        self.build = intern_string(build)
+        self.post_date = post_date
+        self.distribution_path = distribution_path
+        self.non_supported_models = frozenset(
+            [intern_string(model) for model in non_supported_models])
+        self.package_order = tuple(
+            [intern_string(name) for name in package_order])
+        self.total_size = total_size
+        self.catalogs = tuple([intern_string(url) for url in catalogs])
+        self.packages = tuple(packages)
+
+    @classmethod
+    def from_info(cls, info, **overrides):
+        """Builds a product from an info dict, as parsed from the metadata
+        and distribution files or saved in the snapshot."""
+        fields = {
+            "title": info.get("title", ""),
+            "version": info.get("version", ""),
+            "build": info.get("BUILD", ""),
+            "distribution_path": info.get("DistributionPath"),
+            "non_supported_models": info.get("nonSupportedModels") or (),
+            "package_order": info.get("PackageOrder") or (),
+            "total_size": info.get("TotalSize", 0),
+            "catalogs": info.get("Catalogs") or (),
+        }
+        fields.update(overrides)
+        return cls(**fields)
+
+    def info(self):
+        """Returns the product as an info dict for the snapshot. The
+        packages are left out, as they come from the catalog."""
+        return {
+            "title": self.title,
+            "version": self.version,
+            "BUILD": self.build,
+            "DistributionPath": self.distribution_path,
+            "nonSupportedModels": sorted(self.non_supported_models),
+            "PackageOrder": list(self.package_order),
+            "TotalSize": self.total_size,
+            "Catalogs": list(self.catalogs),
+        }
+
+    def __repr__(self):
+        return "<InstallerProduct %s %s>" % (self.title, self.version)
+
+
+class InstallerSnapshot(object):
+    """Object that remembers the installer products processed on the last
+    run against a catalog, so unchanged products can skip the ServerMetadata
+    and distribution downloads.
+    """
+    def __init__(self, catalog_url, path=None):
+        self.catalog_url = catalog_url
+        self.path = path or SNAPSHOT_FILE
+        self.previous = {}
+        self.current = {}
+        # Digest of the catalog file the previous products were read from.
+        self.catalog_hash = None
+        # Product keys that had to be downloaded and parsed again.
+        self.refreshed = []
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as the_file:
+                snapshots = json.load(the_file)
+        except (OSError, IOError, ValueError) as err:
+            logger.debug("No usable snapshot at %s: %s" % (self.path, err))
+            return
+        snapshot = snapshots.get(self.catalog_url, {})
+        self.previous = snapshot.get("products", {})
+        self.catalog_hash = snapshot.get("CatalogHash")
+
+    def save(self):
+        try:
+            with open(self.path) as the_file:
+                snapshots = json.load(the_file)
+        except (OSError, IOError, ValueError):
+            snapshots = {}
+        snapshots[self.catalog_url] = {"CatalogHash": self.catalog_hash,
+                                       "products": self.current}
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w") as the_file:
+                json.dump(snapshots, the_file, indent=2, sort_keys=True)
+            os.rename(temp_path, self.path)
+        except (OSError, IOError) as err:
+            logger.error("Could not save snapshot %s: %s" % (self.path, err))
+
+    def reuse(self, product_key, post_date, dist_url, workdir):
+        """Returns the product info from the last snapshot if the product
+        has not been reposted and its distribution file is intact in
+        workdir. Otherwise returns None."""
+        entry = self.previous.get(product_key)
+        if not entry:
+            return None
+        if (entry.get("PostDate") != format_post_date(post_date) or
+                entry.get("DistributionURL") != dist_url):
+            return None
+        dist_path = entry["info"].get("DistributionPath")
+        # A dist file in another working directory is away from the
+        # packages this run downloads.
+        if (dist_path != local_path_for_url(dist_url, workdir) or
+                not os.path.exists(dist_path) or
+                file_digest(dist_path) != entry.get("DistributionHash")):
+            return None
+        logger.debug("Reusing snapshot for %s" % product_key)
+        return entry["info"]
+
+    def restore(self):
+        """Returns an InstallerProduct for every product in the last
+        snapshot. Only valid while the catalog itself is unchanged."""
+        self.current = self.previous
+        restored = {}
+        for product_key, entry in self.previous.items():
+            restored[product_key] = InstallerProduct.from_info(
+                entry["info"], post_date=datetime.datetime.strptime(
+                    entry["PostDate"], SNAPSHOT_DATE_FORMAT))
+        return restored
+
+    def record(self, product_key, product, dist_url, refreshed=True):
+        if refreshed:
+            self.refreshed.append(product_key)
+        entry_info = product.info()
+        entry_info["PostDate"] = format_post_date(product.post_date)
+        dist_path = product.distribution_path
+        self.current[product_key] = {
+            "PostDate": entry_info["PostDate"],
+            "DistributionURL": dist_url,
+            "DistributionHash": (file_digest(dist_path)
+                                 if dist_path and os.path.exists(dist_path)
+                                 else None),
+            "info": entry_info,
+        }
+
+    @staticmethod
+    def differs(previous, current):
+        """Returns True if the catalog entry or the distribution file changed.
+        A product that was only refreshed because its local distribution file
+        went missing is not a change."""
+        if (previous.get("PostDate") != current.get("PostDate") or
+                previous.get("DistributionURL") !=
+                current.get("DistributionURL")):
+            return True
+        return bool(previous.get("DistributionHash") and
+                    current.get("DistributionHash") and
+                    previous["DistributionHash"] !=
+                    current["DistributionHash"])
+
+    def changes(self):
+        """Returns the products added, changed and removed since the last
+        snapshot."""
+        def summary(product_key, entry):
+            return {"product_id": product_key,
+                    "title": entry["info"].get("title", ""),
+                    "version": entry["info"].get("version", ""),
+                    "PostDate": entry["PostDate"]}
+
+        added = [summary(key, self.current[key]) for key in self.refreshed
+                 if key not in self.previous]
+        changed = [summary(key, self.current[key]) for key in self.refreshed
+                   if key in self.previous and
+                   self.differs(self.previous[key], self.current[key])]
+        removed = [summary(key, self.previous[key]) for key in self.previous
+                   if key not in self.current]
+        return {"catalog": self.catalog_url, "added": added,
+                "changed": changed, "removed": removed}
+
 
 class MacInfo(object):
     """Object that encapsulates information about this computer.
     """
     def __init__(self):
-        self._sp_hardware = subprocess.check_output(
-            ["/usr/sbin/system_profiler", "SPHardwareDataType", "-xml"])
+        # system_profiler is slow and the hardware does not change between
+        # runs, so its output is cached.
+        if is_fresh(HARDWARE_CACHE, HARDWARE_CACHE_MAX_AGE):
+            with open(HARDWARE_CACHE) as the_file:
+                self._sp_hardware = the_file.read()
+        else:
+            self._sp_hardware = subprocess.check_output(
+                ["/usr/sbin/system_profiler", "SPHardwareDataType", "-xml"])
+            with open(HARDWARE_CACHE, "w") as the_file:
+                the_file.write(self._sp_hardware)
         self.sp_hardware = plistlib.readPlistFromString(self._sp_hardware)[0]
         _items = [i for i in self.sp_hardware.get("_items")
                   if "serial_number" in i.keys()][0]
@@ -766,6 +2301,10 @@ class MacInfo(object):
                 self.__dict__[key] = value
 
     def _network(self):
+        from SystemConfiguration import (
+            SCDynamicStoreCopyComputerName,
+            SCDynamicStoreCopyLocalHostName,
+        )
         self.computer_name = SCDynamicStoreCopyComputerName(None, None)[0]
         self.local_hostname = SCDynamicStoreCopyLocalHostName(None)
 
@@ -799,6 +2338,168 @@ def get_default_catalog():
     return DEFAULT_SUCATALOGS.get(darwin_major)
 
 
+def encode_catalog_value(value):
+    """json default hook for the catalog values JSON cannot hold."""
+    if isinstance(value, datetime.datetime):
+        return {"__date__": value.strftime(SNAPSHOT_DATE_FORMAT)}
+    if isinstance(value, plistlib.Data):
+        return {"__data__": base64.b64encode(value.data)}
+    raise TypeError("Cannot encode %r" % value)
+
+
+def decode_catalog_value(value):
+    """json object_hook that reverses encode_catalog_value."""
+    if "__date__" in value:
+        return datetime.datetime.strptime(value["__date__"],
+                                          SNAPSHOT_DATE_FORMAT)
+    if "__data__" in value:
+        return plistlib.Data(base64.b64decode(value["__data__"]))
+    return value
+
+
+def write_catalog_index(path, catalog_hash, products, installers, catalogs):
+    """Saves merged catalog products as a CatalogIndex file. Each product is
+    stored as its own JSON document after a header with their offsets."""
+    body = []
+    offsets = {}
+    position = 0
+    for product_key, product in products.items():
+        document = json.dumps(product, default=encode_catalog_value,
+                              separators=(",", ":"))
+        offsets[product_key] = (position, len(document))
+        body.append(document)
+        position += len(document)
+    header = json.dumps({
+        "CatalogHash": catalog_hash,
+        "index": offsets,
+        "installers": installers,
+        "catalogs": dict([(product_key, catalogs[product_key])
+                          for product_key in installers]),
+    }, separators=(",", ":"))
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), 0o755)
+        if not is_private(os.stat(os.path.dirname(path))):
+            logger.error("Not saving catalog index %s: its directory is "
+                         "not private to this user." % path)
+            return
+        with os.fdopen(os.open(temp_path,
+                               os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644),
+                       "wb") as the_file:
+            the_file.write(CATALOG_INDEX_MAGIC)
+            the_file.write(struct.pack("!Q", len(header)))
+            the_file.write(header)
+            for document in body:
+                the_file.write(document)
+        os.rename(temp_path, path)
+    except (OSError, IOError) as err:
+        logger.error("Could not save catalog index %s: %s" % (path, err))
+
+
+def is_private(stat_result):
+    """Returns True if stat_result is of a file or directory this user owns
+    and no other user can write to."""
+    return (stat_result.st_uid == os.getuid() and
+            not stat_result.st_mode & (stat.S_IWGRP | stat.S_IWOTH))
+
+
+def open_catalog_index(path, catalog_hash):
+    """Returns the CatalogIndex at path if it was built from the catalog
+    files with catalog_hash, or None."""
+    try:
+        index = CatalogIndex(path)
+    except (EnvironmentError, ValueError, KeyError, struct.error) as err:
+        logger.debug("No usable catalog index at %s: %s" % (path, err))
+        return None
+    if index.catalog_hash != catalog_hash:
+        index.close()
+        return None
+    return index
+
+
+def get_seed_catalogs():
+    """Returns a dict of seed program names and their catalog URLs"""
+    try:
+        return plistlib.readPlist(SEED_CATALOGS_PLIST)
+    except (OSError, IOError, ExpatError) as err:
+        logger.debug("Error reading %s: %s" % (SEED_CATALOGS_PLIST, err))
+        return {}
+
+
+def get_catalog_urls(arguments):
+    """Returns the list of catalog URLs to read, in order of preference and
+    without duplicates."""
+    urls = list(arguments.catalogurl or [])
+    seed_catalogs = get_seed_catalogs()
+    seed_programs = list(arguments.seedprogram or [])
+    if urls and not arguments.aggregate_catalogs:
+        seed_programs = []
+    if arguments.aggregate_catalogs:
+        urls.append(get_default_catalog())
+        if not seed_programs:
+            seed_programs = sorted(seed_catalogs.keys())
+    for seed_program in seed_programs:
+        if seed_program in seed_catalogs:
+            urls.append(seed_catalogs[seed_program])
+        else:
+            logger.error("Unknown seed program: " + seed_program)
+    if not urls:
+        urls.append(get_default_catalog())
+    catalog_urls = []
+    for url in urls:
+        if url and url not in catalog_urls:
+            catalog_urls.append(url)
+    return catalog_urls
+
+
+def open_artifact(local_path):
+    """Opens a replicated file for reading, decompressing it on the fly if
+    its content is gzip."""
+    the_file = open(local_path, "rb")
+    if the_file.read(len(GZIP_MAGIC)) == GZIP_MAGIC:
+        the_file.seek(0)
+        return gzip.GzipFile(fileobj=the_file)
+    the_file.seek(0)
+    return the_file
+
+
+def read_sucatalog(local_path):
+    """Reads a softwareupdate catalog, returning an empty dict if it cannot
+    be read."""
+    try:
+        with open_artifact(local_path) as the_file:
+            return plistlib.readPlist(the_file)
+    except (OSError, IOError, ExpatError, zlib.error) as err:
+        logger.error("Error reading %s: %s" %
+                     (local_path, err))
+    return {}
+
+
+def worker_thread_name(role):
+    """Returns a name for a worker thread that starts with the name of the
+    thread starting it, so its log records can be traced to that thread."""
+    return "%s/%s" % (threading.current_thread().name, role)
+
+
+def run_in_threads(function, items):
+    """Calls function once per item, each in its own thread, and returns the
+    results in the order of items."""
+    results = [None] * len(items)
+
+    def worker(index, item):
+        results[index] = function(item)
+
+    threads = [threading.Thread(target=worker, args=(index, item),
+                                name=worker_thread_name("worker"))
+               for index, item in enumerate(items)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
 def parse_server_metadata(filename):
     """Parses a softwareupdate server metadata file, looking for
     information of interest.
@@ -806,8 +2507,9 @@ def parse_server_metadata(filename):
     title = ""
     vers = ""
     try:
-        md_plist = plistlib.readPlist(filename)
-    except (OSError, IOError, ExpatError) as err:
+        with open_artifact(filename) as the_file:
+            md_plist = plistlib.readPlist(the_file)
+    except (OSError, IOError, ExpatError, zlib.error) as err:
         logger.error("Error reading " + filename + str(err))
         return {}
     vers = md_plist.get("CFBundleShortVersionString", "")
@@ -827,11 +2529,12 @@ def parse_dist(filename):
     """Parses a softwareupdate dist file, returning a dict of info of
     interest"""
     try:
-        dom = minidom.parse(filename)
+        with open_artifact(filename) as the_file:
+            dom = minidom.parse(the_file)
     except ExpatError:
         logger.log(FAIL, "Invalid XML in %s" % filename)
         return {}
-    except IOError as err:
+    except (IOError, zlib.error) as err:
         logger.log(FAIL, "Error reading %s: %s" % (filename, err))
         return {}
 
@@ -841,9 +2544,51 @@ def parse_dist(filename):
     if auxinfo:
         aux = parse_auxinfo(auxinfo)
         aux.update(parse_scripts(scripts))
-        return aux
     else:
-        return parse_scripts(scripts)
+        aux = parse_scripts(scripts)
+    aux["PackageOrder"] = parse_pkg_refs(dom.getElementsByTagName("pkg-ref"))
+    return aux
+
+
+def parse_pkg_refs(pkg_refs):
+    """Returns the package file names referenced by a dist file, in the
+    order the installer will use them."""
+    package_order = []
+    for pkg_ref in pkg_refs:
+        text = "".join([n.nodeValue for n in pkg_ref.childNodes
+                        if n.nodeType == n.TEXT_NODE]).strip()
+        if text:
+            file_name = os.path.basename(text.lstrip("#"))
+            if file_name not in package_order:
+                package_order.append(file_name)
+    return package_order
+
+
+def order_packages(packages, package_order, largest_first=False):
+    """Sorts catalog packages by their position in package_order. Packages
+    the dist file does not mention go at the end. Packages at the same
+    position keep their catalog order, or with largest_first are sorted by
+    size, largest first."""
+    def position(indexed_package):
+        index, package = indexed_package
+        file_name = os.path.basename(
+            urlparse.urlsplit(package.get("URL", ""))[2])
+        size = package.get("Size", 0) if largest_first else 0
+        if file_name in package_order:
+            return (package_order.index(file_name), -size, index)
+        return (len(package_order), -size, index)
+
+    return [package for _, package in
+            sorted(enumerate(packages), key=position)]
+
+
+def convert_duration(seconds):
+    if seconds < 60:
+        return "less than a minute"
+    minutes = int(round(seconds / 60.0))
+    if minutes < 120:
+        return "about %d minutes" % minutes
+    return "about %.1f hours" % (minutes / 60.0)
 
 
 def parse_auxinfo(auxinfo):
@@ -886,6 +2631,14 @@ def parse_scripts(xml):
     return script_info
 
 
+RETRY_POLICY = RetryPolicy()
+CIRCUIT_BREAKERS = CircuitBreakers()
+TRANSFER_STATS = TransferStats()
+RUN_METRICS = RunMetrics()
+# Set by start_cassette_recording to record every response open_url gets.
+CASSETTE_RECORDER = None
+
+
 def discover_caching_server():
     """Finds caching server using AssetCacheLocatorUtil"""
     try:
@@ -930,84 +2683,518 @@ def convert_size(size_bytes):
     return "%s %s" % (s, size_name[i])
 
 
-def progress_percent(percent):
-    return float(percent / 100.0 * PROGRESS_BAR_MAX_VALUE)
+def intern_string(value):
+    """Returns value interned, so equal strings share one object. Unicode
+    that is plain ASCII becomes a str first, as only str can be interned."""
+    if isinstance(value, unicode):
+        try:
+            value = value.encode("ascii")
+        except UnicodeError:
+            return value
+    if isinstance(value, str):
+        return intern(value)
+    return value
+
+
+def count_objects_by_type():
+    """Returns a dict of type names and the number of live objects of each
+    type the garbage collector tracks."""
+    counts = {}
+    for obj in gc.get_objects():
+        kind = type(obj).__name__
+        counts[kind] = counts.get(kind, 0) + 1
+    return counts
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports kilobytes.
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+
+def release_free_memory():
+    """Collects garbage and asks the allocator to return its free pages to
+    the system, so freeing a large structure also lowers the resident
+    size."""
+    gc.collect()
+    try:
+        if sys.platform == "darwin":
+            libc = ctypes.CDLL("/usr/lib/libSystem.B.dylib")
+            libc.malloc_zone_pressure_relief(None, 0)
+        else:
+            libc = ctypes.CDLL("libc.so.6")
+            libc.malloc_trim(0)
+    except (OSError, AttributeError) as err:
+        logger.debug("Could not release free memory: %s" % err)
+
+
+def file_digest(path, chunk_size=1048576):
+    """Returns the SHA-1 hex digest of a file."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as the_file:
+        while True:
+            chunk = the_file.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_fresh(path, max_age):
+    """Returns True if path exists and was modified less than max_age
+    seconds ago."""
+    try:
+        return time.time() - os.path.getmtime(path) < max_age
+    except OSError:
+        return False
+
+
+def format_post_date(post_date):
+    """Returns a PostDate as a string suitable for JSON output."""
+    if isinstance(post_date, datetime.datetime):
+        return post_date.strftime(SNAPSHOT_DATE_FORMAT)
+    return str(post_date)
 
 
-def progress_increment(fraction):
-    return float(fraction * PROGRESS_BAR_MAX_VALUE)
+def check_package_signature(local_path):
+    """Checks a package's signature with pkgutil. Returns the reason it looks
+    damaged, or None. Unsigned packages are accepted."""
+    try:
+        process = subprocess.Popen(
+            [PKGUTIL_CMD, "--check-signature", local_path],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError as err:
+        logger.debug("Could not run pkgutil: %s" % err)
+        return None
+    output = process.communicate()[0]
+    if process.returncode and "no signature" not in output:
+        logger.debug("pkgutil output: " + output)
+        return "bad signature"
+    return None
+
+
+def make_transfer_engine(arguments, script_thread):
+    """Returns the TransferEngine selected by --transfer-engine. It is
+    cancelled when the script ends."""
+    cancelled = script_thread.cancel_event if script_thread else None
+    throttle = None
+    if arguments.bandwidth_limit or arguments.prefetch_window:
+        throttle = TransferThrottle(
+            rate=arguments.bandwidth_limit * 1024,
+            windows=arguments.prefetch_window,
+            cancelled=cancelled)
+    if arguments.transfer_engine == "pool":
+        return TransferEngine(workers=TRANSFER_WORKERS,
+                              timeout=TRANSFER_TIMEOUT, cancelled=cancelled,
+                              throttle=throttle)
+    return TransferEngine(cancelled=cancelled, throttle=throttle)
+
+
+def parse_time_window(window):
+    """Parses HH:MM-HH:MM into a pair of minutes after midnight."""
+    try:
+        start, end = window.split("-")
+        return tuple([int(part.split(":")[0]) * 60 + int(part.split(":")[1])
+                      for part in (start, end)])
+    except (ValueError, IndexError):
+        raise argparse.ArgumentTypeError(
+            "Invalid time window %s. Use HH:MM-HH:MM." % window)
 
 
-def replicate_url(script_thread, full_url, weight, root_dir="/tmp",
-                  caching_server=None, chunk_size=8196):
+def parse_capacity(capacity):
+    """Parses CONNECTIONS:KBPS into a pair of ints. 0 means unlimited."""
+    try:
+        connections, rate = [int(part) for part in capacity.split(":")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "Invalid capacity %s. Use CONNECTIONS:KBPS." % capacity)
+    return connections, rate
+
+
+def lower_priority():
+    """Lowers this process's CPU and disk I/O priority for background
+    work."""
+    os.nice(PREFETCH_NICENESS)
+    if sys.platform != "darwin":
+        return
+    try:
+        libc = ctypes.CDLL("/usr/lib/libSystem.B.dylib", use_errno=True)
+        if libc.setiopolicy_np(IOPOL_TYPE_DISK, IOPOL_SCOPE_PROCESS,
+                               IOPOL_THROTTLE):
+            logger.debug("setiopolicy_np failed: %d" % ctypes.get_errno())
+    except (OSError, AttributeError) as err:
+        logger.debug("Could not lower I/O priority: %s" % err)
+
+
+def caching_server_url(full_url, caching_server):
+    """Rewrites a URL to fetch it through a caching server. caching_server
+    is a host:port, which keeps the URL's scheme, or a URL such as
+    http://host:port for a server with a different scheme."""
+    scheme, host, path = urlparse.urlsplit(full_url)[:3]
+    if "://" in caching_server:
+        scheme, caching_server = caching_server.split("://", 1)
+    return (scheme + "://" + caching_server.rstrip("/") + path +
+            "?source=" + host)
+
+
+def local_path_for_url(full_url, root_dir):
+    """Returns the path a URL is replicated to under root_dir."""
+    path = urlparse.urlsplit(full_url)[2]
+    relative_url = os.path.normpath(path.lstrip("/"))
+    return os.path.join(root_dir, relative_url)
+
+
+def package_id(package):
+    """Returns the URL that identifies a catalog package entry."""
+    return package.get("URL") or package.get("MetadataURL")
+
+
+def slim_package(package):
+    """Returns a copy of a catalog package entry with only the keys used
+    after the catalog is released."""
+    return dict([(key, package[key]) for key in PACKAGE_KEYS
+                 if key in package])
+
+
+def verify_package(package, local_path):
+    """Compares a replicated package against its catalog entry. Returns the
+    reason it looks damaged, or None."""
+    if not os.path.exists(local_path):
+        return "missing"
+    if "Size" in package and os.path.getsize(local_path) != package["Size"]:
+        return "size mismatch"
+    digest = package.get("Digest")
+    if digest and len(digest) == 40 and file_digest(local_path) != digest:
+        return "digest mismatch"
+    return None
+
+
+def replicate_url(script_thread, full_url, phase, root_dir="/tmp",
+                  caching_server=None, chunk_size=8196, max_age=None,
+                  timeout=None, cancel_event=None, expected_size=None,
+                  throttle=None, retry_policy=None):
     """Downloads a URL and stores it in the same relative path on our
-    filesystem. Returns a path to the replicated file."""
+    filesystem. Returns a path to the replicated file. If max_age is given,
+    a local copy younger than max_age seconds is used without downloading.
+    If expected_size is given, a local copy of that size is used as is and a
+    shorter one is resumed, and the size is taken to be already expected by
+    the progress phase; otherwise the content length is added to it. A phase
+    of None leaves the progress alone. Setting cancel_event stops the
+    download with a ReplicationError. throttle.consume is called with every
+    chunk read. Transient failures are retried according to retry_policy, which
+    defaults to RETRY_POLICY. Any failure is raised as a ReplicationError."""
     path = urlparse.urlsplit(full_url)[2]
     backup_url = full_url
     if caching_server and (".pkg" in path or ".dmg" in path):
-        full_url = (urlparse.urlsplit(full_url)[0] + "://" +
-                    caching_server + path + "?source=" +
-                    urlparse.urlsplit(full_url)[1])
-    relative_url = path.lstrip("/")
-    relative_url = os.path.normpath(relative_url)
-    local_file_path = os.path.join(root_dir, relative_url)
-    if not os.path.exists(os.path.dirname(local_file_path)):
+        full_url = caching_server_url(full_url, caching_server)
+    local_file_path = local_path_for_url(backup_url, root_dir)
+    try:
         os.makedirs(os.path.dirname(local_file_path), 0o777)
+    except OSError as err:
+        # Another worker may have made it first.
+        if err.errno != errno.EEXIST:
+            raise
     file_name = full_url.split("/")[-1].split("?")[0]
+    if max_age and is_fresh(local_file_path, max_age):
+        logger.debug("Using cached %s" % local_file_path)
+        TRANSFER_STATS.count("reused")
+        return local_file_path
+    if (expected_size is not None and os.path.exists(local_file_path) and
+            os.path.getsize(local_file_path) == expected_size):
+        logger.debug("Already replicated %s" % local_file_path)
+        TRANSFER_STATS.count("reused")
+        if phase:
+            script_thread.progress.add_bytes(phase, expected_size)
+        return local_file_path
+    lock = DownloadLock(local_file_path)
+    try:
+        if not lock.acquire():
+            wait_for_download(script_thread, lock, file_name, phase,
+                              expected_size, cancel_event)
+            # The other process may have finished the file meanwhile.
+            if os.path.exists(local_file_path) and (
+                    expected_size is None or
+                    os.path.getsize(local_file_path) == expected_size):
+                logger.debug("Replicated by another process %s" %
+                             local_file_path)
+                TRANSFER_STATS.count("reused")
+                if phase and expected_size is not None:
+                    script_thread.progress.add_bytes(phase, expected_size)
+                return local_file_path
+        download_with_retries(script_thread, full_url, backup_url,
+                              local_file_path, file_name, phase, chunk_size,
+                              timeout, cancel_event, expected_size, throttle,
+                              retry_policy or RETRY_POLICY)
+    finally:
+        lock.release()
+    return local_file_path
+
+
+def wait_for_download(script_thread, lock, file_name, phase, expected_size,
+                      cancel_event):
+    """Waits until lock is free, which happens when the process downloading
+    the file finishes or dies. The growth of its partial file counts towards
+    this process's progress while waiting."""
+    logger.log(SLVL, "Waiting for %s, which process %s is downloading..." % (
+        file_name, lock.owner()))
+    TRANSFER_STATS.count("waits")
+    part_path = lock.local_file_path + PART_SUFFIX
+    progress = (script_thread.progress
+                if phase and expected_size is not None else None)
+    seen = 0
+    try:
+        while not lock.acquire():
+            if cancel_event is not None:
+                if cancel_event.wait(LOCK_POLL_INTERVAL):
+                    raise ReplicationError("Cancelled")
+            else:
+                time.sleep(LOCK_POLL_INTERVAL)
+            if progress and os.path.exists(part_path):
+                try:
+                    size = os.path.getsize(part_path)
+                except OSError:
+                    continue
+                if size > seen:
+                    progress.add_bytes(phase, size - seen)
+                    seen = size
+    finally:
+        # Whatever this process does next reports the bytes itself.
+        if progress and seen:
+            progress.add_bytes(phase, -seen)
+
+
+def download_with_retries(script_thread, full_url, backup_url,
+                          local_file_path, file_name, phase, chunk_size,
+                          timeout, cancel_event, expected_size, throttle,
+                          retry_policy):
+    """Downloads a URL, retrying transient failures according to
+    retry_policy."""
     logger.debug("Downloading %s..." % full_url)
     logger.log(SLVL, "Downloading %s..." % file_name)
-    with open(local_file_path, "wb") as f:
-        headers = {"user-agent": USER_AGENT}
-        import ssl
-        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-        # Attempt the download. If 404 or other error is found, try again
-        # with the backup_url (which may still fail). The most cromulent
-        # usage of this will be if the caching server lacks the files.
+    attempt = 0
+    while True:
+        attempt += 1
         try:
-            request = urllib2.Request(full_url, headers=headers)
-            response = urllib2.urlopen(request, context=context)
-        except urllib2.HTTPError:
-            full_url = backup_url
-            request = urllib2.Request(full_url, headers=headers)
-            response = urllib2.urlopen(request, context=context)
-        total = float(response.headers.get("content-length"))
-        total_written = 0.0
-        diff = 0.0
-        if total is None:  # no content length header
-            f.write(response.content)
-        else:
-            while True:
-                chunk = response.read(chunk_size)
-                if not chunk:
-                    break
-                f.write(chunk)
-                written = float(len(chunk))
-                total_written += written
-                diff += written
-                if diff >= 0.01 * total and total >= 5000000:
-                    logger.log(
-                        SLVL, "Downloading %s   %s of %s" % (
-                            file_name, convert_size(total_written),
-                            convert_size(total)))
-                    script_thread.stage_progress(
-                        progress_increment(diff / total))
-                    script_thread.overall_progress(
-                        progress_increment((diff * weight) / total))
-                    diff = 0
+            download_url(script_thread, full_url, backup_url,
+                         local_file_path, file_name, phase, chunk_size,
+                         timeout, cancel_event, expected_size, throttle)
+            break
+        except (ReplicationError, IOError, socket.error,
+                httplib.HTTPException, urllib2.URLError) as err:
+            if (cancel_event is not None and cancel_event.is_set()) or (
+                    not retry_policy.should_retry(err, attempt)):
+                TRANSFER_STATS.count("failures")
+                if isinstance(err, ReplicationError):
+                    raise
+                raise ReplicationError("%s: %s" % (type(err).__name__, err))
+            delay = retry_policy.delay(attempt)
+            TRANSFER_STATS.count("retries")
+            logger.debug("Retrying %s in %.1fs after %s: %s" % (
+                file_name, delay, type(err).__name__, err))
+            if cancel_event is not None:
+                cancel_event.wait(delay)
+            else:
+                time.sleep(delay)
     logger.log(SLVL, "Downloading %s Complete." % file_name)
-    script_thread.stage_progress(PROGRESS_BAR_MAX_VALUE)
-    return local_file_path
+
+
+def download_url(script_thread, full_url, backup_url, local_file_path,
+                 file_name, phase, chunk_size, timeout, cancel_event,
+                 expected_size, throttle):
+    """Makes one attempt at downloading a URL to local_file_path, resuming
+    a partial copy when expected_size is known. The data is written to a
+    partial file that is renamed into place once complete. A failed attempt
+    takes back the progress it reported, as the next one starts over or
+    resumes."""
+    part_path = local_file_path + PART_SUFFIX
+    url_path = urlparse.urlsplit(backup_url)[2]
+    if (expected_size is not None and not os.path.exists(part_path) and
+            os.path.exists(local_file_path) and
+            os.path.getsize(local_file_path) < expected_size):
+        # A partial copy left where complete files go.
+        os.rename(local_file_path, part_path)
+    existing_size = 0
+    if expected_size is not None and os.path.exists(part_path):
+        existing_size = os.path.getsize(part_path)
+        if existing_size > expected_size:
+            existing_size = 0
+    if existing_size and existing_size == expected_size:
+        # An earlier attempt got every byte but stopped before the rename.
+        # Asking the server for the bytes after the end would get a 416.
+        logger.debug("Completing %s from its partial file" % file_name)
+        os.rename(part_path, local_file_path)
+        if phase:
+            script_thread.progress.add_bytes(phase, expected_size)
+        return
+    headers = {"user-agent": USER_AGENT}
+    if existing_size:
+        headers["Range"] = "bytes=%d-" % existing_size
+    elif expected_size is None and is_compressible(backup_url):
+        headers["Accept-Encoding"] = "gzip, deflate"
+    response = open_url(full_url, backup_url, headers, timeout)
+    # Progress and the short read check count bytes on the wire, which is
+    # what the content length gives for a compressed response.
+    decoder = None
+    encoding = response.headers.get("content-encoding", "").lower()
+    if encoding in ("gzip", "deflate"):
+        decoder = StreamDecoder(encoding)
+        TRANSFER_STATS.count("compressed")
+    # A chunked response has no length. Its size is then unknown, so it
+    # gets no expected bytes, pipeline or short read check.
+    total = response.headers.get("content-length")
+    if total is not None:
+        total = float(total)
+    total_written = 0.0
+    progress = script_thread.progress if phase else None
+    added = 0.0
+    if progress and expected_size is None and total is not None:
+        added = total
+    mode = "wb"
+    if existing_size and response.getcode() == 206:
+        logger.debug("Resuming %s at %s" % (file_name,
+                                            convert_size(existing_size)))
+        mode = "ab"
+        if total is not None:
+            total += existing_size
+        total_written = float(existing_size)
+    # Bytes are reported in batches, which keeps the per-chunk cost to an
+    # addition.
+    reported = total_written
+    logged = 0.0
+    if progress:
+        progress.expect(phase, added)
+        progress.add_bytes(phase, reported)
+    try:
+        with open(part_path, mode) as f:
+            # Large files are written on a separate thread so a slow disk
+            # does not stall the socket. The pipeline has the same write()
+            # method.
+            writer = f
+            if total is not None and total >= PIPELINE_THRESHOLD:
+                writer = TransferPipeline(f)
+            try:
+                while True:
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise ReplicationError("Cancelled")
+                    chunk = response.read(chunk_size)
+                    if not chunk:
+                        break
+                    if throttle:
+                        throttle.consume(len(chunk))
+                    total_written += len(chunk)
+                    if decoder:
+                        chunk = decoder.decompress(chunk)
+                    writer.write(chunk)
+                    if total_written - reported >= PROGRESS_FLUSH_BYTES:
+                        if progress:
+                            progress.add_bytes(phase,
+                                               total_written - reported)
+                        RUN_METRICS.add_bytes(url_path,
+                                              total_written - reported)
+                        reported = total_written
+                    if (total is not None and total >= 5000000 and
+                            total_written - logged >= 0.01 * total):
+                        logger.log(
+                            SLVL, "Downloading %s   %s of %s" % (
+                                file_name, convert_size(total_written),
+                                convert_size(total)))
+                        logged = total_written
+                if decoder:
+                    writer.write(decoder.flush())
+            except Exception:
+                # The writer thread must be done with f before it closes.
+                if writer is not f:
+                    writer.abort()
+                raise
+            if writer is not f:
+                writer.close()
+                logger.debug(
+                    "%s network stall: %.2fs disk stall: %.2fs (%s-bound)" %
+                    (file_name, writer.write_stall, writer.read_stall,
+                     "disk" if writer.read_stall > writer.write_stall
+                     else "network"))
+        if total is not None and total_written < total:
+            raise ShortReadError("Got %d of %d bytes of %s" % (
+                total_written, total, file_name))
+    except Exception:
+        if progress:
+            progress.expect(phase, -added)
+            progress.add_bytes(phase, -reported)
+        raise
+    os.rename(part_path, local_file_path)
+    if progress:
+        progress.add_bytes(phase, total_written - reported)
+    RUN_METRICS.add_bytes(url_path, total_written - reported)
+
+
+def is_compressible(url):
+    """Returns True if url names a text file worth fetching compressed."""
+    path = urlparse.urlsplit(url)[2]
+    return os.path.splitext(path)[1] in COMPRESSIBLE_EXTENSIONS
+
+
+def open_url(full_url, backup_url, headers, timeout=None):
+    """Opens full_url, falling back to backup_url when it fails or its
+    host's circuit breaker is open. Returns the response."""
+    import ssl
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    open_kwargs = {"context": context}
+    if timeout:
+        open_kwargs["timeout"] = timeout
+    # Attempt the download. If 404 or other error is found, try again
+    # with the backup_url (which may still fail). The most cromulent
+    # usage of this will be if the caching server lacks the files.
+    urls = [full_url]
+    if backup_url != full_url:
+        urls.append(backup_url)
+    for index, url in enumerate(urls):
+        last_url = index == len(urls) - 1
+        host = urlparse.urlsplit(url)[1]
+        breaker = CIRCUIT_BREAKERS.get(host)
+        if not breaker.allow():
+            if last_url:
+                raise CircuitOpenError("Circuit open for " + host)
+            TRANSFER_STATS.count("fallbacks")
+            continue
+        TRANSFER_STATS.count("requests")
+        started = time.time()
+        try:
+            request = urllib2.Request(url, headers=headers)
+            response = urllib2.urlopen(request, **open_kwargs)
+        except (urllib2.URLError, httplib.HTTPException, socket.error) as err:
+            if CASSETTE_RECORDER and isinstance(err, urllib2.HTTPError):
+                CASSETTE_RECORDER.record_error(url, err.code,
+                                               time.time() - started)
+            # A missing file is not a sign of an unhealthy host.
+            if not (isinstance(err, urllib2.HTTPError) and
+                    err.code < 500):
+                breaker.record_failure()
+            if last_url:
+                raise
+            logger.debug("Falling back to %s after %s" % (backup_url, err))
+            TRANSFER_STATS.count("fallbacks")
+            continue
+        breaker.record_success()
+        if index == 0 and len(urls) > 1:
+            TRANSFER_STATS.count("cache_hits")
+        if CASSETTE_RECORDER:
+            return CASSETTE_RECORDER.wrap(url, response, time.time() - started,
+                                          ranged="Range" in headers)
+        return response
 
 
 def get_latest_macos_version(product_info):
-    return sorted([product_info[prod_id]["version"]
+    return sorted([product_info[prod_id].version
                   for prod_id in product_info])[-1]
 
 
 def matching_product_id(product_info, target):
     all_pids = [prod_id for prod_id in product_info
-                if target in product_info[prod_id]['version'] or
-                target.lower() in product_info[prod_id]['title'].lower()]
+                if target in product_info[prod_id].version or
+                target.lower() in product_info[prod_id].title.lower()]
 
     # If there are more than one product ID, get the newest one.
     if len(all_pids) > 1:
@@ -1022,8 +3209,8 @@ def matching_product_id(product_info, target):
                 continue
             # plistlib automatically converts date stamps in plists to
             # datetime objects. Grab those for comparison.
-            this_date = (product_info[this_pid]["PostDate"])
-            new_date = (product_info[newest_pid]["PostDate"])
+            this_date = (product_info[this_pid].post_date)
+            new_date = (product_info[newest_pid].post_date)
             # If the date in this loop is greater, use that product ID.
             if this_date > new_date:
                 newest_pid = this_pid
@@ -1039,9 +3226,9 @@ def matching_product_id(product_info, target):
 
 def parse_version_string(product_info, target):
     return ("%s %s - Dated: %s" % (
-        product_info[target]["title"],
-        product_info[target]["version"],
-        product_info[target]["PostDate"].strftime("%m-%d-%Y")))
+        product_info[target].title,
+        product_info[target].version,
+        product_info[target].post_date.strftime("%m-%d-%Y")))
 
 
 def has_apfs():
@@ -1086,33 +3273,1277 @@ def setup_logging(script_thread):
     logger.addHandler(log_fail)
 
 
+class MirrorRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves files from the mirror root by their URL path, ignoring the
+    ?source= query that caching server URLs carry. Supports single byte
+    Range requests."""
+    protocol_version = "HTTP/1.1"
+    server_version = "installinstallmacos-mirror"
+
+    def do_HEAD(self):
+        self.send_file(head=True)
+
+    def do_GET(self):
+        self.send_file()
+
+    def log_message(self, format, *args):
+        logger.debug("Mirror %s: %s" % (self.client_address[0],
+                                        format % args))
+
+    def local_path(self):
+        """Returns the file under the root for the request path, or None for
+        a path, or a symlink, that leads outside the root."""
+        path = urlparse.urlsplit(self.path)[2]
+        root_dir = os.path.realpath(self.server.root_dir)
+        local_path = os.path.realpath(
+            os.path.join(root_dir, urllib2.unquote(path).lstrip("/")))
+        if not local_path.startswith(root_dir + os.sep):
+            return None
+        return local_path
+
+    def send_file(self, head=False):
+        local_path = self.local_path()
+        if not local_path or not os.path.isfile(local_path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(local_path)
+        byte_range = parse_byte_range(self.headers.get("Range"), size)
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if byte_range:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range",
+                             "bytes %d-%d/%d" % (start, end, size))
+        else:
+            start, end = 0, size - 1
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if head or not size:
+            return
+        with open(local_path, "rb") as the_file:
+            the_file.seek(start)
+            remaining = end - start + 1
+            try:
+                while remaining > 0:
+                    chunk = the_file.read(min(MIRROR_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+            except socket.error as err:
+                logger.debug("Mirror client went away: %s" % err)
+
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server for a replicated working directory, one thread per
+    client."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, root_dir):
+        BaseHTTPServer.HTTPServer.__init__(self, address,
+                                           MirrorRequestHandler)
+        self.root_dir = root_dir
+
+
+class MeteredFile(object):
+    """Wraps a handler's output file, passing each write through the
+    server's meter in SIMULATION_CHUNK_SIZE pieces."""
+    def __init__(self, the_file, server):
+        self.the_file = the_file
+        self.server = server
+
+    def write(self, data):
+        for offset in range(0, len(data), SIMULATION_CHUNK_SIZE):
+            piece = buffer(data, offset, SIMULATION_CHUNK_SIZE)
+            self.server.meter(len(piece))
+            self.the_file.write(piece)
+
+    def __getattr__(self, name):
+        return getattr(self.the_file, name)
+
+
+class SimulationRequestHandler(MirrorRequestHandler):
+    """Mirror handler for a stand-in server with limited capacity. Requests
+    beyond the connection limit get a 503. A cache fills a missing file from
+    the origin named by the ?source= query before serving it."""
+    def setup(self):
+        MirrorRequestHandler.setup(self)
+        self.wfile = MeteredFile(self.wfile, self.server)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_file(self, head=False):
+        if not self.server.admit():
+            self.send_error(503)
+            return
+        started = time.time()
+        try:
+            if self.server.fills:
+                self.fill()
+            MirrorRequestHandler.send_file(self, head)
+        finally:
+            self.server.release(time.time() - started)
+
+    def fill(self):
+        query = urlparse.parse_qs(urlparse.urlsplit(self.path)[3])
+        local_path = self.local_path()
+        if not local_path or "source" not in query:
+            return
+        url = "http://" + query["source"][0] + urlparse.urlsplit(self.path)[2]
+        with self.server.fill_lock(local_path):
+            if os.path.isfile(local_path):
+                return
+            try:
+                replicate_url(None, url, None, root_dir=self.server.root_dir)
+            except ReplicationError as err:
+                logger.debug("Simulated cache could not fill %s: %s" %
+                             (url, err))
+                return
+        self.server.count("filled", os.path.getsize(local_path))
+
+
+class SimulationServer(MirrorServer):
+    """Stand-in caching server or origin for simulate_fleet, serving at
+    most connections requests and rate bytes per second at once. Counts
+    what it serves.
+    """
+    request_queue_size = SIMULATION_BACKLOG
+
+    def __init__(self, root_dir, connections=0, rate=0, fills=False):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           SimulationRequestHandler)
+        self.root_dir = root_dir
+        self.connections = connections
+        self.throttle = TransferThrottle(rate)
+        self.fills = fills
+        self.active = 0
+        self.counters = {"requests": 0, "rejected": 0, "sent": 0,
+                         "filled": 0, "peak_connections": 0}
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.fill_locks = {}
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def stop(self):
+        # shutdown waits for serve_forever, so only call it once started.
+        if self.thread.ident:
+            self.shutdown()
+        self.server_close()
+
+    def fill_lock(self, local_path):
+        """Returns the lock that makes one request at a time fill
+        local_path."""
+        with self.lock:
+            return self.fill_locks.setdefault(local_path, threading.Lock())
+
+    def admit(self):
+        with self.lock:
+            self.counters["requests"] += 1
+            if self.connections and self.active >= self.connections:
+                self.counters["rejected"] += 1
+                return False
+            self.active += 1
+            self.counters["peak_connections"] = max(
+                self.counters["peak_connections"], self.active)
+            return True
+
+    def release(self, latency):
+        with self.lock:
+            self.active -= 1
+            self.latencies.append(latency)
+
+    def meter(self, count):
+        self.throttle.consume(count)
+        self.count("sent", count)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def report(self, elapsed):
+        with self.lock:
+            report = dict(self.counters)
+            report["latency"] = percentiles(self.latencies)
+        report["throughput"] = report["sent"] / max(elapsed, 1e-6)
+        return report
+
+
+def parse_byte_range(header, size):
+    """Parses a single range Range header. Returns None for no range, False
+    for a range that cannot be satisfied, or a (start, end) tuple."""
+    if not header or not header.startswith("bytes="):
+        return None
+    spec = header[len("bytes="):].split(",")[0].strip()
+    try:
+        first, last = spec.split("-", 1)
+        if not first:
+            start = max(size - int(last), 0)
+            end = size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+class CassetteRecorder(object):
+    """Object that records the HTTP responses of a run into a cassette
+    directory: their status, size and timing profile in CASSETTE_FILE, and
+    their bodies under bodies/. Catalogs, metadata and dist files are kept
+    whole; large packages are kept as their size only. One entry is kept per
+    URL, preferring a complete response.
+    """
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.body_dir = os.path.join(root_dir, "bodies")
+        if not os.path.exists(self.body_dir):
+            os.makedirs(self.body_dir)
+        self.started = time.time()
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def wrap(self, url, response, latency, ranged=False):
+        """Returns response wrapped so its body is recorded as it is
+        read."""
+        return RecordingResponse(self, url, response, latency, ranged)
+
+    def record_error(self, url, status, latency):
+        host, path = urlparse.urlsplit(url)[1:3]
+        self.add({"host": host, "path": path, "status": status,
+                  "latency": latency, "size": 0, "wire_bytes": 0,
+                  "samples": [], "body": None,
+                  "started": time.time() - latency - self.started}, False)
+
+    def add(self, entry, complete):
+        key = (entry["host"], entry["path"])
+        with self.lock:
+            if complete or key not in self.entries:
+                self.entries[key] = entry
+
+    def save(self):
+        """Writes CASSETTE_FILE and drops the bodies of unfinished
+        responses."""
+        with self.lock:
+            entries = sorted(self.entries.values(),
+                             key=lambda entry: entry["started"])
+        for temp_path in glob.glob(os.path.join(self.body_dir, "*.tmp")):
+            os.remove(temp_path)
+        path = os.path.join(self.root_dir, CASSETTE_FILE)
+        with open(path + ".tmp", "w") as the_file:
+            json.dump({"recorded": format_post_date(
+                datetime.datetime.utcfromtimestamp(self.started)),
+                "entries": entries}, the_file, indent=1, sort_keys=True)
+        os.rename(path + ".tmp", path)
+        logger.info("Recorded %d responses to %s" % (len(entries), path))
+
+
+class RecordingResponse(object):
+    """Wraps a urllib2 response for CassetteRecorder. Reads pass straight
+    through; the wire bytes are sampled over time, and a kept body is
+    written decoded, as the run stores it.
+    """
+    def __init__(self, recorder, url, response, latency, ranged):
+        self.recorder = recorder
+        self.response = response
+        self.host, self.path = urlparse.urlsplit(url)[1:3]
+        self.latency = latency
+        self.status = response.getcode()
+        self.opened = time.time()
+        self.wire_bytes = 0
+        self.body_bytes = 0
+        self.samples = []
+        self.last_sample = self.opened
+        self.done = False
+        content_range = response.headers.get("content-range", "")
+        self.size = int(content_range.rsplit("/", 1)[1] if content_range
+                        else response.headers.get("content-length") or 0)
+        encoding = response.headers.get("content-encoding", "").lower()
+        self.decoder = (StreamDecoder(encoding)
+                        if encoding in ("gzip", "deflate") else None)
+        self.body_file = None
+        if (self.status == 200 and not ranged and (
+                is_compressible(url) or self.size <= CASSETTE_BODY_LIMIT)):
+            self.body_name = hashlib.sha1(self.host + self.path).hexdigest()
+            self.temp_path = os.path.join(recorder.body_dir, "%s.%d.tmp" % (
+                self.body_name, id(self)))
+            self.body_file = open(self.temp_path, "wb")
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def read(self, amount=-1):
+        chunk = self.response.read(amount) if amount >= 0 else (
+            self.response.read())
+        now = time.time()
+        self.wire_bytes += len(chunk)
+        if self.body_file:
+            data = self.decoder.decompress(chunk) if self.decoder else chunk
+            self.body_file.write(data)
+            self.body_bytes += len(data)
+        if now - self.last_sample >= CASSETTE_SAMPLE_INTERVAL:
+            self.last_sample = now
+            self.samples.append([now - self.opened, self.wire_bytes])
+        if not chunk and not self.done:
+            self.finish(now)
+        return chunk
+
+    def finish(self, now):
+        self.done = True
+        self.samples.append([now - self.opened, self.wire_bytes])
+        body = None
+        if self.body_file:
+            if self.decoder:
+                data = self.decoder.flush()
+                self.body_file.write(data)
+                self.body_bytes += len(data)
+            self.body_file.close()
+            body = self.body_name
+            os.rename(self.temp_path,
+                      os.path.join(self.recorder.body_dir, body))
+            self.size = self.body_bytes
+        self.recorder.add({
+            "host": self.host, "path": self.path, "status": self.status,
+            "latency": self.latency, "size": self.size,
+            "wire_bytes": self.wire_bytes, "samples": self.samples,
+            "body": body, "started": self.opened - self.latency -
+            self.recorder.started,
+        }, self.status == 200)
+
+
+def start_cassette_recording(arguments):
+    """Records every response of this run into --record-cassette, if given,
+    saving the cassette when the process exits."""
+    global CASSETTE_RECORDER
+    if not arguments.record_cassette:
+        return None
+    CASSETTE_RECORDER = CassetteRecorder(arguments.record_cassette)
+    atexit.register(CASSETTE_RECORDER.save)
+    return CASSETTE_RECORDER
+
+
+class CassetteRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves a cassette entry by /host/path after its recorded latency,
+    pacing the body along its recorded timing profile. Supports single byte
+    Range requests."""
+    protocol_version = "HTTP/1.1"
+    server_version = "installinstallmacos-replay"
+
+    def do_HEAD(self):
+        self.send_entry(head=True)
+
+    def do_GET(self):
+        self.send_entry()
+
+    def log_message(self, format, *args):
+        logger.debug("Replay %s: %s" % (self.client_address[0],
+                                        format % args))
+
+    def send_entry(self, head=False):
+        host, _, path = urlparse.urlsplit(self.path)[2][1:].partition("/")
+        key = (host, "/" + path)
+        entry = self.server.entries.get(key)
+        if entry is None:
+            self.send_error(404)
+            return
+        time.sleep(entry["latency"])
+        if entry["status"] >= 400:
+            self.send_error(entry["status"])
+            return
+        size = entry["size"]
+        byte_range = parse_byte_range(self.headers.get("Range"), size)
+        if byte_range is False:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if byte_range:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range",
+                             "bytes %d-%d/%d" % (start, end, size))
+        else:
+            start, end = 0, size - 1
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if head or not size:
+            return
+        body = self.server.bodies.get(key)
+        started = time.time()
+        offset_time = self.server.time_at(entry, start)
+        offset = start
+        try:
+            while offset <= end:
+                count = min(CASSETTE_CHUNK_SIZE, end - offset + 1)
+                delay = (self.server.time_at(entry, offset + count) -
+                         offset_time - (time.time() - started))
+                if delay > 0:
+                    time.sleep(delay)
+                if body is not None:
+                    self.wfile.write(buffer(body, offset, count))
+                else:
+                    self.wfile.write(self.server.filler(offset, count))
+                offset += count
+        except socket.error as err:
+            logger.debug("Replay client went away: %s" % err)
+
+
+class CassetteServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server for a recorded cassette on this host. Every recorded URL
+    is served at /host/path, and the URLs inside kept catalogs, metadata
+    and dist files are rewritten to point here, so a run against the
+    replay never leaves the machine.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root_dir, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", port),
+                                           CassetteRequestHandler)
+        self.base_url = "http://127.0.0.1:%d" % self.server_address[1]
+        with open(os.path.join(root_dir, CASSETTE_FILE)) as the_file:
+            cassette = json.load(the_file)
+        self.entries = dict([((entry["host"], entry["path"]), entry)
+                             for entry in cassette["entries"]])
+        for entry in self.entries.values():
+            entry["times"] = [0.0] + [sample[0]
+                                      for sample in entry["samples"]]
+            entry["counts"] = [0] + [sample[1]
+                                     for sample in entry["samples"]]
+        # Filler for bodies that were not kept. Its content only depends on
+        # the offset, so resumed downloads line up.
+        self.filler_block = hashlib.sha512("filler").digest() * (
+            CASSETTE_CHUNK_SIZE // 64)
+        self.bodies = {}
+        for key, entry in self.entries.items():
+            if not entry["body"]:
+                continue
+            with open(os.path.join(root_dir, "bodies", entry["body"]),
+                      "rb") as the_file:
+                body = the_file.read()
+            if entry["path"].endswith(".sucatalog"):
+                body = self.drop_filler_digests(body)
+            if is_compressible(entry["path"]):
+                body = re.sub(r"https?://([^/\s<>\"']+)/",
+                              self.base_url + r"/\1/", body)
+            self.bodies[key] = body
+            entry["size"] = len(body)
+
+    def drop_filler_digests(self, body):
+        """Removes the digests of packages replayed as filler from a
+        catalog, as filler can never match them."""
+        try:
+            catalog = plistlib.readPlistFromString(body)
+        except ExpatError:
+            return body
+        for product in catalog.get("Products", {}).values():
+            for package in product.get("Packages", []):
+                url = urlparse.urlsplit(package.get("URL", ""))
+                entry = self.entries.get((url[1], url[2]))
+                if entry and not entry["body"]:
+                    package.pop("Digest", None)
+        return plistlib.writePlistToString(catalog)
+
+    def time_at(self, entry, position):
+        """Returns the seconds into its recorded transfer at which the
+        response had delivered position bytes of its body."""
+        if not entry["samples"] or not entry["size"]:
+            return 0.0
+        wire = float(position) / entry["size"] * entry["wire_bytes"]
+        times, counts = entry["times"], entry["counts"]
+        index = bisect.bisect_left(counts, wire)
+        if index >= len(counts):
+            return times[-1]
+        if not index or counts[index] == counts[index - 1]:
+            return times[index]
+        share = (wire - counts[index - 1]) / (counts[index] -
+                                              counts[index - 1])
+        return times[index - 1] + share * (times[index] - times[index - 1])
+
+    def filler(self, offset, count):
+        start = offset % len(self.filler_block)
+        return (self.filler_block * 2)[start:start + count]
+
+
+def replay_cassette(arguments):
+    """Serve a recorded cassette on this host until interrupted."""
+    server = CassetteServer(arguments.replay_cassette, arguments.replay_port)
+    catalogs = sorted(["%s/%s%s" % (server.base_url, host, path)
+                       for host, path in server.entries
+                       if path.endswith(".sucatalog")])
+    logger.info("Replaying %d responses from %s on %s. Run with %s" % (
+        len(server.entries), arguments.replay_cassette, server.base_url,
+        " ".join(["--catalogurl " + url for url in catalogs])))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def serve_mirror(arguments):
+    """Serve the working directory to other Macs until interrupted."""
+    # The default working directory is all of /private/tmp.
+    if (os.path.realpath(arguments.workdir) ==
+            os.path.realpath(DEFAULT_WORKING_DIR)):
+        logger.log(FAIL, "Pass --workdir with the directory to serve. "
+                   "--serve-mirror will not serve %s." % DEFAULT_WORKING_DIR)
+        sys.exit(1)
+    server = MirrorServer((arguments.mirror_address, arguments.serve_mirror),
+                          arguments.workdir)
+    logger.info("Serving %s as a mirror on port %d. Point other Macs at it "
+                "with --caching-server http://<this host>:%d" % (
+                    arguments.workdir, server.server_address[1],
+                    server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def build_simulation_origin(root_dir, base_url, package_count, package_size):
+    """Writes a catalog with one macOS installer of package_count packages
+    of package_size bytes under root_dir, with URLs under base_url. Returns
+    the catalog URL."""
+    product_key = "SIM-00001"
+    product_dir = os.path.join(root_dir, "content", product_key)
+    os.makedirs(product_dir)
+    product_url = base_url + "/content/" + product_key
+    block = os.urandom(min(package_size, 1048576) or 1)
+    packages = []
+    for number in range(package_count):
+        name = "Package%d.pkg" % number
+        with open(os.path.join(product_dir, name), "wb") as the_file:
+            remaining = package_size
+            while remaining > 0:
+                the_file.write(block[:remaining])
+                remaining -= len(block)
+        with open(os.path.join(product_dir, name[:-4] + ".pkm"), "w") as pkm:
+            pkm.write("<pkm/>")
+        packages.append({"URL": product_url + "/" + name,
+                         "MetadataURL": product_url + "/" + name[:-4] +
+                         ".pkm",
+                         "Size": package_size})
+    plistlib.writePlist({
+        "CFBundleShortVersionString": "10.15.7",
+        "localization": {"English": {"title": "macOS Simulation"}},
+    }, os.path.join(product_dir, product_key + ".smd"))
+    with open(os.path.join(product_dir, "English.dist"), "w") as dist:
+        dist.write(
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<installer-gui-script minSpecVersion="1">\n'
+            '<auxinfo><dict><key>BUILD</key><string>19H2</string>'
+            '<key>VERSION</key><string>10.15.7</string></dict></auxinfo>\n'
+            "<script>\nvar nonSupportedModels = ['Simulated1,1'];\n"
+            "</script>\n" +
+            "".join(['<pkg-ref id="p%d">#%s</pkg-ref>\n' % (
+                number, os.path.basename(package["URL"]))
+                for number, package in enumerate(packages)]) +
+            "</installer-gui-script>\n")
+    plistlib.writePlist({"Products": {product_key: {
+        "ServerMetadataURL": product_url + "/" + product_key + ".smd",
+        "PostDate": datetime.datetime.utcnow().replace(microsecond=0),
+        "Distributions": {"English": product_url + "/English.dist"},
+        "Packages": packages,
+        "ExtendedMetaInfo": {"InstallAssistantPackageIdentifiers": {
+            "OSInstall": "com.apple.mpkg.OSInstall"}},
+    }}}, os.path.join(root_dir, "index.sucatalog"))
+    return base_url + "/index.sucatalog"
+
+
+def simulate_client(arguments):
+    """Runs one simulated Mac: parses the catalog and downloads the newest
+    installer through arguments.caching_server, as a prefetch would.
+    Returns a dict of its outcome."""
+    started = time.time()
+    result = {"ok": False}
+    try:
+        installer = MakeInstaller(arguments,
+                                  script_thread=ScriptThread(arguments))
+        installer.software_catalog.start_parsing()
+        product_info = installer.software_catalog.product_info
+        product_key = sorted(product_info,
+                             key=lambda key: product_info[key].post_date)[-1]
+        installer.target_version = product_key
+        installer.replicate_product()
+        # The stand-in packages are not signed, so only their sizes are
+        # checked here.
+        result["failures"] = len([
+            package for package in installer.product.packages
+            if "URL" in package and verify_package(package, local_path_for_url(
+                package["URL"], arguments.workdir))])
+        result["ok"] = not result["failures"]
+    except Exception as err:
+        result["error"] = "%s: %s" % (type(err).__name__, err)
+    result["elapsed"] = time.time() - started
+    result["stats"] = TRANSFER_STATS.counters
+    return result
+
+
+def fork_simulated_client(arguments):
+    """Runs simulate_client in a child process, which has its own circuit
+    breakers and transfer stats like a separate Mac would. Returns the pid
+    and a pipe that receives the result as JSON."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(write_fd)
+        return pid, os.fdopen(read_fd)
+    global CATALOG_INDEX_DIR, CIRCUIT_BREAKERS, TRANSFER_STATS, RUN_METRICS
+    global CASSETTE_RECORDER
+    os.close(read_fd)
+    try:
+        # Another thread may have held the parent's locks at the fork.
+        CIRCUIT_BREAKERS = CircuitBreakers()
+        TRANSFER_STATS = TransferStats()
+        RUN_METRICS = RunMetrics()
+        CASSETTE_RECORDER = None
+        CATALOG_INDEX_DIR = os.path.join(arguments.workdir, "catalogs")
+        logging.disable(logging.CRITICAL)
+        result = simulate_client(arguments)
+        shutil.rmtree(arguments.workdir, True)
+        os.write(write_fd, json.dumps(result))
+    finally:
+        os._exit(0)
+
+
+def percentiles(values):
+    """Returns the median, 95th and 99th percentiles and maximum of
+    values."""
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def percentile(fraction):
+        return values[min(int(math.ceil(fraction * len(values))) - 1,
+                          len(values) - 1)]
+
+    return {"p50": percentile(0.5), "p95": percentile(0.95),
+            "p99": percentile(0.99), "max": values[-1]}
+
+
+def simulate_fleet(arguments, clients, cache=(0, 0), origin=(0, 0),
+                   ramp=0, package_count=SIMULATION_PACKAGES,
+                   package_size=SIMULATION_PACKAGE_SIZE):
+    """Runs clients simulated Macs at once against a stand-in caching server
+    and origin on this host. cache and origin are (connections, KB per
+    second) capacities, 0 meaning unlimited. The clients start evenly over
+    ramp seconds and use the transfer settings in arguments. Returns a
+    report of throughput, latency and fallbacks."""
+    root_dir = tempfile.mkdtemp(prefix="installinstallmacos-simulation.")
+    origin_server = SimulationServer(os.path.join(root_dir, "origin"),
+                                     origin[0], origin[1] * 1024)
+    cache_server = SimulationServer(os.path.join(root_dir, "cache"),
+                                    cache[0], cache[1] * 1024, fills=True)
+    try:
+        catalog_url = build_simulation_origin(
+            origin_server.root_dir, origin_server.url(), package_count,
+            package_size)
+        os.makedirs(cache_server.root_dir)
+        origin_server.thread.start()
+        cache_server.thread.start()
+        started = time.time()
+        children = []
+        for number in range(clients):
+            client_arguments = copy.copy(arguments)
+            client_arguments.catalogurl = [catalog_url]
+            client_arguments.seedprogram = None
+            client_arguments.aggregate_catalogs = False
+            client_arguments.caching_server = cache_server.url()
+            client_arguments.workdir = os.path.join(
+                root_dir, "client%d" % number)
+            client_arguments.cache_max_age = 0
+            client_arguments.prefetch_window = None
+            client_arguments.incremental = False
+            client_arguments.list_changes = False
+            client_arguments.list_installers = False
+            client_arguments.profile = False
+            children.append(fork_simulated_client(client_arguments))
+            if ramp and clients > 1:
+                time.sleep(float(ramp) / (clients - 1))
+        results = []
+        for pid, the_pipe in children:
+            with the_pipe:
+                output = the_pipe.read()
+            os.waitpid(pid, 0)
+            results.append(json.loads(output) if output else
+                           {"ok": False, "error": "client crashed",
+                            "stats": {}})
+        elapsed = time.time() - started
+    finally:
+        cache_server.stop()
+        origin_server.stop()
+    shutil.rmtree(root_dir, True)
+    stats = TransferStats()
+    for result in results:
+        for name, amount in result["stats"].items():
+            stats.count(name, amount)
+    cache_report = cache_server.report(elapsed)
+    origin_report = origin_server.report(elapsed)
+    # Bytes the origin sent to fill the cache never reached a client.
+    delivered = (cache_report["sent"] + origin_report["sent"] -
+                 cache_report["filled"])
+    return {
+        "clients": clients,
+        "completed": len([result for result in results if result["ok"]]),
+        "errors": sorted(set([result["error"] for result in results
+                              if "error" in result])),
+        "elapsed": elapsed,
+        "throughput": delivered / max(elapsed, 1e-6),
+        "client_time": percentiles([result["elapsed"]
+                                    for result in results]),
+        "fallback_rate": stats.counters.get("fallbacks", 0) /
+        float(max(clients * package_count, 1)),
+        "transfer_stats": stats.counters,
+        "cache": cache_report,
+        "origin": origin_report,
+    }
+
+
+def run_fleet_simulation(arguments):
+    """Print the report of --simulate-fleet as JSON, and a summary to the
+    log."""
+    report = simulate_fleet(arguments, arguments.simulate_fleet,
+                            cache=arguments.simulate_cache,
+                            origin=arguments.simulate_origin,
+                            ramp=arguments.simulate_ramp)
+    sys.stdout.write(json.dumps(report, indent=2, sort_keys=True) + "\n")
+    logger.log(OLVL, "%d of %d simulated clients completed in %s at %s/s. "
+               "Client time p95 %.1fs, fallback rate %.1f%%." % (
+                   report["completed"], report["clients"],
+                   convert_duration(report["elapsed"]),
+                   convert_size(report["throughput"]),
+                   report["client_time"].get("p95", 0),
+                   report["fallback_rate"] * 100))
+
+
+def progress_event(snapshot):
+    """Returns the event for a ProgressModel snapshot, with the overall
+    progress as a percentage for readers that want one number."""
+    return {"event": "progress", "progress": snapshot,
+            "percent": round(100 * snapshot["overall"] /
+                             PROGRESS_BAR_MAX_VALUE, 1)}
+
+
+class ProgressStream(object):
+    """Object that writes events as compact newline-delimited JSON, in the
+    same shape the daemon sends them, to stdout (-), a UNIX socket
+    (unix:PATH), a TCP socket (tcp:HOST:PORT) or a file. A destination that
+    goes away ends the stream, not the run.
+
+    The events are written by a background thread, so a slow reader never
+    holds up the transfers. Events that do not fit in the queue are dropped
+    and counted in a dropped event. A socket that takes nothing for
+    PROGRESS_STREAM_TIMEOUT seconds ends the stream.
+    """
+    def __init__(self, destination):
+        self.destination = destination
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue(PROGRESS_STREAM_QUEUE_SIZE)
+        self.dropped = 0
+        self.ended = False
+        if destination == "-":
+            self.the_file = sys.stdout
+        elif destination.startswith("unix:"):
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.settimeout(PROGRESS_STREAM_TIMEOUT)
+            client.connect(destination[len("unix:"):])
+            self.the_file = client.makefile("w")
+        elif destination.startswith("tcp:"):
+            host, port = destination[len("tcp:"):].rsplit(":", 1)
+            self.the_file = socket.create_connection(
+                (host, int(port)), PROGRESS_STREAM_TIMEOUT).makefile("w")
+        else:
+            self.the_file = open(destination, "a")
+        self.thread = threading.Thread(target=self._writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, event):
+        """Queues one event. Returns False once the stream has ended."""
+        if self.ended:
+            return False
+        line = json.dumps(event, separators=(",", ":"), default=str) + "\n"
+        try:
+            self.queue.put_nowait(line)
+        except Queue.Full:
+            with self.lock:
+                self.dropped += 1
+        return True
+
+    def close(self):
+        """Writes out the queued events, waiting no longer than
+        PROGRESS_STREAM_TIMEOUT seconds for them, and closes the
+        destination."""
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=PROGRESS_STREAM_TIMEOUT)
+            except Queue.Full:
+                pass
+            self.thread.join(PROGRESS_STREAM_TIMEOUT)
+        self.ended = True
+        if self.the_file is not sys.stdout:
+            try:
+                self.the_file.close()
+            except (IOError, socket.error):
+                pass
+
+    def _writer(self):
+        while True:
+            line = self.queue.get()
+            if line is None:
+                return
+            with self.lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                line = json.dumps({"event": "dropped", "count": dropped},
+                                  separators=(",", ":")) + "\n" + line
+            try:
+                self.the_file.write(line)
+                self.the_file.flush()
+            except (IOError, socket.error) as err:
+                # socket.timeout is a socket.error.
+                logger.debug("Progress stream %s ended: %s" % (
+                    self.destination, err))
+                self.ended = True
+                return
+
+
+def start_progress_stream(arguments, script_thread):
+    """Sends the progress, status texts and errors of script_thread to
+    --progress-stream, if given. Without a GUI, the log is wired to the
+    script thread the way the GUI wires it."""
+    if not arguments.progress_stream:
+        return None
+    try:
+        progress_stream = ProgressStream(arguments.progress_stream)
+    except (IOError, socket.error, ValueError) as err:
+        logger.error("Could not open progress stream %s: %s" % (
+            arguments.progress_stream, err))
+        sys.exit(1)
+    script_thread.progress_stream = progress_stream
+    if not script_thread.gui:
+        setup_logging(script_thread)
+    atexit.register(progress_stream.close)
+    return progress_stream
+
+
+class ClientLogHandler(logging.Handler):
+    """Handler that sends log records to a daemon client as events. Only the
+    records of the thread that creates it, and of the worker threads named
+    after it, are sent, so other clients and the catalog refresh do not leak
+    into the job's stream.
+    """
+    def __init__(self, send, level=SLVL):
+        logging.Handler.__init__(self, level)
+        self.send = send
+        self.thread_name = threading.current_thread().name
+
+    def filter(self, record):
+        if (record.threadName != self.thread_name and
+                not record.threadName.startswith(self.thread_name + "/")):
+            return False
+        return logging.Handler.filter(self, record)
+
+    def emit(self, record):
+        self.send({"event": "log", "level": record.levelname,
+                   "message": record.getMessage()})
+
+
+class DaemonScriptThread(ScriptThread):
+    """ScriptThread for one daemon command. Progress goes to the client that
+    sent the command, and a client that hangs up cancels the transfers.
+    """
+    def __init__(self, arguments, send):
+        self.send = send
+        ScriptThread.__init__(self, arguments)
+
+    def show_progress(self, snapshot):
+        ScriptThread.show_progress(self, snapshot)
+        if not self.send(progress_event(snapshot)):
+            self.cancel_event.set()
+
+    def close(self):
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+
+
+class InstallerDaemon(object):
+    """Object that keeps a parsed catalog between commands and refreshes it
+    in the background. Commands that download run one at a time; listing
+    only reads the catalog and never waits for them.
+    """
+    def __init__(self, arguments):
+        self.arguments = arguments
+        self.software_catalog = None
+        self.lock = threading.Lock()
+        self.job_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def refresh(self):
+        script_thread = DaemonScriptThread(self.arguments, lambda event: True)
+        try:
+            installer = MakeInstaller(self.arguments,
+                                      script_thread=script_thread)
+            installer.software_catalog.start_parsing()
+        finally:
+            script_thread.close()
+        with self.lock:
+            self.software_catalog = installer.software_catalog
+        logger.info("Catalog refreshed: %d installers." %
+                    len(installer.software_catalog.product_info))
+
+    def refresh_loop(self):
+        interval = max(self.arguments.cache_max_age, DAEMON_MIN_REFRESH)
+        while not self.stopped.wait(interval):
+            try:
+                self.refresh()
+            except (Exception, SystemExit):
+                logger.exception("Catalog refresh failed.")
+
+    def run(self, request, send):
+        """Runs one command for a client. Returns its result, which is sent
+        back as JSON."""
+        command = request.get("command")
+        if command not in DAEMON_COMMANDS:
+            raise ValueError("Unknown command: %s" % command)
+        with self.lock:
+            software_catalog = self.software_catalog
+        if command == "list":
+            return installer_listing(software_catalog)
+        if command in ("stage", "install") and os.getuid() != 0:
+            raise ValueError("%s requires elevated privileges." % command)
+        target_version = request.get("target_version") or None
+        if target_version is not None and (
+                not isinstance(target_version, list) or
+                not all([isinstance(version, basestring)
+                         for version in target_version])):
+            raise ValueError("target_version must be a list of strings.")
+        arguments = copy.copy(self.arguments)
+        arguments.target_version = target_version
+        script_thread = DaemonScriptThread(arguments, send)
+        log_client = ClientLogHandler(send)
+        with self.job_lock:
+            logger.addHandler(log_client)
+            try:
+                return self.run_job(command, arguments, script_thread,
+                                    software_catalog)
+            finally:
+                logger.removeHandler(log_client)
+                script_thread.close()
+
+    def run_job(self, command, arguments, script_thread, software_catalog):
+        installer = MakeInstaller(arguments, script_thread=script_thread)
+        installer.software_catalog = software_catalog
+        script_thread.progress.finish_phase("catalog")
+        targets = choose_targets(installer, arguments, script_thread)
+        if command == "install" and len(targets) > 1:
+            raise ValueError("install takes a single target version.")
+        installer.replicate_products([key for key, _ in targets])
+        result = {"products": [key for key, _ in targets],
+                  "damaged": [url for url, _ in installer.staging_failures]}
+        if command == "prefetch":
+            return result
+        for product_key, version_string in targets:
+            logger.log(OLVL, "Creating %s installer in Applications "
+                       "folder..." % version_string)
+            installer.select_product(product_key)
+            installer.install_product()
+        script_thread.progress.finish_phase("install")
+        if command == "install":
+            installer.launch_osinstall()
+        return result
+
+
+class DaemonRequestHandler(SocketServer.StreamRequestHandler):
+    """Runs one command per connection. The request is a line of JSON and
+    the reply is a stream of JSON lines that ends with a done or error
+    event."""
+    def handle(self):
+        self.send_lock = threading.Lock()
+        self.connected = True
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+        except ValueError as err:
+            self.send({"event": "error", "message": "Bad request: %s" % err})
+            return
+        try:
+            result = self.server.installer_daemon.run(request, self.send)
+        except SystemExit:
+            self.send({"event": "error", "message": "Command failed."})
+            return
+        except Exception as err:
+            logger.exception("Daemon command failed.")
+            self.send({"event": "error", "message": str(err)})
+            return
+        self.send({"event": "done", "result": result})
+
+    def finish(self):
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            # The client hung up before the reply was flushed.
+            pass
+
+    def send(self, event):
+        """Sends an event to the client. Returns False once the client has
+        gone away."""
+        with self.send_lock:
+            if not self.connected:
+                return False
+            try:
+                self.wfile.write(json.dumps(event, default=str) + "\n")
+                self.wfile.flush()
+            except socket.error:
+                self.connected = False
+            return self.connected
+
+
+class DaemonServer(SocketServer.ThreadingMixIn,
+                   SocketServer.UnixStreamServer):
+    """Control socket server for --daemon, one thread per client. The
+    socket is only accessible to the user running the daemon."""
+    daemon_threads = True
+
+    def __init__(self, path, installer_daemon):
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                # Left behind by a daemon that did not shut down cleanly.
+                os.remove(path)
+            else:
+                raise ReplicationError("A daemon is already listening on " +
+                                       path)
+            finally:
+                probe.close()
+        old_umask = os.umask(0o177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path,
+                                                   DaemonRequestHandler)
+        finally:
+            os.umask(old_umask)
+        self.installer_daemon = installer_daemon
+
+
+def run_daemon(arguments):
+    """Keep the catalog parsed and run commands sent to the control socket
+    until interrupted."""
+    if not arguments.caching_server:
+        arguments.caching_server = discover_caching_server()
+    # startosinstall signals the pid that launched it when it is done. The
+    # daemon keeps running until the Mac restarts.
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    installer_daemon = InstallerDaemon(arguments)
+    installer_daemon.refresh()
+    refresher = threading.Thread(target=installer_daemon.refresh_loop)
+    refresher.daemon = True
+    refresher.start()
+    server = DaemonServer(arguments.daemon_socket, installer_daemon)
+    logger.info("Daemon listening on %s" % arguments.daemon_socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        installer_daemon.stopped.set()
+        server.server_close()
+        os.remove(arguments.daemon_socket)
+
+
+def daemon_client(arguments):
+    """Send a command to a running daemon and print its log and progress as
+    they arrive. Returns the exit status."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(arguments.daemon_socket)
+    except socket.error as err:
+        logger.error("Could not reach the daemon at %s: %s" % (
+            arguments.daemon_socket, err))
+        return 1
+    client.sendall(json.dumps({"command": arguments.send,
+                               "target_version": arguments.target_version}) +
+                   "\n")
+    status = 1
+    shown = None
+    for line in client.makefile():
+        event = json.loads(line)
+        if event["event"] == "log":
+            sys.stderr.write(event["message"] + "\n")
+        elif event["event"] == "progress":
+            percent = int(event["progress"]["overall"])
+            if percent != shown:
+                shown = percent
+                sys.stderr.write("Progress: %d%%\n" % percent)
+        elif event["event"] == "done":
+            sys.stdout.write(json.dumps(event["result"], indent=2,
+                                        sort_keys=True) + "\n")
+            status = 0
+        elif event["event"] == "error":
+            logger.log(FAIL, event["message"])
+    client.close()
+    return status
+
+
 def get_arguments():
     # Returns the results of the argparse module reading argv.
     parser = argparse.ArgumentParser()
     parser.add_argument("--show-gui", default=True,
                         help="Whether or not to show GUI to logged in user.")
-    parser.add_argument("--catalogurl", default="",
+    parser.add_argument("--catalogurl", action="append",
                         help="Software Update catalog URL. This option "
-                        "overrides any seedprogram option.")
+                        "overrides any seedprogram option unless "
+                        "--aggregate-catalogs is set. May be given more "
+                        "than once to read several catalogs.")
+    parser.add_argument("--seedprogram", action="append",
+                        help="Read the catalog of this seed program, e.g. "
+                        "PublicSeed. May be given more than once.")
+    parser.add_argument("--aggregate-catalogs", action="store_true",
+                        help="Read the default catalog and every seed "
+                        "program catalog together with any --catalogurl.")
     parser.add_argument("--workdir", metavar="path_to_working_dir",
                         default=DEFAULT_WORKING_DIR,
                         help="Path to working directory on a volume with over "
                         "over 10G of available space. Defaults to current "
                         "working directory.")
-    parser.add_argument("--target-version",
+    parser.add_argument("--target-version", action="append",
                         help="Choose which version of macOS to target. "
                         "The latest version will be automatically "
-                        "selected.")
+                        "selected. May be given more than once with "
+                        "--installer-only or --prefetch to stage several "
+                        "versions in one run.")
     parser.add_argument("--erase-install", default=False,
                         help="Choose whether or not to erase the disk "
                         "when installing macOS. Dangerous!")
     parser.add_argument("--caching-server",
-                        help="Specify a caching server (optional)")
+                        help="Specify a caching server (optional). Use "
+                        "http://host:port for a --serve-mirror server.")
     parser.add_argument("--installer-only", default=False,
                         help="Only create the installer.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only download product info for installers "
+                        "that are new or changed since the last run.")
+    parser.add_argument("--list-changes", action="store_true",
+                        help="Print the installers added, changed or removed "
+                        "since the last run as JSON and exit.")
+    parser.add_argument("--list", dest="list_installers", action="store_true",
+                        help="Print the available macOS installers as JSON "
+                        "and exit.")
+    parser.add_argument("--launch-delay", type=int, default=15,
+                        help="Seconds to wait before starting "
+                        "startosinstall. May be 0.")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="Download the target version into the working "
+                        "directory at low priority and exit without "
+                        "installing.")
+    parser.add_argument("--bandwidth-limit", type=int, default=0,
+                        metavar="KBPS",
+                        help="Limit downloads to this many KB per second.")
+    parser.add_argument("--prefetch-window", action="append",
+                        type=parse_time_window, metavar="HH:MM-HH:MM",
+                        help="Only download during this time of day. May be "
+                        "given more than once.")
+    parser.add_argument("--serve-mirror", type=int, metavar="PORT",
+                        help="Serve the working directory over HTTP on this "
+                        "port so other Macs can use it as a caching server.")
+    parser.add_argument("--mirror-address", default="127.0.0.1",
+                        help="Address the mirror server listens on. Use "
+                        "0.0.0.0 to serve other Macs.")
+    parser.add_argument("--transfer-engine", choices=["serial", "pool"],
+                        default="serial",
+                        help="serial downloads one file at a time. pool "
+                        "downloads several at once, with a per-host limit "
+                        "and timeouts.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile each stage and write pstats files and "
+                        "allocation reports next to the log.")
+    parser.add_argument("--cache-max-age", type=int, default=CATALOG_MAX_AGE,
+                        help="Seconds a downloaded catalog and its product "
+                        "metadata are reused before they are downloaded "
+                        "again. 0 always downloads them.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep the catalog parsed, refresh it every "
+                        "--cache-max-age seconds, and run commands sent to "
+                        "--daemon-socket until interrupted.")
+    parser.add_argument("--daemon-socket", default=DAEMON_SOCKET,
+                        metavar="PATH",
+                        help="Control socket of the daemon.")
+    parser.add_argument("--metrics-file", metavar="PATH",
+                        help="Keep a Prometheus text format file of the "
+                        "run's progress, throughput, retries, cache hits "
+                        "and stage durations at this path, rewritten every "
+                        "%d seconds." % METRICS_INTERVAL)
+    parser.add_argument("--progress-stream", metavar="DESTINATION",
+                        help="Write progress, status and error events as "
+                        "newline-delimited JSON to - (stdout), unix:PATH, "
+                        "tcp:HOST:PORT or a file.")
+    parser.add_argument("--record-cassette", metavar="DIR",
+                        help="Record the status, timing and bodies of every "
+                        "HTTP response of this run into a cassette in DIR. "
+                        "Large package bodies are kept as their size only.")
+    parser.add_argument("--replay-cassette", metavar="DIR",
+                        help="Serve a recorded cassette on this host with "
+                        "its recorded latency and bandwidth until "
+                        "interrupted.")
+    parser.add_argument("--replay-port", type=int, default=0, metavar="PORT",
+                        help="Port --replay-cassette listens on. 0 picks a "
+                        "free port.")
+    parser.add_argument("--simulate-fleet", type=int, metavar="CLIENTS",
+                        help="Run this many simulated Macs at once against a "
+                        "stand-in caching server and origin on this host, "
+                        "using the transfer options given, and print a "
+                        "report of throughput, latency and fallbacks.")
+    parser.add_argument("--simulate-cache", type=parse_capacity,
+                        default=(0, 0), metavar="CONNECTIONS:KBPS",
+                        help="Capacity of the simulated caching server. 0 "
+                        "is unlimited.")
+    parser.add_argument("--simulate-origin", type=parse_capacity,
+                        default=(0, 0), metavar="CONNECTIONS:KBPS",
+                        help="Capacity of the simulated origin. 0 is "
+                        "unlimited.")
+    parser.add_argument("--simulate-ramp", type=float, default=0,
+                        metavar="SECONDS",
+                        help="Start the simulated Macs evenly over this many "
+                        "seconds instead of all at once.")
+    parser.add_argument("--send", choices=DAEMON_COMMANDS,
+                        help="Send a command to a running daemon and print "
+                        "its progress. Use --target-version to pick the "
+                        "products.")
 
     # Skip unknown arguments.
     arguments, _ = parser.parse_known_args()
+    if (arguments.target_version and len(arguments.target_version) > 1 and
+            not (arguments.installer_only or arguments.prefetch or
+                 arguments.send in ("prefetch", "stage"))):
+        parser.error("several --target-version values need --installer-only "
+                     "or --prefetch")
     logger.info(
         "Parsed Parameters: show-gui: " + str(arguments.show_gui) +
         " catalogurl: " + str(arguments.catalogurl) +
@@ -1123,17 +4554,49 @@ def get_arguments():
     return arguments
 
 
-def install_macos(arguments, script_thread):
-    """Install macOS Installer Application and Launch startosinstall."""
-    if arguments.erase_install == "ERASEINSTALL":
-        logger.log(OLVL, "Checking for APFS volumes...")
-        if not has_apfs():
-            logger.log(FAIL, "This computer does not have an APFS volume. " +
-                       "Please use a different method to wipe this machine.")
-            script_thread.end_application()
-        else:
-            logger.log(OLVL, "APFS Present!")
-
+def list_changes(arguments, script_thread):
+    """Print the installer changes since the last snapshot as JSON."""
+    software_catalog = MakeInstaller(
+        arguments, script_thread=script_thread).software_catalog
+    software_catalog.start_parsing()
+    sys.stdout.write(json.dumps(
+        software_catalog.snapshot.changes(), indent=2, sort_keys=True) + "\n")
+
+
+def list_installers(arguments, script_thread):
+    """Print the macOS installers in the catalog as JSON."""
+    software_catalog = MakeInstaller(
+        arguments, script_thread=script_thread).software_catalog
+    software_catalog.start_parsing()
+    sys.stdout.write(json.dumps(installer_listing(software_catalog), indent=2,
+                                sort_keys=True) + "\n")
+
+
+def installer_listing(software_catalog):
+    """Returns the macOS installers of a parsed catalog, newest first."""
+    listing = []
+    for compatible, product_info in (
+            (True, software_catalog.product_info),
+            (False, software_catalog.incompatible_info)):
+        for product_key, product in product_info.items():
+            listing.append({
+                "product_id": product_key,
+                "title": product.title,
+                "version": product.version,
+                "build": product.build,
+                "PostDate": format_post_date(product.post_date),
+                "size": product.total_size,
+                "compatible": compatible,
+                "catalogs": list(product.catalogs),
+            })
+    listing.sort(key=lambda product: product["PostDate"], reverse=True)
+    return listing
+
+
+def resolve_products(arguments, script_thread):
+    """Parse the catalog and pick the products to download. Returns the
+    MakeInstaller and a list of (product key, human-readable name) for each
+    target, with the first one selected."""
     logger.log(OLVL, "Downloading list of latest macOS installers...")
 
     # Create an instance of the object that will hold all the data we need.
@@ -1142,9 +4605,19 @@ def install_macos(arguments, script_thread):
     logger.log(OLVL, "Parsing list...")
     installer.software_catalog.start_parsing()
 
-    script_thread.overall_progress(progress_percent(1))
+    script_thread.progress.finish_phase("catalog")
+    return installer, choose_targets(installer, arguments, script_thread)
+
 
-    if not installer.software_catalog.product_info:
+def choose_targets(installer, arguments, script_thread):
+    """Picks the products to download from a parsed catalog. Returns a list
+    of (product key, human-readable name) for each target, and selects the
+    first one."""
+    product_info = installer.software_catalog.product_info
+    if not product_info:
+        if arguments.daemon:
+            raise ValueError("No macOS installer products found in the "
+                             "sucatalog.")
         logger.log(FAIL, "No macOS installer products found in the sucatalog.")
         time.sleep(30)
         sys.exit(1)
@@ -1152,48 +4625,96 @@ def install_macos(arguments, script_thread):
     # If no target version is selected, download the latest version of
     # macOS as determined by the version number.
     if arguments.target_version:
-        arguments.target_version = arguments.target_version
-        logger.info("Using parsed parameter: " + arguments.target_version)
+        target_versions = arguments.target_version
+        logger.info("Using parsed parameter: " + ", ".join(target_versions))
     else:
-        arguments.target_version = get_latest_macos_version(
-            installer.software_catalog.product_info)
-        logger.info("Using discovered version: " + arguments.target_version)
-
+        target_versions = [get_latest_macos_version(product_info)]
+        logger.info("Using discovered version: " + target_versions[0])
+
+    targets = []
+    for target_version in target_versions:
+        product_key = matching_product_id(product_info, target_version)
+        if not product_key:
+            if arguments.daemon:
+                raise ValueError("No macOS installer matches " +
+                                 target_version)
+            logger.log(FAIL, "No macOS installer matches " + target_version)
+            sys.exit(1)
+        if product_key in [key for key, _ in targets]:
+            continue
+        logger.log(OLVL, "Found macOS Product ID: " + product_key)
+        # Use the product info to create a human-readable product name
+        # i.e. "macOS Mojave 10.14 - Dated: 12-12-2018"
+        targets.append(
+            (product_key, parse_version_string(product_info, product_key)))
     # Let the installer know which product will be targeted.
-    installer.target_version = matching_product_id(
-        installer.software_catalog.product_info, arguments.target_version)
-    logger.log(OLVL, "Found macOS Product ID: " + installer.target_version)
+    installer.select_product(targets[0][0])
 
-    # Use the product info to create a human-readable product name
-    # i.e. "macOS Mojave 10.14 - Dated: 12-12-2018"
-    version_string = parse_version_string(
-        installer.software_catalog.product_info, installer.target_version)
-    script_thread.version_text(version_string)
+    version_strings = ", ".join([name for _, name in targets])
+    script_thread.version_text(version_strings)
 
-    script_thread.reset_stage_progress()
-    logger.log(OLVL, "Downloading packages for: %s" % version_string)
+    logger.log(OLVL, "Downloading packages for: %s" % version_strings)
 
     if not arguments.caching_server:
         logger.debug("Checking for caching server.")
         arguments.caching_server = discover_caching_server()
 
-    logger.debug("Cahing Server: " + arguments.caching_server)
+    logger.debug("Caching Server: " + str(arguments.caching_server))
+    return targets
+
+
+def prefetch_product(arguments, script_thread):
+    """Download the target products into the working directory at low
+    priority, so a later run finds every package in place."""
+    lower_priority()
+    installer, targets = resolve_products(arguments, script_thread)
+    version_strings = ", ".join([name for _, name in targets])
+    with installer.timings.stage("replicate product"):
+        installer.replicate_products([key for key, _ in targets])
+    if installer.staging_failures:
+        logger.log(FAIL, "Prefetch of %s left %d damaged or missing "
+                   "files." % (version_strings,
+                               len(installer.staging_failures)))
+        sys.exit(1)
+    logger.info("Transfer stats: " + TRANSFER_STATS.report())
+    logger.log(OLVL, "Prefetch complete for %s" % version_strings)
+
+
+def install_macos(arguments, script_thread):
+    """Install macOS Installer Application and Launch startosinstall."""
+    if arguments.erase_install == "ERASEINSTALL":
+        logger.log(OLVL, "Checking for APFS volumes...")
+        if not has_apfs():
+            logger.log(FAIL, "This computer does not have an APFS volume. " +
+                       "Please use a different method to wipe this machine.")
+            script_thread.end_application()
+        else:
+            logger.log(OLVL, "APFS Present!")
+
+    installer, targets = resolve_products(arguments, script_thread)
 
-    # Download all the packages for the selected product.
-    logger.debug("Replicating Selected Product.")
-    installer.replicate_product()
+    # Download all the packages for the selected products.
+    logger.debug("Replicating Selected Products.")
+    with installer.timings.stage("replicate product"):
+        installer.replicate_products([key for key, _ in targets])
 
     script_thread.show_spinner()
 
     logger.log(OLVL, "All Download Tasks Complete!")
-    logger.log(OLVL, "Creating macOS installer in Applications folder...")
 
-    # install the product to the Applications folder.
-    installer.install_product()
+    # install the products to the Applications folder.
+    with installer.timings.stage("install product"):
+        for product_key, version_string in targets:
+            logger.log(OLVL, "Creating %s installer in Applications "
+                       "folder..." % version_string)
+            installer.select_product(product_key)
+            installer.install_product()
+    logger.info("Stage timings: " + installer.timings.report())
+    logger.info("Transfer stats: " + TRANSFER_STATS.report())
 
     logger.log(
         OLVL, "Installer downloaded and staged in Applications folder...")
-    script_thread.overall_progress(progress_percent(15))
+    script_thread.progress.finish_phase("install")
 
     if arguments.installer_only:
         logger.log(OLVL, "Done!")
@@ -1212,15 +4733,45 @@ def install_macos(arguments, script_thread):
 def main():
     """Main Function. This will run when this script is called explicitly."""
 
+    # Get the custom command line arguments passed to this script.
+    arguments = get_arguments()
+    start_cassette_recording(arguments)
+
+    # Listing only reads the catalog, so it does not need root or the GUI.
+    if arguments.list_changes:
+        list_changes(arguments, ScriptThread(arguments))
+        sys.exit(0)
+    if arguments.list_installers:
+        list_installers(arguments, ScriptThread(arguments))
+        sys.exit(0)
+    if arguments.serve_mirror is not None:
+        serve_mirror(arguments)
+        sys.exit(0)
+    if arguments.replay_cassette:
+        replay_cassette(arguments)
+        sys.exit(0)
+    if arguments.simulate_fleet:
+        run_fleet_simulation(arguments)
+        sys.exit(0)
+    if arguments.prefetch:
+        script_thread = ScriptThread(arguments)
+        start_metrics_exporter(arguments, script_thread)
+        start_progress_stream(arguments, script_thread)
+        prefetch_product(arguments, script_thread)
+        sys.exit(0)
+    if arguments.send:
+        sys.exit(daemon_client(arguments))
+    if arguments.daemon:
+        run_daemon(arguments)
+        sys.exit(0)
+
     if os.getuid() != 0:
         logger.error("This script requires elevated privileges.")
         sys.exit(1)
 
-    # Get the custom command line arguments passed to this script.
-    arguments = get_arguments()
-
     if arguments.show_gui != "False":
         # Setup PyObjC references to GUI window
+        load_gui()
         # Prevent the Python icon from showing in the Dock.
         info = NSBundle.mainBundle().infoDictionary()
         info["LSUIElement"] = True
@@ -1236,11 +4787,13 @@ def main():
         # Setup separate thread for underlying Python Script.
         script_thread = ScriptThread(arguments, gui=delegate.progress_window)
         script_thread.queue = delegate.progress_window.queue
+        start_metrics_exporter(arguments, script_thread)
         # Register the SIGUSR1 signal to the end_application method.
         signal.signal(signal.SIGUSR1, script_thread.receive_signal)
 
         # Create link between the script, the GUI, and logging.
         setup_logging(script_thread)
+        start_progress_stream(arguments, script_thread)
         # In this app we just start working, we don't have a stop/start button.
         script_thread.start_script()
 
@@ -1248,7 +4801,14 @@ def main():
         AppHelper.runEventLoop()
     else:
         script_thread = ScriptThread(arguments)
+        start_metrics_exporter(arguments, script_thread)
+        start_progress_stream(arguments, script_thread)
+        signal.signal(signal.SIGUSR1, script_thread.receive_signal)
         script_thread.start_script()
+        # Joining with a timeout keeps the main thread able to run the
+        # signal handler while the script runs.
+        while script_thread.thread1.is_alive():
+            script_thread.thread1.join(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,209 @@
+"""Shared fixtures for the installinstallmacos_gui tests.
+
+The script only imports PyObjC when it shows the GUI, so the tests also run
+where PyObjC is not installed, for example on Linux CI.
+"""
+import datetime
+import os
+import plistlib
+import re
+import shutil
+import SimpleHTTPServer
+import SocketServer
+import sys
+import threading
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+import installinstallmacos_gui as iim_module  # noqa: E402
+
+DIST_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<installer-gui-script minSpecVersion="1">
+<auxinfo><dict>
+<key>BUILD</key><string>%(build)s</string>
+<key>OSVERSION</key><string>%(version)s</string>
+</dict></auxinfo>
+<script>
+var nonSupportedModels = ['MacBookPro4,1','%(unsupported)s'];
+</script>
+</installer-gui-script>
+"""
+# The model the tests run as. Every product except the second lists it as
+# unsupported.
+MACHINE_MODEL = "TestMac1,1"
+
+
+class _FakeMacInfo(object):
+    machine_model = MACHINE_MODEL
+
+
+class Origin(object):
+    """A fake softwareupdate server: a catalog of installer products served
+    from a directory over loopback. Every GET path is recorded in hits, and
+    the path and start offset of every Range request in ranges. A path in
+    errors is answered with its [status, count] status count more times."""
+    def __init__(self, root):
+        self.root = root
+        self.hits = []
+        self.ranges = []
+        self.errors = {}
+        origin = self
+
+        class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def translate_path(self, path):
+                return origin.root + path.split("?")[0]
+
+            def do_GET(self):
+                origin.hits.append(self.path)
+                error = origin.errors.get(self.path)
+                if error and error[1]:
+                    error[1] -= 1
+                    self.send_error(error[0])
+                    return
+                ranged = re.match(r"bytes=(\d+)-$",
+                                  self.headers.get("Range", ""))
+                if not ranged:
+                    return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(
+                        self)
+                start = int(ranged.group(1))
+                origin.ranges.append((self.path, start))
+                with open(self.translate_path(self.path), "rb") as the_file:
+                    the_file.seek(start)
+                    data = the_file.read()
+                if not data:
+                    self.send_error(416)
+                    return
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %d-%d/%d" % (
+                    start, start + len(data) - 1, start + len(data)))
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.base_url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.catalog_url = self.base_url + "/cat/index.sucatalog"
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def build(self, count=3, package_sizes=(300000, 700000, 20000)):
+        """Writes a catalog of count installer products, each with one
+        package per size. Product 061-00001 is the one this Mac supports."""
+        if os.path.exists(self.root):
+            shutil.rmtree(self.root)
+        os.makedirs(os.path.join(self.root, "cat"))
+        products = {}
+        for index in range(count):
+            product_key = "061-%05d" % index
+            product_dir = os.path.join(self.root, "p", product_key)
+            product_url = "%s/p/%s" % (self.base_url, product_key)
+            os.makedirs(product_dir)
+            plistlib.writePlist(
+                {"CFBundleShortVersionString": "10.15.%d" % index,
+                 "localization": {"English": {"title": "macOS Catalina"}}},
+                os.path.join(product_dir, "md.smd"))
+            with open(os.path.join(product_dir, "English.dist"), "w") as dist:
+                dist.write(DIST_TEMPLATE % {
+                    "build": "19A%d" % index,
+                    "version": "10.15.%d" % index,
+                    "unsupported": (MACHINE_MODEL if index != 1
+                                    else "OtherMac1,1")})
+            packages = []
+            for number, size in enumerate(package_sizes):
+                name = "pkg%d" % number
+                with open(os.path.join(product_dir, name + ".pkg"),
+                          "wb") as package:
+                    package.write(os.urandom(size))
+                with open(os.path.join(product_dir, name + ".pkm"),
+                          "w") as metadata:
+                    metadata.write("<pkm/>")
+                packages.append({"URL": "%s/%s.pkg" % (product_url, name),
+                                 "Size": size,
+                                 "MetadataURL": "%s/%s.pkm" % (product_url,
+                                                               name)})
+            products[product_key] = {
+                "ServerMetadataURL": product_url + "/md.smd",
+                "PostDate": datetime.datetime(2019, 10, 7 + index),
+                "Distributions": {"English": product_url + "/English.dist"},
+                "Packages": packages,
+                "ExtendedMetaInfo": {"InstallAssistantPackageIdentifiers": {
+                    "OSInstall": "com.apple.mpkg.OSInstall"}},
+            }
+        products["000-other"] = {"Packages": []}
+        plistlib.writePlist({"Products": products},
+                            os.path.join(self.root, "cat", "index.sucatalog"))
+        return self
+
+    def edit_catalog(self, edit):
+        """Calls edit with the catalog's products and writes them back."""
+        path = os.path.join(self.root, "cat", "index.sucatalog")
+        catalog = plistlib.readPlist(path)
+        edit(catalog["Products"])
+        plistlib.writePlist(catalog, path)
+
+    def path_for(self, url):
+        """Returns the origin's own copy of url."""
+        return self.root + url[len(self.base_url):]
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def iim(monkeypatch, tmpdir):
+    """The script module, with its per-run state reset and its caches
+    redirected into tmpdir."""
+    monkeypatch.setattr(iim_module, "MacInfo", _FakeMacInfo)
+    monkeypatch.setattr(iim_module, "discover_caching_server", lambda: None)
+    monkeypatch.setattr(iim_module, "CATALOG_INDEX_DIR",
+                        str(tmpdir.join("catalogs")))
+    monkeypatch.setattr(iim_module, "SNAPSHOT_FILE",
+                        str(tmpdir.join("snapshot.json")))
+    monkeypatch.setattr(iim_module, "CIRCUIT_BREAKERS",
+                        iim_module.CircuitBreakers())
+    monkeypatch.setattr(iim_module, "TRANSFER_STATS",
+                        iim_module.TransferStats())
+    monkeypatch.setattr(iim_module, "RUN_METRICS", iim_module.RunMetrics())
+    monkeypatch.setattr(iim_module, "CASSETTE_RECORDER", None)
+    monkeypatch.setattr(iim_module, "RECOVERY_BACKOFF", 0)
+    monkeypatch.setattr(iim_module.log_stderr, "level", 100)
+    return iim_module
+
+
+@pytest.fixture
+def origin(tmpdir):
+    server = Origin(str(tmpdir.join("origin")))
+    yield server.build()
+    server.stop()
+
+
+@pytest.fixture
+def workdir(tmpdir):
+    return str(tmpdir.join("work"))
+
+
+@pytest.fixture
+def make_arguments(iim, origin, workdir, monkeypatch):
+    """Returns a function that parses command line flags the way main does,
+    pointed at the origin catalog and workdir."""
+    def make_arguments(*argv):
+        monkeypatch.setattr(sys, "argv", [
+            "installinstallmacos_gui.py", "--catalogurl", origin.catalog_url,
+            "--workdir", workdir] + list(argv))
+        arguments = iim.get_arguments()
+        arguments.caching_server = None
+        return arguments
+    return make_arguments
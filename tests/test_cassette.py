@@ -0,0 +1,63 @@
+"""Tests for recording a run as a cassette and replaying it offline."""
+import json
+import os
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def cassette_dir(tmpdir):
+    return str(tmpdir.join("cassette"))
+
+
+def package_sizes(workdir):
+    sizes = {}
+    for root, _, files in os.walk(workdir):
+        for name in files:
+            if name.endswith(".pkg"):
+                sizes[name] = os.path.getsize(os.path.join(root, name))
+    return sizes
+
+
+def test_record_and_replay(iim, origin, workdir, make_arguments,
+                           cassette_dir, tmpdir, monkeypatch):
+    origin.build(count=2, package_sizes=(iim.CASSETTE_BODY_LIMIT + 1000,
+                                         1234))
+    arguments = make_arguments("--cache-max-age", "0",
+                               "--target-version", "10.15.1")
+    recorder = iim.CassetteRecorder(cassette_dir)
+    monkeypatch.setattr(iim, "CASSETTE_RECORDER", recorder)
+    iim.prefetch_product(arguments, iim.ScriptThread(arguments))
+    recorder.save()
+    monkeypatch.setattr(iim, "CASSETTE_RECORDER", None)
+
+    with open(os.path.join(cassette_dir, iim.CASSETTE_FILE)) as the_file:
+        entries = dict((entry["path"], entry)
+                       for entry in json.load(the_file)["entries"])
+    assert entries["/cat/index.sucatalog"]["body"]
+    large = entries["/p/061-00001/pkg0.pkg"]
+    assert large["status"] == 200
+    assert large["size"] == iim.CASSETTE_BODY_LIMIT + 1000
+    assert not large["body"]
+
+    # The replay needs nothing from the origin.
+    origin.stop()
+    server = iim.CassetteServer(cassette_dir)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        replay_workdir = str(tmpdir.join("replay"))
+        replay_arguments = make_arguments("--cache-max-age", "0",
+                                          "--target-version", "10.15.1",
+                                          "--workdir", replay_workdir)
+        replay_arguments.catalogurl = [
+            server.base_url + "/" + origin.catalog_url.split("//", 1)[1]]
+        monkeypatch.setattr(iim, "CIRCUIT_BREAKERS", iim.CircuitBreakers())
+        iim.prefetch_product(replay_arguments,
+                             iim.ScriptThread(replay_arguments))
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert package_sizes(replay_workdir) == package_sizes(workdir)
@@ -0,0 +1,127 @@
+"""Tests for downloading and merging the softwareupdate catalogs, and for
+the catalog index."""
+import datetime
+
+import pytest
+
+
+def parse_catalogs(iim, arguments):
+    software_catalog = iim.MakeInstaller(
+        arguments, script_thread=iim.ScriptThread(arguments)
+    ).software_catalog
+    software_catalog.parse_catalogs()
+    return software_catalog
+
+
+def test_products_keep_their_catalog_when_another_fails(iim, origin,
+                                                        make_arguments):
+    arguments = make_arguments("--cache-max-age", "0")
+    arguments.catalogurl = [origin.base_url + "/cat/missing.sucatalog",
+                            origin.catalog_url]
+    software_catalog = parse_catalogs(iim, arguments)
+    assert software_catalog.product_catalogs["061-00001"] == [
+        origin.catalog_url]
+
+
+def index_path(iim, origin):
+    return iim.os.path.join(iim.CATALOG_INDEX_DIR, iim.hashlib.sha1(
+        origin.catalog_url).hexdigest() + ".idx")
+
+
+@pytest.fixture
+def full_parses(iim, monkeypatch):
+    """Counts the catalogs parsed from the raw catalog files."""
+    parses = []
+    parse_sucatalog = iim.SoftwareCatalog.parse_sucatalog
+
+    def counting_parse_sucatalog(self):
+        parses.append(self.su_catalog_url)
+        return parse_sucatalog(self)
+
+    monkeypatch.setattr(iim.SoftwareCatalog, "parse_sucatalog",
+                        counting_parse_sucatalog)
+    return parses
+
+
+def test_index_round_trip(iim, tmpdir):
+    path = str(tmpdir.join("catalogs", "test.idx"))
+    products = {
+        "061-00001": {"PostDate": datetime.datetime(2019, 10, 8, 1, 2, 3),
+                      "Packages": [{"URL": "http://127.0.0.1/a.pkg",
+                                    "Size": 10}]},
+        "000-other": {"Packages": []},
+    }
+    iim.write_catalog_index(path, "hash", products, ["061-00001"],
+                            {"061-00001": ["http://127.0.0.1/index"]})
+    index = iim.open_catalog_index(path, "hash")
+    assert sorted(index.keys()) == ["000-other", "061-00001"]
+    assert index["061-00001"] == products["061-00001"]
+    assert index.get("061-00009") is None
+    assert index.installers == ["061-00001"]
+    assert index.catalogs == {"061-00001": ["http://127.0.0.1/index"]}
+    index.close()
+    assert iim.open_catalog_index(path, "other hash") is None
+
+
+def test_changed_catalog_rebuilds_the_index(iim, origin, make_arguments,
+                                            full_parses):
+    arguments = make_arguments("--cache-max-age", "0")
+    parse_catalogs(iim, arguments)
+    parse_catalogs(iim, arguments)
+    assert len(full_parses) == 1
+
+    def edit(products):
+        products["061-00000"]["PostDate"] = datetime.datetime(2020, 1, 1)
+
+    origin.edit_catalog(edit)
+    software_catalog = parse_catalogs(iim, arguments)
+    assert len(full_parses) == 2
+    assert software_catalog.catalog["Products"]["061-00000"]["PostDate"] == (
+        datetime.datetime(2020, 1, 1))
+
+
+@pytest.mark.parametrize("damage", ["truncate", "corrupt"])
+def test_damaged_index_falls_back_to_a_full_parse(iim, origin, make_arguments,
+                                                  full_parses, damage):
+    arguments = make_arguments("--cache-max-age", "0")
+    parse_catalogs(iim, arguments)
+    path = index_path(iim, origin)
+    with open(path, "r+b") as the_file:
+        if damage == "truncate":
+            the_file.truncate(len(iim.CATALOG_INDEX_MAGIC) + 20)
+        else:
+            the_file.seek(len(iim.CATALOG_INDEX_MAGIC) + 8)
+            the_file.write("garbage")
+    software_catalog = parse_catalogs(iim, arguments)
+    assert len(full_parses) == 2
+    assert sorted(software_catalog.os_installers) == [
+        "061-00000", "061-00001", "061-00002"]
+    # The rebuilt index is used again.
+    parse_catalogs(iim, arguments)
+    assert len(full_parses) == 2
+
+
+def test_index_writable_by_others_is_ignored(iim, origin, make_arguments,
+                                             full_parses):
+    arguments = make_arguments("--cache-max-age", "0")
+    parse_catalogs(iim, arguments)
+    path = index_path(iim, origin)
+    iim.os.chmod(path, 0o666)
+    parse_catalogs(iim, arguments)
+    assert len(full_parses) == 2
+    # The index is replaced by a private one.
+    assert not iim.os.stat(path).st_mode & 0o022
+    parse_catalogs(iim, arguments)
+    assert len(full_parses) == 2
+
+
+def test_index_in_a_shared_directory_is_ignored(iim, origin, make_arguments,
+                                                full_parses):
+    arguments = make_arguments("--cache-max-age", "0")
+    parse_catalogs(iim, arguments)
+    iim.os.chmod(iim.CATALOG_INDEX_DIR, 0o777)
+    software_catalog = parse_catalogs(iim, arguments)
+    parse_catalogs(iim, arguments)
+    assert len(full_parses) == 3
+    assert sorted(software_catalog.os_installers) == [
+        "061-00000", "061-00001", "061-00002"]
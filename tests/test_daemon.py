@@ -0,0 +1,43 @@
+"""Tests for the daemon's per-job handling."""
+import threading
+
+import pytest
+
+
+def test_client_log_handler_only_sends_its_job(iim):
+    events = []
+    handler = iim.ClientLogHandler(events.append)
+    iim.logger.addHandler(handler)
+    try:
+        iim.logger.log(iim.OLVL, "from the job")
+        worker = threading.Thread(
+            target=iim.logger.log, args=(iim.OLVL, "from a job worker"),
+            name=iim.worker_thread_name("transfer"))
+        other = threading.Thread(target=iim.logger.log,
+                                 args=(iim.OLVL, "from another client"))
+        for thread in (worker, other):
+            thread.start()
+            thread.join()
+    finally:
+        iim.logger.removeHandler(handler)
+    assert [event["message"] for event in events] == [
+        "from the job", "from a job worker"]
+
+
+@pytest.mark.parametrize("target_version", ["10.15", [10.15], {"a": "b"}])
+def test_target_version_must_be_a_list_of_strings(iim, make_arguments,
+                                                  target_version):
+    daemon = iim.InstallerDaemon(make_arguments("--daemon"))
+    with pytest.raises(ValueError):
+        daemon.run({"command": "prefetch", "target_version": target_version},
+                   lambda event: True)
+
+
+def test_choose_targets_raises_in_daemon_mode(iim, make_arguments,
+                                              monkeypatch):
+    monkeypatch.setattr(iim.time, "sleep", lambda seconds: pytest.fail(
+        "choose_targets slept"))
+    arguments = make_arguments("--daemon")
+    installer = iim.MakeInstaller(arguments)
+    with pytest.raises(ValueError):
+        iim.choose_targets(installer, arguments, None)
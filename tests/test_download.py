@@ -0,0 +1,93 @@
+"""Tests for single downloads."""
+import BaseHTTPServer
+import gzip
+import os
+import StringIO
+import threading
+
+import pytest
+
+BODY = "<plist>" + "catalog " * 20000 + "</plist>"
+
+
+class ChunkedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Sends BODY with chunked transfer encoding, gzipped under /gzip/."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        data = BODY
+        self.send_response(200)
+        if self.path.startswith("/gzip/"):
+            compressed = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=compressed, mode="wb") as the_file:
+                the_file.write(BODY)
+            data = compressed.getvalue()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for offset in range(0, len(data), 4096):
+            chunk = data[offset:offset + 4096]
+            self.wfile.write("%x\r\n%s\r\n" % (len(chunk), chunk))
+        self.wfile.write("0\r\n\r\n")
+
+
+@pytest.fixture
+def chunked_server():
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), ChunkedHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield "http://127.0.0.1:%d" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize("path", ["/plain/index.sucatalog",
+                                  "/gzip/index.sucatalog"])
+def test_response_without_length(iim, make_arguments, chunked_server,
+                                 workdir, path):
+    script_thread = iim.ScriptThread(make_arguments())
+    local_path = iim.replicate_url(script_thread, chunked_server + path,
+                                   "catalog", root_dir=workdir)
+    with open(local_path) as the_file:
+        assert the_file.read() == BODY
+    assert script_thread.progress.expected["catalog"] == 0
+
+
+def read(path):
+    with open(path, "rb") as the_file:
+        return the_file.read()
+
+
+def test_interrupted_download_resumes_with_range(iim, origin, workdir):
+    url = origin.base_url + "/p/061-00001/pkg0.pkg"
+    local_path = iim.local_path_for_url(url, workdir)
+    cancelled = threading.Event()
+    threading.Timer(0.3, cancelled.set).start()
+    with pytest.raises(iim.ReplicationError):
+        iim.replicate_url(None, url, None, root_dir=workdir,
+                          expected_size=300000, cancel_event=cancelled,
+                          throttle=iim.TransferThrottle(100000,
+                                                        cancelled=cancelled))
+    partial = os.path.getsize(local_path + iim.PART_SUFFIX)
+    assert 0 < partial < 300000
+    assert not os.path.exists(local_path)
+    iim.replicate_url(None, url, None, root_dir=workdir, expected_size=300000)
+    assert origin.ranges == [("/p/061-00001/pkg0.pkg", partial)]
+    assert read(local_path) == read(origin.path_for(url))
+    assert not os.path.exists(local_path + iim.PART_SUFFIX)
+
+
+def test_package_metadata_is_reused_while_fresh(iim, origin, make_arguments):
+    arguments = make_arguments()
+    for _ in range(2):
+        installer = iim.MakeInstaller(
+            arguments, script_thread=iim.ScriptThread(arguments))
+        installer.software_catalog.start_parsing()
+        installer.target_version = "061-00001"
+        del origin.hits[:]
+        installer.replicate_product()
+    assert origin.hits == []
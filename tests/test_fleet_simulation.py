@@ -0,0 +1,32 @@
+"""Tests for the fleet load simulator."""
+
+
+def test_fleet_shares_the_cache(iim, make_arguments):
+    report = iim.simulate_fleet(make_arguments(), 3, package_count=2,
+                                package_size=200000)
+    assert report["clients"] == 3
+    assert report["completed"] == 3
+    assert report["errors"] == []
+    # Each package is filled into the cache from the origin once.
+    assert report["cache"]["filled"] == 2 * 200000
+    assert report["cache"]["rejected"] == 0
+    assert report["fallback_rate"] == 0
+    assert set(report["client_time"]) == set(["p50", "p95", "p99", "max"])
+
+
+def test_busy_cache_falls_back_to_the_origin(iim, make_arguments):
+    report = iim.simulate_fleet(
+        make_arguments("--transfer-engine", "pool"), 3, cache=(1, 0),
+        origin=(0, 2000), ramp=0.2, package_count=2, package_size=200000)
+    assert report["completed"] == 3
+    assert report["elapsed"] >= 0.2
+    assert report["cache"]["rejected"] > 0
+    assert report["fallback_rate"] > 0
+    assert report["transfer_stats"]["fallbacks"] > 0
+
+
+def test_ramp_flag(iim, make_arguments):
+    arguments = make_arguments("--simulate-fleet", "3", "--simulate-cache",
+                               "4:100", "--simulate-ramp", "1.5")
+    assert arguments.simulate_cache == (4, 100)
+    assert arguments.simulate_ramp == 1.5
@@ -0,0 +1,66 @@
+"""Tests for re-fetching damaged artifacts when the installer fails."""
+import os
+
+
+def make_installer(iim, make_arguments):
+    arguments = make_arguments("--cache-max-age", "0")
+    installer = iim.MakeInstaller(
+        arguments, script_thread=iim.ScriptThread(arguments))
+    installer.software_catalog.start_parsing()
+    installer.target_version = "061-00001"
+    installer.replicate_product()
+    return installer
+
+
+def test_find_suspect_artifacts(iim, origin, workdir, make_arguments):
+    installer = make_installer(iim, make_arguments)
+    assert installer.find_suspect_artifacts() == []
+    product_dir = os.path.join(workdir, "p", "061-00001")
+    with open(os.path.join(product_dir, "pkg0.pkg"), "ab") as package:
+        package.write("junk")
+    os.remove(os.path.join(product_dir, "pkg2.pkm"))
+    product_url = origin.base_url + "/p/061-00001/"
+    assert installer.find_suspect_artifacts("pkg1.pkg is damaged") == [
+        (product_url + "pkg0.pkg", "size mismatch"),
+        (product_url + "pkg1.pkg", "named by installer"),
+        (product_url + "pkg2.pkm", "missing"),
+    ]
+
+
+def test_install_product_refetches_only_suspects(iim, origin, workdir,
+                                                 make_arguments, tmpdir,
+                                                 monkeypatch):
+    installer = make_installer(iim, make_arguments)
+    product_dir = os.path.join(workdir, "p", "061-00001")
+    with open(os.path.join(product_dir, "pkg0.pkg"), "ab") as package:
+        package.write("junk")
+    os.remove(os.path.join(product_dir, "pkg2.pkm"))
+    # Fails, naming pkg1, until pkg0 is intact and pkg2.pkm is back.
+    fake_installer = tmpdir.join("installer")
+    fake_installer.write(
+        "#!/bin/sh\n"
+        "[ $(wc -c < %s) -eq 300000 ] && [ -e %s ] && exit 0\n"
+        "echo 'installer: Error - pkg1.pkg is damaged'\n"
+        "exit 1\n" % (os.path.join(product_dir, "pkg0.pkg"),
+                      os.path.join(product_dir, "pkg2.pkm")))
+    fake_installer.chmod(0o755)
+    monkeypatch.setattr(iim, "INSTALLER_CMD", str(fake_installer))
+    monkeypatch.setattr(iim.glob, "glob",
+                        lambda pattern: ["/Applications/startosinstall"])
+    del origin.hits[:]
+    installer.install_product()
+    assert sorted(os.path.basename(hit) for hit in origin.hits) == [
+        "pkg0.pkg", "pkg1.pkg", "pkg2.pkm"]
+    assert installer.find_suspect_artifacts() == []
+
+
+def test_refetch_honours_the_transfer_options(iim, origin, workdir,
+                                              make_arguments):
+    arguments = make_arguments("--cache-max-age", "0")
+    installer = iim.MakeInstaller(
+        arguments, script_thread=iim.ScriptThread(arguments))
+    url = origin.base_url + "/p/061-00001/pkg2.pkg"
+    # A cancelled run must not download anything more.
+    installer.transfer_engine.cancel()
+    installer.refetch_artifacts([(url, "missing")])
+    assert not os.path.exists(iim.local_path_for_url(url, workdir))
@@ -0,0 +1,51 @@
+"""Tests for --list."""
+import datetime
+import json
+import os
+import sys
+import time
+
+
+def list_installers(iim, make_arguments, capsys):
+    arguments = make_arguments("--list")
+    capsys.readouterr()
+    iim.list_installers(arguments, iim.ScriptThread(arguments))
+    return json.loads(capsys.readouterr()[0])
+
+
+def test_second_list_makes_no_requests(iim, origin, make_arguments, capsys):
+    listing = list_installers(iim, make_arguments, capsys)
+    assert [product["product_id"] for product in listing] == [
+        "061-00002", "061-00001", "061-00000"]
+    assert origin.hits
+    del origin.hits[:]
+    assert list_installers(iim, make_arguments, capsys) == listing
+    assert origin.hits == []
+    assert "AppKit" not in sys.modules
+
+
+def age_workdir(workdir, seconds, extension):
+    now = time.time()
+    for root, _, files in os.walk(workdir):
+        for name in files:
+            if name.endswith(extension):
+                path = os.path.join(root, name)
+                os.utime(path, (now - seconds, now - seconds))
+
+
+def test_list_refetches_metadata_of_a_reposted_product(iim, origin, workdir,
+                                                       make_arguments, capsys):
+    list_installers(iim, make_arguments, capsys)
+    age_workdir(workdir, 60, (".smd", ".dist"))
+    age_workdir(workdir, iim.CATALOG_MAX_AGE + 1, ".sucatalog")
+
+    def repost(products):
+        products["061-00000"]["PostDate"] = (
+            datetime.datetime.utcnow() - datetime.timedelta(seconds=30))
+
+    origin.edit_catalog(repost)
+    del origin.hits[:]
+    list_installers(iim, make_arguments, capsys)
+    assert sorted(origin.hits) == [
+        "/cat/index.sucatalog", "/p/061-00000/English.dist",
+        "/p/061-00000/md.smd"]
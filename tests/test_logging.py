@@ -0,0 +1,67 @@
+"""Tests for the asynchronous log file handler."""
+import logging
+import logging.handlers
+import threading
+import time
+
+import pytest
+
+
+@pytest.fixture
+def log_file(tmpdir):
+    """A rotating file handler whose writes wait until gate is set."""
+    target = logging.handlers.RotatingFileHandler(str(tmpdir.join("log")))
+    target.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+    target.gate = threading.Event()
+    target.shouldRollover = lambda record: not target.gate.wait(10)
+    return target
+
+
+def make_record(levelno, msg, *args, **kwargs):
+    return logging.LogRecord("test", levelno, __file__, 1, msg, args,
+                             kwargs.get("exc_info"))
+
+
+def test_full_queue_drops_only_debug_and_progress(iim, log_file):
+    handler = iim.AsyncLogHandler(log_file, queue_size=2, batch_size=1)
+    handler.emit(make_record(logging.INFO, "first"))
+    # The writer holds the first record until the gate opens.
+    while handler.queue.qsize():
+        time.sleep(0.01)
+    handler.emit(make_record(logging.INFO, "second"))
+    handler.emit(make_record(logging.INFO, "third"))
+    handler.emit(make_record(logging.DEBUG, "debug"))
+    handler.emit(make_record(iim.SLVL, "stage"))
+    assert handler.dropped == 2
+    blocked = threading.Thread(
+        target=handler.emit, args=(make_record(iim.OLVL, "overall"),))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+    log_file.gate.set()
+    blocked.join(5)
+    handler.close()
+    with open(log_file.baseFilename) as the_file:
+        lines = the_file.read().splitlines()
+    # The drop notice is written with whichever batch follows the drops.
+    assert sorted(lines) == [
+        "INFO first", "INFO second", "INFO third", "Overall overall",
+        "WARNING Dropped 2 DEBUG and progress records."]
+
+
+def test_other_handlers_see_the_original_record(iim, log_file):
+    log_file.gate.set()
+    handler = iim.AsyncLogHandler(log_file)
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        record = make_record(logging.ERROR, "failed %s", "here",
+                             exc_info=iim.sys.exc_info())
+    handler.emit(record)
+    handler.close()
+    assert record.args == ("here",)
+    assert record.exc_info[0] is ValueError
+    with open(log_file.baseFilename) as the_file:
+        lines = the_file.read().splitlines()
+    assert lines[0] == "ERROR failed here"
+    assert lines[-1] == "ValueError: boom"
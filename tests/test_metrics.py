@@ -0,0 +1,18 @@
+"""Tests for the Prometheus textfile exporter."""
+
+HIT_RATIO = "installinstallmacos_caching_server_hit_ratio"
+
+
+def hit_ratio_samples(text):
+    return [line for line in text.splitlines()
+            if line.startswith(HIT_RATIO + " ")]
+
+
+def test_hit_ratio_needs_caching_server_requests(iim, make_arguments,
+                                                 tmpdir):
+    exporter = iim.MetricsExporter(str(tmpdir.join("run.prom")),
+                                   iim.ScriptThread(make_arguments()))
+    assert hit_ratio_samples(exporter.render()) == []
+    iim.TRANSFER_STATS.count("cache_hits", 3)
+    iim.TRANSFER_STATS.count("fallbacks")
+    assert hit_ratio_samples(exporter.render()) == [HIT_RATIO + " 0.75"]
@@ -0,0 +1,51 @@
+"""Tests for serving the working directory as a mirror."""
+import os
+import threading
+import urllib2
+
+import pytest
+
+
+@pytest.fixture
+def mirror(iim, tmpdir):
+    root_dir = tmpdir.mkdir("mirror")
+    root_dir.mkdir("p").join("file.pkg").write("0123456789" * 10)
+    tmpdir.join("secret").write("secret")
+    os.symlink(str(tmpdir.join("secret")), str(root_dir.join("p", "link")))
+    server = iim.MirrorServer(("127.0.0.1", 0), str(root_dir))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield "http://127.0.0.1:%d" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def get(url, **headers):
+    try:
+        response = urllib2.urlopen(urllib2.Request(url, headers=headers))
+    except urllib2.HTTPError as err:
+        return err.code, None
+    return response.getcode(), response.read()
+
+
+def test_serves_ranges(mirror):
+    assert get(mirror + "/p/file.pkg?source=x") == (200, "0123456789" * 10)
+    assert get(mirror + "/p/file.pkg", Range="bytes=12-15") == (206, "2345")
+    assert get(mirror + "/p/file.pkg", Range="bytes=-3") == (206, "789")
+    assert get(mirror + "/p/file.pkg", Range="bytes=100-")[0] == 416
+
+
+def test_refuses_paths_outside_the_root(mirror):
+    assert get(mirror + "/../secret")[0] == 404
+    assert get(mirror + "/p/%2e%2e/%2e%2e/secret")[0] == 404
+    assert get(mirror + "/p/link")[0] == 404
+
+
+def test_refuses_the_default_workdir(iim, monkeypatch):
+    monkeypatch.setattr("sys.argv", ["installinstallmacos_gui.py",
+                                     "--serve-mirror", "0"])
+    arguments = iim.get_arguments()
+    assert arguments.mirror_address == "127.0.0.1"
+    with pytest.raises(SystemExit):
+        iim.serve_mirror(arguments)
@@ -0,0 +1,98 @@
+"""Tests for the progress model behind the bars, the ETA and the stream."""
+import pytest
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(iim, monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(iim.time, "time", fake_clock)
+    return fake_clock
+
+
+@pytest.fixture
+def published():
+    return []
+
+
+@pytest.fixture
+def model(iim, clock, published):
+    return iim.ProgressModel(publish=published.append)
+
+
+def test_phases_are_weighted(iim, clock, model, published):
+    assert dict(iim.PROGRESS_PHASES) == {"catalog": 5.0, "downloads": 80.0,
+                                         "install": 15.0}
+    model.expect("catalog", 100)
+    clock.now += 1
+    model.add_bytes("catalog", 50)
+    assert published[-1]["overall"] == 2.5
+    assert published[-1]["stage"] == 50.0
+    model.finish_phase("catalog")
+    assert published[-1]["overall"] == 5.0
+    assert published[-1]["stage"] == 100.0
+    model.expect("downloads", 1000)
+    clock.now += 1
+    model.add_bytes("downloads", 250)
+    # The stage bar starts over with each phase.
+    assert (published[-1]["overall"], published[-1]["stage"]) == (25.0, 25.0)
+    model.finish_phase("downloads")
+    model.finish_phase("install")
+    assert published[-1]["overall"] == 100.0
+
+
+def test_rate_is_smoothed_and_gives_the_eta(iim, clock, model, published):
+    model.expect("downloads", 10000)
+    clock.now += 1
+    model.add_bytes("downloads", 1000)
+    assert published[-1]["rate"] == 1000.0
+    assert published[-1]["eta"] == 9.0
+    clock.now += 1
+    model.add_bytes("downloads", 3000)
+    rate = 1000.0 + iim.PROGRESS_SMOOTHING * (3000.0 - 1000.0)
+    assert published[-1]["rate"] == rate
+    assert published[-1]["eta"] == 6000.0 / rate
+    # Within the sample interval the rate is left alone.
+    clock.now += iim.PROGRESS_PUBLISH_INTERVAL
+    model.add_bytes("downloads", 100)
+    assert published[-1]["rate"] == rate
+    assert published[-1]["done"] == 4100.0
+    # Within the publish interval nothing is published.
+    count = len(published)
+    clock.now += iim.PROGRESS_PUBLISH_INTERVAL / 2
+    model.add_bytes("downloads", 100)
+    assert len(published) == count
+
+
+def test_no_eta_before_the_first_sample(iim, clock, model, published):
+    model.expect("downloads", 10000)
+    clock.now += iim.PROGRESS_SAMPLE_INTERVAL / 2
+    model.add_bytes("downloads", 1000)
+    assert published[-1]["eta"] is None
+
+
+def test_bars_never_move_backwards(iim, clock, model, published):
+    model.expect("downloads", 1000)
+    clock.now += 1
+    model.add_bytes("downloads", 500)
+    assert (published[-1]["overall"], published[-1]["stage"]) == (40.0, 50.0)
+    # A new file adds to the bytes expected.
+    model.expect("downloads", 1000)
+    clock.now += 1
+    model.add_bytes("downloads", 10)
+    assert (published[-1]["overall"], published[-1]["stage"]) == (40.0, 50.0)
+    # A failed attempt takes its bytes back.
+    clock.now += 1
+    model.add_bytes("downloads", -400)
+    assert (published[-1]["overall"], published[-1]["stage"]) == (40.0, 50.0)
+    assert published[-1]["done"] == 110.0
+    clock.now += 1
+    model.add_bytes("downloads", 1390)
+    assert (published[-1]["overall"], published[-1]["stage"]) == (60.0, 75.0)
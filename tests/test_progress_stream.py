@@ -0,0 +1,42 @@
+"""Tests for --progress-stream."""
+import json
+import socket
+import time
+
+
+def test_file_destination(iim, tmpdir):
+    path = str(tmpdir.join("progress.ndjson"))
+    stream = iim.ProgressStream(path)
+    snapshot = {"phase": "downloads", "overall": 42.48, "stage": 80.0}
+    assert stream.send(iim.progress_event(snapshot))
+    assert stream.send({"event": "error", "message": "boom"})
+    stream.close()
+    with open(path) as the_file:
+        events = [json.loads(line) for line in the_file]
+    assert events == [
+        {"event": "progress", "progress": snapshot, "percent": 42.5},
+        {"event": "error", "message": "boom"}]
+    assert not stream.send({"event": "status"})
+
+
+def test_stalled_reader_does_not_block_the_run(iim, tmpdir, monkeypatch):
+    monkeypatch.setattr(iim, "PROGRESS_STREAM_TIMEOUT", 0.5)
+    monkeypatch.setattr(iim, "PROGRESS_STREAM_QUEUE_SIZE", 10)
+    path = str(tmpdir.join("progress.sock"))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    stream = iim.ProgressStream("unix:" + path)
+    # The reader accepts the connection and then never reads.
+    reader = server.accept()[0]
+    event = {"event": "status", "message": "x" * 65536}
+    started = time.time()
+    for _ in range(200):
+        stream.send(event)
+    assert time.time() - started < 1
+    stream.thread.join(5)
+    assert stream.ended
+    assert not stream.send(event)
+    stream.close()
+    reader.close()
+    server.close()
@@ -0,0 +1,142 @@
+"""Tests for retrying failed downloads and the per-host circuit breakers."""
+import httplib
+import socket
+import urllib2
+
+import pytest
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def sleeps(iim, monkeypatch):
+    """The delays download_with_retries sleeps for, without sleeping."""
+    delays = []
+    monkeypatch.setattr(iim.time, "sleep", delays.append)
+    # Every backoff takes its full jittered range.
+    monkeypatch.setattr(iim.random, "uniform", lambda low, high: high)
+    return delays
+
+
+def http_error(code):
+    return urllib2.HTTPError("http://127.0.0.1/", code, "", {}, None)
+
+
+@pytest.mark.parametrize("err, retryable", [
+    (http_error(503), True),
+    (http_error(429), True),
+    (http_error(404), False),
+    (socket.timeout("timed out"), True),
+    (urllib2.URLError("refused"), True),
+    (httplib.BadStatusLine(""), True),
+    (IOError(28, "No space left on device"), False),
+])
+def test_error_classification(iim, err, retryable):
+    assert iim.RetryPolicy().is_retryable(err) == retryable
+
+
+def test_replication_error_classification(iim):
+    policy = iim.RetryPolicy()
+    assert policy.is_retryable(iim.ShortReadError("short"))
+    assert policy.is_retryable(iim.CircuitOpenError("open"))
+    assert not policy.is_retryable(iim.ReplicationError("Cancelled"))
+
+
+def test_backoff_doubles_up_to_the_cap(iim, sleeps):
+    policy = iim.RetryPolicy(base_delay=1.0, max_delay=5.0)
+    assert [policy.delay(attempt) for attempt in range(1, 6)] == [
+        1.0, 2.0, 4.0, 5.0, 5.0]
+
+
+def test_transient_errors_are_retried(iim, origin, workdir, sleeps):
+    path = "/p/061-00001/pkg2.pkg"
+    origin.errors[path] = [503, 2]
+    iim.replicate_url(None, origin.base_url + path, None, root_dir=workdir,
+                      retry_policy=iim.RetryPolicy(attempts=3, base_delay=1.0,
+                                                   max_delay=1.5))
+    assert origin.hits == [path] * 3
+    assert sleeps == [1.0, 1.5]
+    assert iim.TRANSFER_STATS.counters["retries"] == 2
+
+
+def test_permanent_errors_are_not_retried(iim, origin, workdir, sleeps):
+    with pytest.raises(iim.ReplicationError):
+        iim.replicate_url(None, origin.base_url + "/p/missing.pkg", None,
+                          root_dir=workdir)
+    assert origin.hits == ["/p/missing.pkg"]
+    assert sleeps == []
+
+
+def test_programming_errors_are_not_wrapped(iim, origin, workdir,
+                                            monkeypatch):
+    def download_url(*args):
+        raise TypeError("bug")
+
+    monkeypatch.setattr(iim, "download_url", download_url)
+    with pytest.raises(TypeError):
+        iim.replicate_url(None, origin.base_url + "/p/061-00001/pkg2.pkg",
+                          None, root_dir=workdir)
+
+
+def test_complete_partial_file_is_not_requested(iim, origin, workdir):
+    url = origin.base_url + "/p/061-00001/pkg2.pkg"
+    local_path = iim.local_path_for_url(url, workdir)
+    iim.os.makedirs(iim.os.path.dirname(local_path))
+    with open(origin.path_for(url), "rb") as source:
+        data = source.read()
+    with open(local_path + iim.PART_SUFFIX, "wb") as part:
+        part.write(data)
+    iim.replicate_url(None, url, None, root_dir=workdir,
+                      expected_size=len(data))
+    assert origin.hits == []
+    with open(local_path, "rb") as the_file:
+        assert the_file.read() == data
+    assert not iim.os.path.exists(local_path + iim.PART_SUFFIX)
+
+
+def test_breaker_opens_half_opens_and_closes(iim, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(iim.time, "time", clock)
+    breaker = iim.CircuitBreaker("host", failure_limit=2, reset_after=60)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    clock.now += 60
+    # Half open: one more failure opens it again at once.
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    clock.now += 60
+    assert breaker.allow()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.allow()
+
+
+def test_open_breaker_stops_requests_to_the_origin(iim, origin, workdir,
+                                                   sleeps):
+    bad_path = "/p/061-00001/pkg0.pkg"
+    good_path = "/p/061-00001/pkg2.pkg"
+    origin.errors[bad_path] = [500, iim.CIRCUIT_FAILURE_LIMIT]
+    policy = iim.RetryPolicy(attempts=1)
+    for _ in range(iim.CIRCUIT_FAILURE_LIMIT):
+        with pytest.raises(iim.ReplicationError):
+            iim.replicate_url(None, origin.base_url + bad_path, None,
+                              root_dir=workdir, retry_policy=policy)
+    with pytest.raises(iim.CircuitOpenError):
+        iim.replicate_url(None, origin.base_url + good_path, None,
+                          root_dir=workdir, retry_policy=policy)
+    assert origin.hits == [bad_path] * iim.CIRCUIT_FAILURE_LIMIT
+    breaker = iim.CIRCUIT_BREAKERS.get(origin.base_url.split("//")[1])
+    breaker.opened -= iim.CIRCUIT_RESET_AFTER
+    iim.replicate_url(None, origin.base_url + good_path, None,
+                      root_dir=workdir, retry_policy=policy)
+    assert breaker.failures == 0
+    assert breaker.allow()
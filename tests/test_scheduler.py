@@ -0,0 +1,126 @@
+"""Tests for the order packages are downloaded in."""
+
+
+def package(name, size):
+    return {"URL": "http://127.0.0.1/p/%s" % name, "Size": size}
+
+
+PACKAGES = [package("Core.pkg", 300), package("Info.pkg", 5),
+            package("Extra.pkg", 40), package("Base.dmg", 900)]
+
+
+def names(packages):
+    return [entry["URL"].split("/")[-1] for entry in packages]
+
+
+def simulate_schedule(sizes, workers, total_bandwidth,
+                      connection_bandwidth=None):
+    """Returns the seconds needed to download files of the given sizes, in
+    the given order, with each of workers taking the next file when it is
+    free. The active downloads share total_bandwidth equally, each capped at
+    connection_bandwidth. Both bandwidths are in bytes per second."""
+    pending = list(sizes)
+    active = []
+    elapsed = 0.0
+    while pending or active:
+        while pending and len(active) < max(workers, 1):
+            active.append(float(pending.pop(0)))
+        rate = total_bandwidth / len(active)
+        if connection_bandwidth:
+            rate = min(rate, connection_bandwidth)
+        step = min(active) / rate
+        elapsed += step
+        active = [remaining - step * rate for remaining in active
+                  if remaining - step * rate > 1e-6]
+    return elapsed
+
+
+def makespan(packages, workers):
+    # Each connection gets at most half of the link.
+    return simulate_schedule([entry["Size"] for entry in packages], workers,
+                             total_bandwidth=100.0, connection_bandwidth=50.0)
+
+
+def test_several_workers_break_ties_largest_first(iim):
+    scheduler = iim.DownloadScheduler(4)
+    assert names(scheduler.order(PACKAGES, ("Info.pkg", "Core.pkg"))) == [
+        "Info.pkg", "Core.pkg", "Base.dmg", "Extra.pkg"]
+
+
+def test_one_worker_keeps_installer_order(iim):
+    scheduler = iim.DownloadScheduler(1)
+    assert names(scheduler.order(PACKAGES, ("Info.pkg", "Core.pkg"))) == [
+        "Info.pkg", "Core.pkg", "Extra.pkg", "Base.dmg"]
+
+
+def test_need_order_is_kept_over_size(iim):
+    scheduler = iim.DownloadScheduler(4)
+    package_order = ("Info.pkg", "Extra.pkg", "Core.pkg", "Base.dmg")
+    assert names(scheduler.order(PACKAGES, package_order)) == list(
+        package_order)
+
+
+def test_makespan_is_no_worse_than_fifo(iim):
+    packages = [package("Small%d.pkg" % number, 20) for number in range(4)]
+    packages += [package("Large.pkg", 400), package("Core.pkg", 100)]
+    for package_order in [(), ("Core.pkg",), ("Small0.pkg", "Small1.pkg"),
+                          ("Large.pkg", "Core.pkg")]:
+        fifo = iim.order_packages(packages, package_order)
+        scheduled = iim.DownloadScheduler(2).order(packages, package_order)
+        assert makespan(scheduled, 2) <= makespan(fifo, 2)
+    # Nothing ranks the packages, so the large one is started first instead
+    # of last.
+    assert makespan(iim.DownloadScheduler(2).order(packages, ()), 2) < (
+        makespan(iim.order_packages(packages, ()), 2))
+
+
+class Product(object):
+    def __init__(self, packages, package_order=()):
+        self.packages = packages
+        self.package_order = package_order
+
+
+def test_shared_packages_are_downloaded_once(iim):
+    products = [Product(PACKAGES[:3], ("Extra.pkg",)),
+                Product([package("Own.pkg", 600)] + PACKAGES[1:])]
+    assert names(iim.DownloadScheduler(1).order_products(products)) == [
+        "Extra.pkg", "Core.pkg", "Info.pkg", "Own.pkg", "Base.dmg"]
+    assert names(iim.DownloadScheduler(2).order_products(products)) == [
+        "Extra.pkg", "Core.pkg", "Info.pkg", "Base.dmg", "Own.pkg"]
+
+
+class NamedProduct(Product):
+    title = "macOS Catalina"
+
+    def __init__(self, version, packages):
+        Product.__init__(self, packages)
+        self.version = version
+
+
+def test_each_target_completes_once(iim, monkeypatch):
+    messages = []
+    monkeypatch.setattr(iim.logger, "log", lambda level, message:
+                        messages.append((level, message)))
+    shared = package("Shared.pkg", 10)
+    first = package("First.pkg", 20)
+    second = package("Second.pkg", 30)
+    completion = iim.TargetCompletion(
+        ["061-00001", "061-00002"],
+        [NamedProduct("10.15.1", [first, shared]),
+         NamedProduct("10.15.2", [shared, second])])
+    for done in (first, shared, first, shared):
+        completion.package_done(done)
+    assert completion.completed == ["061-00001"]
+    completion.package_done(second)
+    completion.package_done(second)
+    assert completion.completed == ["061-00001", "061-00002"]
+    assert messages == [
+        (iim.OLVL, "Downloads complete for macOS Catalina 10.15.1 (1 of 2)."),
+        (iim.OLVL, "Downloads complete for macOS Catalina 10.15.2 (2 of 2).")]
+
+
+def test_a_single_target_is_not_announced(iim):
+    completion = iim.TargetCompletion(
+        ["061-00001"], [NamedProduct("10.15.1", [package("Only.pkg", 10)])])
+    completion.package_done(package("Only.pkg", 10))
+    assert completion.completed == []
@@ -0,0 +1,86 @@
+"""Tests for several processes downloading into one working directory."""
+import logging
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+PACKAGE_SIZE = 1500000
+
+
+@pytest.fixture
+def mirror(iim, origin, monkeypatch):
+    """A MirrorServer serving the origin's files. Returns its base URL and
+    the list of paths it was asked for."""
+    origin.build(count=1, package_sizes=(PACKAGE_SIZE,))
+    requests = []
+    send_file = iim.MirrorRequestHandler.send_file
+
+    def counting_send_file(self, head=False):
+        requests.append(self.path)
+        return send_file(self, head)
+
+    monkeypatch.setattr(iim.MirrorRequestHandler, "send_file",
+                        counting_send_file)
+    server = iim.MirrorServer(("127.0.0.1", 0), origin.root)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield "http://127.0.0.1:%d" % server.server_address[1], requests
+    server.shutdown()
+    server.server_close()
+
+
+def fork_replicate(iim, url, workdir, rate):
+    """Runs replicate_url in a child process. Returns its pid."""
+    pid = os.fork()
+    if pid:
+        return pid
+    status = 1
+    try:
+        # The parent's server thread may have held the logging locks at the
+        # fork.
+        logging.disable(logging.CRITICAL)
+        iim.replicate_url(None, url, None, root_dir=workdir,
+                          expected_size=PACKAGE_SIZE,
+                          throttle=iim.TransferThrottle(rate))
+        status = 0
+    finally:
+        os._exit(status)
+
+
+def read(path):
+    with open(path, "rb") as the_file:
+        return the_file.read()
+
+
+def test_processes_download_each_file_once(iim, origin, mirror, workdir):
+    base_url, requests = mirror
+    url = base_url + "/p/061-00000/pkg0.pkg"
+    pids = []
+    for _ in range(4):
+        pids.append(fork_replicate(iim, url, workdir, PACKAGE_SIZE))
+        time.sleep(0.1)
+    assert [os.waitpid(pid, 0)[1] for pid in pids] == [0, 0, 0, 0]
+    assert requests == ["/p/061-00000/pkg0.pkg"]
+    local_path = iim.local_path_for_url(url, workdir)
+    assert read(local_path) == read(origin.path_for(url))
+    assert not os.path.exists(local_path + iim.PART_SUFFIX)
+
+
+def test_download_resumes_after_holder_dies(iim, origin, mirror, workdir):
+    base_url, requests = mirror
+    url = base_url + "/p/061-00000/pkg0.pkg"
+    local_path = iim.local_path_for_url(url, workdir)
+    pid = fork_replicate(iim, url, workdir, PACKAGE_SIZE / 3)
+    time.sleep(1)
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+    assert os.path.getsize(local_path + iim.PART_SUFFIX) > 0
+    assert not os.path.exists(local_path)
+    iim.replicate_url(None, url, None, root_dir=workdir,
+                      expected_size=PACKAGE_SIZE)
+    assert read(local_path) == read(origin.path_for(url))
+    assert len(requests) == 2
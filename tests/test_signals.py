@@ -0,0 +1,46 @@
+"""Tests for waiting on the signal from startosinstall."""
+import signal
+import time
+
+import pytest
+
+
+@pytest.fixture
+def script_thread(iim, make_arguments):
+    script_thread = iim.ScriptThread(make_arguments())
+    previous = signal.signal(signal.SIGUSR1, script_thread.receive_signal)
+    yield script_thread
+    signal.signal(signal.SIGUSR1, previous)
+
+
+def test_receive_signal_does_not_log(iim, script_thread, monkeypatch):
+    messages = []
+    monkeypatch.setattr(iim.logger, "debug", messages.append)
+    script_thread.receive_signal(signal.SIGUSR1, None)
+    assert messages == []
+    with pytest.raises(SystemExit):
+        script_thread.wait_for_the_end()
+    assert "Got signal! %d" % signal.SIGUSR1 in messages
+
+
+def test_startosinstall_signal_ends_the_wait(iim, script_thread, tmpdir,
+                                             make_arguments):
+    startosinstall = tmpdir.join("startosinstall")
+    startosinstall.write(
+        "#!/bin/sh\n"
+        "while [ \"$1\" ]; do\n"
+        "  [ \"$1\" = --pidtosignal ] && pid=$2\n"
+        "  shift\n"
+        "done\n"
+        "sleep 0.2\n"
+        "kill -USR1 $pid\n")
+    startosinstall.chmod(0o755)
+    installer = iim.MakeInstaller(
+        make_arguments("--launch-delay", "0"), script_thread=script_thread)
+    installer.os_install = str(startosinstall)
+    started = time.time()
+    installer.launch_osinstall()
+    with pytest.raises(SystemExit):
+        script_thread.wait_for_the_end()
+    assert time.time() - started < 5
+    assert script_thread.cancel_event.is_set()
@@ -0,0 +1,80 @@
+"""Tests for --list-changes and --incremental against the snapshot."""
+import copy
+import datetime
+import json
+
+
+def list_changes(iim, make_arguments, capsys, *argv):
+    arguments = make_arguments("--list-changes", "--cache-max-age", "0",
+                               *argv)
+    capsys.readouterr()
+    iim.list_changes(arguments, iim.ScriptThread(arguments))
+    changes = json.loads(capsys.readouterr()[0])
+    return dict((kind, sorted(product["product_id"]
+                              for product in changes[kind]))
+                for kind in ("added", "changed", "removed"))
+
+
+def metadata_requests(origin):
+    return sorted(hit for hit in origin.hits
+                  if hit.endswith((".smd", ".dist")))
+
+
+def test_added_changed_and_removed(iim, origin, make_arguments, capsys):
+    assert list_changes(iim, make_arguments, capsys) == {
+        "added": ["061-00000", "061-00001", "061-00002"],
+        "changed": [], "removed": []}
+    del origin.hits[:]
+    assert list_changes(iim, make_arguments, capsys) == {
+        "added": [], "changed": [], "removed": []}
+    assert metadata_requests(origin) == []
+
+    def edit(products):
+        products["061-00000"]["PostDate"] = datetime.datetime(2020, 1, 1)
+        del products["061-00002"]
+        products["061-00009"] = copy.deepcopy(products["061-00001"])
+
+    origin.edit_catalog(edit)
+    del origin.hits[:]
+    assert list_changes(iim, make_arguments, capsys) == {
+        "added": ["061-00009"], "changed": ["061-00000"],
+        "removed": ["061-00002"]}
+    # Only the reposted product is fetched again. The added one shares
+    # the files of 061-00001.
+    assert metadata_requests(origin) == [
+        "/p/061-00000/English.dist", "/p/061-00000/md.smd",
+        "/p/061-00001/English.dist", "/p/061-00001/md.smd"]
+
+
+def test_missing_dist_is_not_a_change(iim, origin, workdir, make_arguments,
+                                      capsys):
+    list_changes(iim, make_arguments, capsys)
+    iim.os.remove(iim.local_path_for_url(
+        origin.base_url + "/p/061-00001/English.dist", workdir))
+    del origin.hits[:]
+    assert list_changes(iim, make_arguments, capsys) == {
+        "added": [], "changed": [], "removed": []}
+    assert metadata_requests(origin) == [
+        "/p/061-00001/English.dist", "/p/061-00001/md.smd"]
+
+
+def test_incremental_refetches_in_a_new_workdir(iim, origin, make_arguments,
+                                                tmpdir):
+    def parse(*argv):
+        arguments = make_arguments("--incremental", "--cache-max-age", "0",
+                                   *argv)
+        software_catalog = iim.MakeInstaller(
+            arguments, script_thread=iim.ScriptThread(arguments)
+        ).software_catalog
+        software_catalog.start_parsing()
+        return software_catalog
+
+    parse()
+    del origin.hits[:]
+    parse()
+    assert metadata_requests(origin) == []
+    other_workdir = str(tmpdir.join("other"))
+    software_catalog = parse("--workdir", other_workdir)
+    assert len(metadata_requests(origin)) == 6
+    dist_path = software_catalog.product_info["061-00001"].distribution_path
+    assert dist_path.startswith(other_workdir)
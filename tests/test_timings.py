@@ -0,0 +1,48 @@
+"""Tests for the stage timings and --profile."""
+import os
+
+import pytest
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_stages_are_timed_innermost_first(iim, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(iim.time, "time", clock)
+    timings = iim.StageTimings()
+    with timings.stage("catalog parse"):
+        clock.now += 2
+        with timings.stage("product info"):
+            clock.now += 0.5
+    with pytest.raises(ValueError):
+        with timings.stage("replicate product"):
+            clock.now += 1
+            raise ValueError("failed")
+    assert timings.stages == [("product info", 0.5), ("catalog parse", 2.5),
+                              ("replicate product", 1.0)]
+    assert timings.report() == ("product info: 0.50s, catalog parse: 2.50s, "
+                                "replicate product: 1.00s")
+    assert iim.RUN_METRICS.snapshot()[1] == {
+        "catalog parse": 2.5, "product info": 0.5, "replicate product": 1.0}
+
+
+def test_profile_covers_outermost_stages(iim, tmpdir):
+    profile_dir = str(tmpdir)
+    timings = iim.StageTimings(profile_dir=profile_dir)
+    with timings.stage("catalog parse"):
+        with timings.stage("product info"):
+            pass
+    prefix = "%s.%s.catalog_parse" % (iim.LONG_R_DOMAIN, timings.run_stamp)
+    assert sorted(os.listdir(profile_dir)) == [
+        prefix + ".allocations.txt", prefix + ".pstats"]
+    with open(os.path.join(profile_dir,
+                           prefix + ".allocations.txt")) as the_file:
+        assert the_file.readline() == "Stage: catalog parse\n"
+    assert [name for name, _ in timings.stages] == ["product info",
+                                                    "catalog parse"]
@@ -0,0 +1,122 @@
+"""Tests for the pooled transfer engine."""
+import os
+import threading
+import time
+
+import pytest
+
+
+def test_map_keeps_order(iim):
+    engine = iim.TransferEngine(workers=4)
+    assert engine.map(lambda item: item * 2, range(10)) == [
+        item * 2 for item in range(10)]
+
+
+def test_map_raises_worker_exception(iim):
+    def function(item):
+        if item == 3:
+            raise KeyError(item)
+        return item
+
+    engine = iim.TransferEngine(workers=4)
+    with pytest.raises(KeyError):
+        engine.map(function, range(10))
+
+
+def test_replicate_url_into_new_directory_from_many_threads(iim, origin,
+                                                            workdir):
+    urls = [origin.base_url + "/p/061-00000/" + name
+            for name in ("pkg0.pkg", "pkg1.pkg", "pkg2.pkg", "pkg0.pkm",
+                         "pkg1.pkm", "pkg2.pkm", "md.smd", "English.dist")]
+    start = threading.Event()
+
+    def replicate(url):
+        start.wait()
+        return iim.replicate_url(None, url, None, root_dir=workdir)
+
+    engine = iim.TransferEngine(workers=len(urls), max_per_host=len(urls))
+    threading.Timer(0.1, start.set).start()
+    paths = engine.map(replicate, urls)
+    for url, path in zip(urls, paths):
+        with open(path, "rb") as copy, open(origin.path_for(url), "rb") as \
+                original:
+            assert copy.read() == original.read()
+
+
+@pytest.mark.parametrize("engine", ["serial", "pool"])
+def test_replicate_product(iim, origin, workdir, make_arguments, engine):
+    arguments = make_arguments("--cache-max-age", "0",
+                               "--transfer-engine", engine)
+    installer = iim.MakeInstaller(
+        arguments, script_thread=iim.ScriptThread(arguments))
+    installer.software_catalog.start_parsing()
+    assert sorted(installer.software_catalog.product_info) == ["061-00001"]
+    installer.target_version = "061-00001"
+    installer.replicate_product()
+    assert installer.staging_failures == []
+    product_dir = os.path.join(workdir, "p", "061-00001")
+    assert sorted(name for name in os.listdir(product_dir)
+                  if not name.endswith(iim.LOCK_SUFFIX)) == [
+        "English.dist", "md.smd", "pkg0.pkg", "pkg0.pkm", "pkg1.pkg",
+        "pkg1.pkm", "pkg2.pkg", "pkg2.pkm"]
+
+
+def test_cancelled_pipelined_download_stops_writer(iim, origin, workdir,
+                                                   monkeypatch):
+    monkeypatch.setattr(iim, "PIPELINE_THRESHOLD", 0)
+    url = origin.base_url + "/p/061-00000/pkg1.pkg"
+    local_path = iim.local_path_for_url(url, workdir)
+    os.makedirs(os.path.dirname(local_path))
+    cancel_event = threading.Event()
+    cancel_event.set()
+    threads = threading.active_count()
+    with pytest.raises(iim.ReplicationError):
+        iim.download_url(None, url, url, local_path, "pkg1.pkg", None,
+                         65536, None, cancel_event, 700000, None)
+    assert threading.active_count() == threads
+
+
+def test_failed_package_is_not_staged(iim, origin, make_arguments,
+                                      monkeypatch):
+    missing_url = origin.base_url + "/p/061-00001/pkg1.pkg"
+    os.remove(origin.path_for(missing_url))
+    staged = []
+    monkeypatch.setattr(iim.StagingPipeline, "submit",
+                        lambda self, package, path: staged.append(path))
+    arguments = make_arguments("--cache-max-age", "0")
+    installer = iim.MakeInstaller(
+        arguments, script_thread=iim.ScriptThread(arguments))
+    installer.software_catalog.start_parsing()
+    installer.target_version = "061-00001"
+    installer.replicate_product()
+    assert [url for url, _ in installer.staging_failures] == [missing_url]
+    assert sorted(os.path.basename(path) for path in staged) == [
+        "pkg0.pkg", "pkg2.pkg"]
+
+
+def test_throttle_pauses_outside_the_windows(iim, monkeypatch):
+    monkeypatch.setattr(iim, "PREFETCH_WINDOW_CHECK", 0.01)
+    clock = {"minute": 23 * 60}
+    monkeypatch.setattr(iim.time, "localtime", lambda: time.struct_time(
+        (2026, 10, 19, clock["minute"] // 60, clock["minute"] % 60, 0, 0,
+         292, 0)))
+    # The window crosses midnight.
+    throttle = iim.TransferThrottle(windows=[(22 * 60, 6 * 60)])
+    throttle.consume(100)
+    clock["minute"] = 12 * 60
+    paused = threading.Thread(target=throttle.consume, args=(100,))
+    paused.start()
+    paused.join(0.2)
+    assert paused.is_alive()
+    clock["minute"] = 5 * 60 + 59
+    paused.join(5)
+    assert not paused.is_alive()
+    # A cancel ends the pause as well.
+    clock["minute"] = 6 * 60
+    paused = threading.Thread(target=throttle.consume, args=(100,))
+    paused.start()
+    paused.join(0.2)
+    assert paused.is_alive()
+    throttle.cancelled.set()
+    paused.join(5)
+    assert not paused.is_alive()